@@ -0,0 +1,86 @@
+"""Recall and latency of the ANN gallery indexes against exact search.
+
+Builds a synthetic gallery of normalized 512-d templates (identities drawn
+around random centres, queries are noisy copies of enrolled templates) and
+reports build time, recall@1/@k against the exact matrix product and per-query
+latency for each index and knob setting.
+
+    PYTHONPATH=src python benchmarks/ann_recall.py --size 100000 --ef_search 16 64 256 --nprobe 4 16 64
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from serving.ann import HnswIndex, IVFIndex, exact_search
+
+
+def synthetic_gallery(size, dim, nqueries, noise, seed=0):
+    rng = np.random.RandomState(seed)
+    centres = rng.normal(size=(max(1, size // 100), dim))
+    embeddings = centres[rng.randint(len(centres), size=size)] + rng.normal(size=(size, dim))
+    embeddings = (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+    targets = rng.choice(size, nqueries, replace=False)
+    queries = embeddings[targets] + noise * rng.normal(size=(nqueries, dim)) / np.sqrt(dim)
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    return embeddings, queries
+
+
+def evaluate(label, index, ids, queries, truth, k):
+    start = time.perf_counter()
+    found = [index.search(query, k)[0][0] for query in queries]
+    per_query_ms = (time.perf_counter() - start) * 1000.0 / len(queries)
+    recall_1 = np.mean([result[:1] == [ids[row[0]]] for result, row in zip(found, truth)])
+    recall_k = np.mean([len(set(result) & {ids[r] for r in row}) / float(k) for result, row in zip(found, truth)])
+    print("%-28s recall@1 %.4f  recall@%d %.4f  %8.3f ms/query" % (label, recall_1, k, recall_k, per_query_ms))
+
+
+def main(args):
+    embeddings, queries = synthetic_gallery(args.size, args.dim, args.queries, args.noise)
+    ids = ['%d' % i for i in range(args.size)]
+
+    start = time.perf_counter()
+    truth = [exact_search(embeddings, query, args.k)[0][0] for query in queries]
+    print("%-28s %8.3f ms/query  (%d x %d)" % ("exact", (time.perf_counter() - start) * 1000.0 / len(queries),
+                                              args.size, args.dim))
+
+    if 'hnsw' in args.indexes:
+        try:
+            start = time.perf_counter()
+            index = HnswIndex.build(ids, embeddings, M=args.M, ef_construction=args.ef_construction)
+            print("hnsw build (M=%d, ef_construction=%d): %.1f s" % (args.M, args.ef_construction,
+                                                                    time.perf_counter() - start))
+            for ef_search in args.ef_search:
+                index.ef_search = ef_search
+                evaluate("hnsw ef_search=%d" % ef_search, index, ids, queries, truth, args.k)
+        except ImportError:
+            print("hnsw skipped: hnswlib is not installed")
+
+    if 'ivf' in args.indexes:
+        start = time.perf_counter()
+        index = IVFIndex.build(ids, embeddings, nlist=args.nlist)
+        print("ivf build (nlist=%d): %.1f s" % (len(index.centroids), time.perf_counter() - start))
+        for nprobe in args.nprobe:
+            index.nprobe = nprobe
+            evaluate("ivf nprobe=%d" % nprobe, index, ids, queries, truth, args.k)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000, help='Number of templates in the gallery.')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--noise', type=float, default=0.5, help='Norm of the noise added to each query.')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--indexes', nargs='+', choices=['hnsw', 'ivf'], default=['hnsw', 'ivf'])
+    parser.add_argument('--M', type=int, default=16)
+    parser.add_argument('--ef_construction', type=int, default=200)
+    parser.add_argument('--ef_search', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--nlist', type=int, default=0, help='IVF cells, 0 for 4 * sqrt(size).')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,87 @@
+"""Per-stage latency of the inference backends.
+
+Runs PNet at the pyramid scales of a webcam frame, RNet/ONet and FaceNet at
+the given batch sizes on every requested backend and prints median and p95
+latency per stage.
+
+    PYTHONPATH=src python benchmarks/backend_latency.py --backends tensorflow onnxruntime
+"""
+import argparse
+import dataclasses
+import sys
+import time
+
+import numpy as np
+
+from serving.backends import BACKENDS, create_backend
+from serving.settings import Settings
+
+
+def pyramid_shapes(height, width, minsize=20, factor=0.709):
+    # Same scale pyramid as align.detect_face.detect_face
+    shapes = []
+    m = 12.0 / minsize
+    minl = min(height, width) * m
+    scale = m
+    while minl >= 12:
+        shapes.append((int(np.ceil(height * scale)), int(np.ceil(width * scale))))
+        minl *= factor
+        scale *= factor
+    return shapes
+
+
+def time_call(fn, arg, repeats):
+    fn(arg)
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return np.median(samples), np.percentile(samples, 95)
+
+
+def run(backend, frame_size, batch_sizes, repeats):
+    rng = np.random.RandomState(0)
+    results = []
+
+    # PNet takes the transposed (caffe) layout, one call per pyramid scale
+    pnet_total = []
+    for height, width in pyramid_shapes(*frame_size):
+        img = rng.uniform(-1, 1, size=(1, width, height, 3)).astype(np.float32)
+        pnet_total.append(time_call(backend.pnet, img, repeats))
+    results.append(("pnet pyramid %dx%d" % frame_size,
+                    sum(t[0] for t in pnet_total), sum(t[1] for t in pnet_total)))
+
+    for batch_size in batch_sizes:
+        for stage, fn, size in (("rnet", backend.rnet, 24), ("onet", backend.onet, 48),
+                                ("embed", backend.embed, 160)):
+            batch = rng.uniform(-1, 1, size=(batch_size, size, size, 3)).astype(np.float32)
+            median, p95 = time_call(fn, batch, repeats)
+            results.append(("%s batch=%d" % (stage, batch_size), median, p95))
+    return results
+
+
+def main(args):
+    settings = Settings.from_env()
+    for name in args.backends:
+        backend = create_backend(dataclasses.replace(settings, inference_backend=name))
+        try:
+            print("== %s" % name)
+            for stage, median, p95 in run(backend, tuple(args.frame_size), args.batch_sizes, args.repeats):
+                print("%-24s median %8.2f ms   p95 %8.2f ms" % (stage, median, p95))
+        finally:
+            backend.close()
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--frame_size', type=int, nargs=2, default=[480, 640],
+        help='Height and width of the frame used for the PNet pyramid.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 3, 16])
+    parser.add_argument('--repeats', type=int, default=20)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
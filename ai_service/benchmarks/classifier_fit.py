@@ -0,0 +1,119 @@
+"""Fit time and accuracy of the classifier training backends against class count.
+
+Synthetic mode draws identities as random unit centres in 512-d with noisy
+normalized samples around them (``--train_per_class`` to fit, ``--test_per_class``
+to score). With ``--data_dir`` the processed dataset is embedded once with the
+service's inference backend (``FACE_INFERENCE_BACKEND``) and split per class.
+A backend is skipped at larger class counts once one fit took longer than
+``--max_fit_seconds``.
+
+    PYTHONPATH=src:src/face_recognition_process python benchmarks/classifier_fit.py --classes 100 1000 10000 100000
+    PYTHONPATH=src:src/face_recognition_process python benchmarks/classifier_fit.py --data_dir Dataset/FaceData/processed
+"""
+import argparse
+import sys
+import time
+import warnings
+
+import numpy as np
+
+import classifier_backends
+import facenet
+
+
+def synthetic(nrof_classes, train_per_class, test_per_class, dim, noise, seed=0):
+    rng = np.random.RandomState(seed)
+    centres = rng.normal(size=(nrof_classes, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+
+    def draw(per_class):
+        labels = np.repeat(np.arange(nrof_classes), per_class)
+        x = centres[labels] + (noise / np.sqrt(dim)) * rng.normal(size=(len(labels), dim)).astype(np.float32)
+        return x / np.linalg.norm(x, axis=1, keepdims=True), labels
+
+    return draw(train_per_class) + draw(test_per_class)
+
+
+def embed_dataset(data_dir, train_per_class, batch_size):
+    from serving.backends import create_backend
+    from serving.settings import Settings
+
+    dataset = [cls for cls in facenet.get_dataset(data_dir) if len(cls.image_paths) > 1]
+    paths, labels = facenet.get_image_paths_and_labels(dataset)
+    backend = create_backend(Settings.from_env())
+    embeddings = np.concatenate([backend.embed(facenet.load_data(paths[i:i + batch_size], False, False, 160))
+                                 for i in range(0, len(paths), batch_size)])
+    labels = np.asarray(labels)
+    rank = np.zeros(len(labels), dtype=int)
+    for label in range(len(dataset)):
+        members = np.flatnonzero(labels == label)
+        rank[members] = np.arange(len(members))
+    # At least one test image per class, up to train_per_class training images
+    nrof_images = np.bincount(labels)[labels]
+    train = rank < np.minimum(train_per_class, nrof_images - 1)
+    test = rank >= np.minimum(train_per_class, nrof_images - 1)
+    return embeddings[train], labels[train], embeddings[test], labels[test]
+
+
+def evaluate(backend, x_train, y_train, x_test, y_test, batch_size=4096):
+    start = time.perf_counter()
+    model = classifier_backends.train(backend, x_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    correct, confidence = 0, []
+    start = time.perf_counter()
+    for i in range(0, len(x_test), batch_size):
+        probabilities = model.predict_proba(x_test[i:i + batch_size])
+        best = probabilities.argmax(axis=1)
+        correct += np.sum(best == y_test[i:i + batch_size])
+        confidence.append(probabilities[np.arange(len(best)), best])
+    predict_ms = (time.perf_counter() - start) * 1000.0 / len(x_test)
+    return fit_seconds, correct / float(len(x_test)), float(np.median(np.concatenate(confidence))), predict_ms
+
+
+def report(label, backend, result):
+    fit_seconds, accuracy, confidence, predict_ms = result
+    print("%-16s %-11s fit %9.2f s  accuracy %.4f  median top-1 probability %.3f  %.3f ms/face"
+          % (label, backend, fit_seconds, accuracy, confidence, predict_ms))
+    sys.stdout.flush()
+
+
+def main(args):
+    warnings.simplefilter('ignore', FutureWarning)
+    if args.data_dir:
+        x_train, y_train, x_test, y_test = embed_dataset(args.data_dir, args.train_per_class, args.batch_size)
+        label = "%d classes" % (y_train.max() + 1)
+        for backend in args.backends:
+            report(label, backend, evaluate(backend, x_train, y_train, x_test, y_test))
+        return
+
+    too_slow = set()
+    for nrof_classes in args.classes:
+        data = synthetic(nrof_classes, args.train_per_class, args.test_per_class, args.dim, args.noise)
+        for backend in args.backends:
+            if backend in too_slow:
+                print("%-16s %-11s skipped (slower than %d s at fewer classes)"
+                      % ("%d classes" % nrof_classes, backend, args.max_fit_seconds))
+                continue
+            result = evaluate(backend, *data)
+            report("%d classes" % nrof_classes, backend, result)
+            if result[0] > args.max_fit_seconds:
+                too_slow.add(backend)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', choices=classifier_backends.BACKENDS,
+                        default=list(classifier_backends.BACKENDS))
+    parser.add_argument('--classes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--train_per_class', type=int, default=5)
+    parser.add_argument('--test_per_class', type=int, default=2)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--noise', type=float, default=2.0, help='Norm of the noise around each identity centre.')
+    parser.add_argument('--max_fit_seconds', type=float, default=300.0)
+    parser.add_argument('--data_dir', type=str, help='Processed (aligned) dataset to embed instead of synthetic data.')
+    parser.add_argument('--batch_size', type=int, default=100)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""Cold-start cost of the embedding gallery.
+
+Fills a database with synthetic templates, then times the streaming load into
+one matrix, writing the snapshot and memory-mapping it on the next start.
+
+    PYTHONPATH=src python benchmarks/gallery_load.py --size 1000000 --dtype float16
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import insert
+
+from serving.gallery import EMBEDDING_DTYPES, load_gallery
+from serving.storage import FaceData, create_db_engine, create_session_factory, init_db
+
+
+def populate(engine, size, dim, dtype, model_version, chunk_size=20000):
+    rng = np.random.RandomState(0)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        for offset in range(0, size, chunk_size):
+            n = min(chunk_size, size - offset)
+            embeddings = rng.normal(size=(n, dim)).astype(EMBEDDING_DTYPES[dtype])
+            connection.execute(insert(FaceData), [
+                {"id": "%036d" % (offset + i), "name": "student %d" % (offset + i),
+                 "registered_at": start + timedelta(seconds=offset + i),
+                 "embedding": embeddings[i].tobytes(), "embedding_dtype": dtype, "model_version": model_version}
+                for i in range(n)])
+
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    url = args.database_url or 'sqlite:///' + os.path.join(work_dir, 'faces.db')
+    snapshot = os.path.join(work_dir, 'gallery')
+    engine = create_db_engine(url)
+    init_db(engine)
+    SessionLocal = create_session_factory(engine)
+
+    start = time.perf_counter()
+    populate(engine, args.size, args.dim, args.dtype, args.model_version)
+    print("populate %d templates: %.1f s" % (args.size, time.perf_counter() - start))
+
+    for label in ("database + snapshot write", "memory-mapped snapshot"):
+        start = time.perf_counter()
+        with SessionLocal() as db:
+            gallery = load_gallery(db, args.model_version, snapshot)
+        # Touch every row so the memory-mapped case is not measured lazily
+        norms = np.linalg.norm(gallery.embeddings, axis=1)
+        print("%-26s %8.2f s  (%d x %d, %.0f MB)" % (label, time.perf_counter() - start, len(gallery),
+                                                     gallery.dim, gallery.embeddings.nbytes / 2 ** 20))
+        del norms
+    engine.dispose()
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=200000, help='Number of templates.')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--dtype', choices=sorted(EMBEDDING_DTYPES), default='float32')
+    parser.add_argument('--model_version', default='20180402-114759')
+    parser.add_argument('--database_url', help='Defaults to a SQLite file in --work_dir.')
+    parser.add_argument('--work_dir', help='Defaults to a new temporary directory.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
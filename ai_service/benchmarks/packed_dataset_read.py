@@ -0,0 +1,79 @@
+"""Batch loading from PNG files versus the packed, memory-mapped dataset.
+
+Writes a synthetic aligned tree (``--classes`` x ``--per_class`` random
+``--image_size`` PNGs) unless ``--data_dir`` is given, packs it, and times
+``load_data`` for sequential and random batches from both.
+
+    PYTHONPATH=src:src/face_recognition_process python benchmarks/packed_dataset_read.py --classes 200 --per_class 20
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import imageio
+import numpy as np
+
+import facenet
+import packed_dataset
+
+
+def synthetic_tree(root, nrof_classes, per_class, image_size):
+    rng = np.random.RandomState(0)
+    for c in range(nrof_classes):
+        class_dir = os.path.join(root, 'person_%05d' % c)
+        os.makedirs(class_dir)
+        for i in range(per_class):
+            imageio.imwrite(os.path.join(class_dir, '%04d.png' % i),
+                            rng.randint(0, 255, size=(image_size, image_size, 3), dtype=np.uint8))
+
+
+def time_batches(label, paths, batch_size, nrof_batches, image_size, rng):
+    for order in ('sequential', 'random'):
+        start = time.perf_counter()
+        for b in range(nrof_batches):
+            if order == 'random':
+                batch = [paths[i] for i in rng.randint(len(paths), size=batch_size)]
+            else:
+                batch = paths[b * batch_size % len(paths):][:batch_size]
+            packed_dataset.load_data(batch, False, False, image_size)
+        elapsed = time.perf_counter() - start
+        print('%-7s %-10s %8.0f images/s' % (label, order, nrof_batches * batch_size / elapsed))
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_dir = args.data_dir
+        if not data_dir:
+            data_dir = os.path.join(work_dir, 'processed')
+            synthetic_tree(data_dir, args.classes, args.per_class, args.image_size)
+        packed = os.path.join(work_dir, 'processed.packed')
+        start = time.perf_counter()
+        added, _ = packed_dataset.pack(data_dir, packed)
+        print('pack %d images: %.1f s' % (added, time.perf_counter() - start))
+
+        files, _ = facenet.get_image_paths_and_labels(facenet.get_dataset(data_dir))
+        refs, _ = facenet.get_image_paths_and_labels(packed_dataset.get_dataset(packed))
+        rng = np.random.RandomState(1)
+        time_batches('png', files, args.batch_size, args.batches, args.image_size, rng)
+        time_batches('packed', refs, args.batch_size, args.batches, args.image_size, rng)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='', help='Aligned dataset to use instead of synthetic images.')
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--per_class', type=int, default=20)
+    parser.add_argument('--image_size', type=int, default=160)
+    parser.add_argument('--batch_size', type=int, default=90)
+    parser.add_argument('--batches', type=int, default=20)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,109 @@
+"""End-to-end latency and throughput of the recognition pipeline per thread profile.
+
+Each profile runs in a fresh process (thread pools are sized once per process):
+the backend is created with the profile's session options, then ``--concurrency``
+client threads push ``--requests`` frames through MTCNN, the OpenCV crop/resize,
+FaceNet and a BLAS matmul against a random gallery, like /recognition does.
+Prints p50/p95/p99 request latency and requests per second.
+
+    PYTHONPATH=src python benchmarks/thread_budget.py --profiles default latency throughput --concurrency 1 8
+"""
+import argparse
+import dataclasses
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from serving.backends import BACKENDS
+from serving.threads import THREAD_PROFILES, ThreadBudget, available_cpus
+
+FACE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DataSet', 'FaceData', 'raw',
+                          'tungnt', 'tungnt_1.jpg')
+
+
+def recognize(backend, frame, gallery, image_size=160):
+    import align.detect_face
+    import cv2
+    from face_recognition_process import facenet
+
+    bounding_boxes, _ = align.detect_face.detect_face(
+        frame, 20, backend.pnet, backend.rnet, backend.onet, [0.6, 0.7, 0.7], 0.709)
+    faces = []
+    for box in bounding_boxes[:, 0:4].astype(np.int32):
+        x1, y1 = max(box[0], 0), max(box[1], 0)
+        x2, y2 = min(box[2], frame.shape[1]), min(box[3], frame.shape[0])
+        cropped = cv2.resize(frame[y1:y2, x1:x2], (image_size, image_size), interpolation=cv2.INTER_CUBIC)
+        faces.append(facenet.prewhiten(cropped))
+    if not faces:
+        return 0
+    embeddings = backend.embed(np.stack(faces))
+    np.argmax(embeddings @ gallery.T, axis=1)
+    return len(faces)
+
+
+def run_profile(profile, backend_name, concurrency, nrof_requests, gallery_size, image_path):
+    """Runs in a spawned process; returns (latencies in ms, wall time in s, faces per frame)"""
+    import cv2
+    from serving.backends import create_backend
+    from serving.settings import Settings
+    from serving.threads import apply_process_limits
+
+    budget = ThreadBudget.profile(profile)
+    settings = dataclasses.replace(Settings.from_env(), inference_backend=backend_name, thread_budget=budget)
+    apply_process_limits(budget)
+    backend = create_backend(settings)
+    try:
+        frame = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+        gallery = np.random.RandomState(0).normal(size=(gallery_size, 512)).astype(np.float32)
+        nrof_faces = recognize(backend, frame, gallery)
+        for _ in range(2):
+            recognize(backend, frame, gallery)
+
+        def timed_request(_):
+            start = time.perf_counter()
+            recognize(backend, frame, gallery)
+            return (time.perf_counter() - start) * 1000.0
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed_request, range(nrof_requests)))
+        return latencies, time.perf_counter() - start, nrof_faces
+    finally:
+        backend.close()
+
+
+def main(args):
+    ctx = multiprocessing.get_context('spawn')
+    print("%d cpus, backend %s" % (available_cpus(), args.backend))
+    for concurrency in args.concurrency:
+        print("== concurrency %d" % concurrency)
+        for profile in args.profiles:
+            budget = ThreadBudget.profile(profile)
+            with ctx.Pool(1) as pool:
+                latencies, wall, nrof_faces = pool.apply(run_profile, (profile, args.backend, concurrency,
+                                                                      args.requests, args.gallery_size, args.image))
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print("%-10s intra=%-2d inter=%-2d  p50 %8.1f ms  p95 %8.1f ms  p99 %8.1f ms  %7.2f req/s  (%d faces)" % (
+                profile, budget.intra_op_threads, budget.inter_op_threads, p50, p95, p99,
+                len(latencies) / wall, nrof_faces))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', nargs='+', choices=THREAD_PROFILES, default=list(THREAD_PROFILES))
+    parser.add_argument('--backend', choices=BACKENDS, default='tensorflow')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8],
+        help='Number of concurrent client threads.')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--gallery_size', type=int, default=10000,
+        help='Rows of the random gallery matched against each embedding.')
+    parser.add_argument('--image', type=str, default=FACE_IMAGE)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -29,10 +29,12 @@ from __future__ import print_function
 from six import string_types, iteritems
 
 import numpy as np
-import tensorflow as tf
 import cv2
 import os
 
+# TensorFlow is imported by the network code only; detect_face runs on any
+# backend's pnet/rnet/onet without it
+
 def layer(op):
     """Decorator for composable network layers."""
 
@@ -81,6 +83,7 @@ class Network(object):
         session: The current TensorFlow session
         ignore_missing: If true, serialized weights for missing layers are ignored.
         """
+        import tensorflow as tf
         data_dict = np.load(data_path, encoding='latin1',allow_pickle=True).item() #pylint: disable=no-member
 
         for op_name in data_dict:
@@ -121,6 +124,7 @@ class Network(object):
 
     def make_var(self, name, shape):
         """Creates a new TensorFlow variable."""
+        import tensorflow as tf
         return tf.compat.v1.get_variable(name, shape, trainable=self.trainable)
 
     def validate_padding(self, padding):
@@ -140,6 +144,7 @@ class Network(object):
              padding='SAME',
              group=1,
              biased=True):
+        import tensorflow as tf
         # Verify that the padding is acceptable
         self.validate_padding(padding)
         # Get the number of channels in the input
@@ -164,6 +169,7 @@ class Network(object):
 
     @layer
     def prelu(self, inp, name):
+        import tensorflow as tf
         with tf.compat.v1.variable_scope(name):
             i = int(inp.get_shape()[-1])
             alpha = self.make_var('alpha', shape=(i,))
@@ -172,6 +178,7 @@ class Network(object):
 
     @layer
     def max_pool(self, inp, k_h, k_w, s_h, s_w, name, padding='SAME'):
+        import tensorflow as tf
         self.validate_padding(padding)
         return tf.nn.max_pool(inp,
                               ksize=[1, k_h, k_w, 1],
@@ -181,6 +188,7 @@ class Network(object):
 
     @layer
     def fc(self, inp, num_out, name, relu=True):
+        import tensorflow as tf
         with tf.compat.v1.variable_scope(name):
             input_shape = inp.get_shape()
             if input_shape.ndims == 4:
@@ -206,6 +214,7 @@ class Network(object):
     """
     @layer
     def softmax(self, target, axis, name=None):
+        import tensorflow as tf
         max_axis = tf.reduce_max(target, axis, keepdims=True)
         target_exp = tf.exp(target-max_axis)
         normalize = tf.reduce_sum(target_exp, axis, keepdims=True)
@@ -273,6 +282,7 @@ class ONet(Network):
              .fc(10, relu=False, name='conv6-3'))
 
 def create_mtcnn(sess, model_path):
+    import tensorflow as tf
     if not model_path:
         model_path,_ = os.path.split(os.path.realpath(__file__))
 
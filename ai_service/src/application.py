@@ -1,78 +1,90 @@
+import functools
+import glob
 import os
 import shutil
-import sys
 import uuid
-import subprocess
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List, Optional
-from sklearn.svm import SVC
-import pickle
-import tensorflow as tf
-# Disable eager execution for TensorFlow 2.x compatibility
-tf.compat.v1.disable_eager_execution()
 import numpy as np
 import cv2
 import align.detect_face
-from face_recognition_process import facenet
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Query, Path
-from fastapi.responses import JSONResponse
+from face_recognition_process import alignment_manifest, classifier_artifact, classifier_backends, facenet
+from fastapi import APIRouter, FastAPI, File, UploadFile, Form, HTTPException, Depends, Query, Path, Request
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, String, DateTime, Float
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import logging
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-
-# Configure logging
-logging.basicConfig(
-    filename="face_service.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+from serving import metrics
+from serving.metrics import time_stage
+from serving.settings import Settings
+from serving.storage import FaceData, FaceSample, RosterEntry, create_db_engine, create_session_factory, init_db
+from serving.alignment import AlignmentEngine, find_cascade, load_cascade
+from serving.ann import build_index
+from serving.artifacts import ArtifactStore, CachedArtifact
+from serving.backends import create_backend
+from serving.calibration import load_accept_distance
+from serving.gallery import decode_embedding, encode_embedding, load_gallery
+from serving.logs import FACE_LOGGER, configure_logging, stop_logging
+from serving.maintenance import Maintenance
+from serving.registration import ArtifactWriter, RegistrationPipeline, template_of
+from serving.threads import apply_process_limits
+from serving.tracing import TraceSampler, end_trace, start_trace
+from serving.warmup import warmup
+
+# Handlers and levels are configured on startup (serving/logs.py)
 logger = logging.getLogger("face_recognition_service")
+# Per-face detail lines, DEBUG and sampled
+face_logger = logging.getLogger(FACE_LOGGER)
 
-# Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./face_recognition.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# Define the FaceData model for database
-class FaceData(Base):
-    __tablename__ = "faces"
-
-    id = Column(String, primary_key=True, index=True)
-    name = Column(String, index=True)
-    registered_at = Column(DateTime, default=datetime.now)
-    embedding = Column(String)  # Store the face embedding as a serialized string
-
-
-# Create the database tables
-Base.metadata.create_all(bind=engine)
-
-# Set up paths and constants
-# Get the actual project base directory
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-logger.info(f"Base directory: {BASE_DIR}")
+# Set up paths and constants. Nothing here touches the filesystem or loads a
+# model: tables, directories and the TF graphs are created in the app lifespan.
+settings = Settings.from_env()
+BASE_DIR = settings.base_dir
 
 # Define paths based on project structure
-RAW_DATASET_DIR = os.path.join(BASE_DIR, "Dataset", "FaceData", "raw")
-PROCESSED_DATASET_DIR = os.path.join(BASE_DIR, "Dataset", "FaceData", "processed")
-MODEL_DIR = os.path.join(BASE_DIR, "Models")
-CLASSIFIER_PATH = os.path.join(MODEL_DIR, "facemodel.pkl")
-FACENET_MODEL_PATH = os.path.join(MODEL_DIR, "20180402-114759.pb")
-
-# Log all path information for debugging
-logger.info(f"Raw dataset directory: {RAW_DATASET_DIR}")
-logger.info(f"Processed dataset directory: {PROCESSED_DATASET_DIR}")
-logger.info(f"Model directory: {MODEL_DIR}")
-logger.info(f"Classifier path: {CLASSIFIER_PATH}")
-logger.info(f"FaceNet model path: {FACENET_MODEL_PATH}")
-
-# Ensure directories exist
-os.makedirs(RAW_DATASET_DIR, exist_ok=True)
-os.makedirs(PROCESSED_DATASET_DIR, exist_ok=True)
-os.makedirs(MODEL_DIR, exist_ok=True)
+RAW_DATASET_DIR = settings.raw_dataset_dir
+PROCESSED_DATASET_DIR = settings.processed_dataset_dir
+MODEL_DIR = settings.model_dir
+CLASSIFIER_PATH = settings.classifier_path
+FACENET_MODEL_PATH = settings.facenet_model_path
+
+# Database setup: a pooled engine only connects on first use
+SQLALCHEMY_DATABASE_URL = settings.database_url
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL, pool_size=settings.db_pool_size,
+                          max_overflow=settings.db_max_overflow, pool_timeout=settings.db_pool_timeout,
+                          pool_recycle=settings.db_pool_recycle, schema=settings.db_schema)
+SessionLocal = create_session_factory(engine)
+
+# Trained classifiers are published as immutable, memory-mapped artifacts (classifier_artifact.py);
+# a pickled facemodel.pkl is only read until the first version is published
+classifier_store = ArtifactStore(settings.classifier_store_dir, "facemodel", classifier_artifact.SUFFIX,
+                                 keep=settings.classifier_versions_kept, legacy_path=CLASSIFIER_PATH)
+load_classifier = classifier_artifact.load_classifier
+
+# Recognition reloads the classifier only when a new version has been published
+classifier_cache = CachedArtifact(classifier_store, load_classifier)
+
+
+def init_storage(settings=settings):
+    """Create the database tables and the dataset/model directories"""
+    # Log all path information for debugging
+    logger.info("Base directory: %s", settings.base_dir)
+    logger.info("Raw dataset directory: %s", settings.raw_dataset_dir)
+    logger.info("Processed dataset directory: %s", settings.processed_dataset_dir)
+    logger.info("Model directory: %s", settings.model_dir)
+    logger.info("Classifier path: %s", settings.classifier_path)
+    logger.info("FaceNet model path: %s", settings.facenet_model_path)
+
+    # Create the database tables
+    init_db(engine, settings.db_schema)
+
+    # Ensure directories exist
+    os.makedirs(settings.raw_dataset_dir, exist_ok=True)
+    os.makedirs(settings.processed_dataset_dir, exist_ok=True)
+    os.makedirs(settings.model_dir, exist_ok=True)
 
 
 # Pydantic models for API requests/responses
@@ -101,641 +113,588 @@ class FaceListResponse(BaseModel):
     registered_at: datetime
 
 
+class RosterRequest(BaseModel):
+    face_ids: List[str]
+    tenant_id: Optional[str] = None
+
+
 class FaceRecognitionService:
-    def __init__(self):
-        self.graph = tf.Graph()
-        self.sess = None
+    # MTCNN parameters - same as original GitHub project
+    MINSIZE = 20
+    THRESHOLD = [0.6, 0.7, 0.7]
+    FACTOR = 0.709
+    INPUT_IMAGE_SIZE = 160
+
+    def __init__(self, settings=settings):
+        self.settings = settings
+        self.backend = None
         self.pnet = None
         self.rnet = None
         self.onet = None
-        self.embeddings = None
-        self.images_placeholder = None
-        self.phase_train_placeholder = None
+        self.aligner = None
+        self.registration = None
+        # Embeddings of aligned crop files by path: (mtime, embedding)
+        self._crop_embeddings = {}
 
         self.init_face_recognition()
 
     def init_face_recognition(self):
         """Initialize the face recognition model"""
-        logger.info("Initializing face recognition model")
-        with self.graph.as_default():
-            self.sess = tf.compat.v1.Session()
-
-            # Load MTCNN
-            # Fix path handling for cross-platform compatibility
-            align_path = os.path.join(BASE_DIR, "src", "align")
-            if not os.path.exists(os.path.join(align_path, "det1.npy")):
-                logger.error(f"MTCNN model files not found in {align_path}")
-                raise FileNotFoundError(f"MTCNN model files not found in {align_path}")
-            self.pnet, self.rnet, self.onet = align.detect_face.create_mtcnn(self.sess, align_path)
-
-            # Load FaceNet model
-            facenet.load_model(FACENET_MODEL_PATH)
-
-            # Get input and output tensors
-            self.images_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
-            self.embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
-            self.phase_train_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+        logger.info("Initializing face recognition model with the %s backend", self.settings.inference_backend)
+        if self.settings.use_optimized_graph and \
+                self.settings.embedding_model_path != self.settings.facenet_optimized_model_path:
+            logger.warning("Optimized graph not found at %s, falling back to %s",
+                           self.settings.facenet_optimized_model_path, self.settings.facenet_model_path)
+
+        try:
+            self.backend = create_backend(self.settings)
+        except FileNotFoundError as e:
+            logger.error(str(e))
+            raise
+        self.pnet = metrics.timed("pnet", self.backend.pnet)
+        self.rnet = metrics.timed("rnet", self.backend.rnet)
+        self.onet = metrics.timed("onet", self.backend.onet)
+        metrics.MODEL_INFO.labels(self.backend.name, self.backend.embedding_model).set(1)
+        # Fallback detectors are loaded once here, not per image
+        self.aligner = AlignmentEngine(
+            self.detect, self.INPUT_IMAGE_SIZE, margin=44,
+            cascade=load_cascade(self.settings.haar_cascade_path or find_cascade(self.settings.base_dir)),
+            fallback_max_side=self.settings.align_fallback_max_side)
+        self.registration = RegistrationPipeline(self.aligner, self.embed)
+
+    def close(self):
+        """Release the inference backend"""
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
+    def detect(self, img):
+        """Run MTCNN on an image and return (bounding_boxes, points)"""
+        with time_stage("detect"):
+            return align.detect_face.detect_face(
+                img, self.MINSIZE, self.pnet, self.rnet, self.onet, self.THRESHOLD, self.FACTOR
+            )
 
+    def embed(self, images):
+        """Compute FaceNet embeddings for a batch of prewhitened (N, 160, 160, 3) images"""
+        with time_stage("embed"):
+            return self.backend.embed(images)
+
+    @metrics.ALIGN_LATENCY.time()
     def align_faces(self, person_name):
         """
-        Align faces using the original GitHub code approach.
-        This produces the same results as the original project.
+        Align a person's raw images into the processed dataset, the way align_dataset_mtcnn.py does.
+        Registration no longer needs this (serving/registration.py); it realigns retained images.
         """
-        logger.info(f"Aligning faces for {person_name}")
+        logger.info("Aligning faces for %s", person_name)
 
-        input_dir = os.path.join(RAW_DATASET_DIR, person_name)
-        output_dir = PROCESSED_DATASET_DIR
+        input_dir = os.path.join(self.settings.raw_dataset_dir, person_name)
+        output_dir = self.settings.processed_dataset_dir
 
         if not os.path.exists(input_dir):
-            logger.error(f"Input directory does not exist: {input_dir}")
+            logger.error("Input directory does not exist: %s", input_dir)
             return False
 
         os.makedirs(output_dir, exist_ok=True)
 
-        # Import necessary modules that the original code uses
-        import random
         from PIL import Image
-        import math
-
-        # MTCNN parameters - same as original code
-        minsize = 20
-        threshold = [0.6, 0.7, 0.7]
-        factor = 0.709
-        image_size = 160
-        margin = 44
-
-        with self.graph.as_default():
-            with self.sess.as_default():
-                logger.info("Running MTCNN face detection")
-
-                # Get the dataset for this person
-                dataset = []
-                dataset.append(facenet.ImageClass(person_name, [p for p in os.listdir(input_dir)
-                                                                if os.path.isfile(os.path.join(input_dir, p))]))
-
-                # Create output directory
-                person_output_dir = os.path.join(output_dir, person_name)
-                os.makedirs(person_output_dir, exist_ok=True)
-
-                # Process each class (just one in this case)
-                nrof_images_total = 0
-                nrof_successfully_aligned = 0
-
-                for cls in dataset:
-                    output_class_dir = os.path.join(output_dir, cls.name)
-                    if not os.path.exists(output_class_dir):
-                        os.makedirs(output_class_dir)
-
-                    # Process each image
-                    for image_path in cls.image_paths:
-                        full_image_path = os.path.join(input_dir, image_path)
-                        nrof_images_total += 1
-
-                        filename = os.path.splitext(os.path.basename(image_path))[0]
-                        output_filename = os.path.join(output_class_dir, filename + '.png')
-
-                        logger.info(f"Processing {full_image_path}")
-
-                        if not os.path.exists(output_filename):
-                            try:
-                                # Read the image
-                                img = cv2.imread(full_image_path)
-                                if img is None:
-                                    logger.error(f"Could not read {full_image_path}")
-                                    continue
-
-                                # Convert BGR to RGB for MTCNN
-                                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                                # Detect faces
-                                logger.info(f"Detecting faces in {image_path}")
-                                bounding_boxes, _ = align.detect_face.detect_face(
-                                    img_rgb, minsize, self.pnet, self.rnet, self.onet, threshold, factor
-                                )
-
-                                logger.info(f"Detected {bounding_boxes.shape[0]} faces in {image_path}")
-
-                                # If faces detected, process them
-                                if bounding_boxes.shape[0] > 0:
-                                    # Use bounding box for largest face
-                                    det_areas = (bounding_boxes[:, 2] - bounding_boxes[:, 0]) * (
-                                                bounding_boxes[:, 3] - bounding_boxes[:, 1])
-                                    sorted_idx = np.argsort(det_areas)[::-1]  # Sort by area, largest first
-                                    det = bounding_boxes[sorted_idx[0], 0:4]
-
-                                    # Calculate the bounding box
-                                    bb = np.zeros(4, dtype=np.int32)
-                                    bb[0] = np.maximum(det[0] - margin / 2, 0)
-                                    bb[1] = np.maximum(det[1] - margin / 2, 0)
-                                    bb[2] = np.minimum(det[2] + margin / 2, img.shape[1])
-                                    bb[3] = np.minimum(det[3] + margin / 2, img.shape[0])
-
-                                    # Crop and align the face
-                                    cropped = img[bb[1]:bb[3], bb[0]:bb[2], :]
-
-                                    # Convert to PIL and resize
-                                    cropped_pil = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB))
-                                    scaled = cropped_pil.resize((image_size, image_size), Image.BICUBIC)
-
-                                    # Save the image
-                                    scaled.save(output_filename, format="PNG")
-                                    logger.info(f"Saved aligned face to {output_filename}")
-                                    nrof_successfully_aligned += 1
-                                else:
-                                    # If no face detected, try using Haar cascade as fallback
-                                    try:
-                                        # Load Haar cascade
-                                        cascade_path = os.path.join(cv2.__path__[0], 'data',
-                                                                    'haarcascade_frontalface_default.xml')
-                                        if not os.path.exists(cascade_path):
-                                            cascade_path = os.path.join(BASE_DIR, "src",
-                                                                        "haarcascade_frontalface_default.xml")
-
-                                        if os.path.exists(cascade_path):
-                                            face_cascade = cv2.CascadeClassifier(cascade_path)
-                                            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                                            faces = face_cascade.detectMultiScale(gray, 1.1, 5)
-
-                                            if len(faces) > 0:
-                                                # Use the largest detected face
-                                                if len(faces) > 1:
-                                                    face_areas = [(w * h, (x, y, w, h)) for (x, y, w, h) in faces]
-                                                    face_areas.sort(reverse=True)
-                                                    _, largest_face = face_areas[0]
-                                                    x, y, w, h = largest_face
-                                                else:
-                                                    x, y, w, h = faces[0]
-
-                                                # Add margin (40%)
-                                                margin_percent = 0.4
-                                                center_x = x + w / 2
-                                                center_y = y + h / 2
-
-                                                # Calculate new size with margin
-                                                new_size = max(w, h) * (1 + margin_percent)
-
-                                                # Calculate bounding box
-                                                bb = np.zeros(4, dtype=np.int32)
-                                                bb[0] = max(0, int(center_x - new_size / 2))
-                                                bb[1] = max(0, int(center_y - new_size / 2))
-                                                bb[2] = min(img.shape[1], int(center_x + new_size / 2))
-                                                bb[3] = min(img.shape[0], int(center_y + new_size / 2))
-
-                                                # Crop and align the face
-                                                cropped = img[bb[1]:bb[3], bb[0]:bb[2], :]
-
-                                                # Convert to PIL and resize
-                                                cropped_pil = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB))
-                                                scaled = cropped_pil.resize((image_size, image_size), Image.BICUBIC)
-
-                                                # Save the image
-                                                scaled.save(output_filename, format="PNG")
-                                                logger.info(
-                                                    f"Saved face detected with Haar cascade to {output_filename}")
-                                                nrof_successfully_aligned += 1
-                                                continue
-                                    except Exception as e:
-                                        logger.error(f"Haar cascade failed: {str(e)}")
-
-                                    # If all detection fails, use center crop
-                                    logger.warning(f"No face detected in {image_path}, using center crop")
-                                    height, width = img.shape[:2]
-                                    center_x = width // 2
-                                    center_y = height // 2
-
-                                    # If portrait, shift up
-                                    if height > width:
-                                        center_y = int(height * 0.4)
-
-                                    crop_size = min(width, height)
-                                    bb = np.zeros(4, dtype=np.int32)
-                                    bb[0] = max(0, center_x - crop_size // 2)
-                                    bb[1] = max(0, center_y - crop_size // 2)
-                                    bb[2] = min(width, center_x + crop_size // 2)
-                                    bb[3] = min(height, center_y + crop_size // 2)
-
-                                    # Crop and resize
-                                    cropped = img[bb[1]:bb[3], bb[0]:bb[2], :]
-                                    cropped_pil = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB))
-                                    scaled = cropped_pil.resize((image_size, image_size), Image.BICUBIC)
-
-                                    # Save the image
-                                    scaled.save(output_filename, format="PNG")
-                                    logger.info(f"Saved center-cropped image to {output_filename}")
-                                    nrof_successfully_aligned += 1
-                            except Exception as e:
-                                logger.error(f"Error processing {image_path}: {str(e)}")
-                                import traceback
-                                logger.error(traceback.format_exc())
-
-                logger.info(f"Total images: {nrof_images_total}, Successfully aligned: {nrof_successfully_aligned}")
-                return nrof_successfully_aligned > 0
 
-    def train_classifier(self):
-        """Train the SVM classifier on the processed dataset using the same parameters as the GitHub project"""
-        logger.info("Training SVM classifier")
+        logger.info("Running MTCNN face detection")
 
-        # Get the correct path to the classifier.py script
-        classifier_script_path = os.path.join(BASE_DIR, "src/face_recognition_process", "classifier.py")
-        logger.info(f"Classifier script path: {classifier_script_path}")
+        # Get the dataset for this person
+        dataset = []
+        dataset.append(facenet.ImageClass(person_name, [p for p in os.listdir(input_dir)
+                                                        if os.path.isfile(os.path.join(input_dir, p))]))
 
-        if not os.path.exists(classifier_script_path):
-            logger.error(f"Classifier script not found at: {classifier_script_path}")
-            return False
+        # Create output directory
+        person_output_dir = os.path.join(output_dir, person_name)
+        os.makedirs(person_output_dir, exist_ok=True)
 
-        # Check if the processed dataset is not empty
-        if not os.path.exists(PROCESSED_DATASET_DIR):
-            logger.error(f"Processed dataset directory not found: {PROCESSED_DATASET_DIR}")
-            return False
+        # Process each class (just one in this case)
+        nrof_images_total = 0
+        nrof_successfully_aligned = 0
+        nrof_unchanged = 0
+        strategies = {}
 
-        # Count classes and images
-        class_count = 0
-        image_count = 0
-        for class_name in os.listdir(PROCESSED_DATASET_DIR):
-            class_dir = os.path.join(PROCESSED_DATASET_DIR, class_name)
-            if os.path.isdir(class_dir):
-                class_count += 1
-                for f in os.listdir(class_dir):
-                    if f.lower().endswith(('.jpg', '.jpeg', '.png')):
-                        image_count += 1
-
-        logger.info(f"Found {class_count} classes with {image_count} images in processed dataset")
-
-        if class_count == 0 or image_count == 0:
-            logger.error("No classes or images found in processed dataset")
-            return False
+        # Images aligned before with the same parameters and unchanged content are skipped
+        manifest = alignment_manifest.AlignmentManifest(
+            output_dir, params={"image_size": self.INPUT_IMAGE_SIZE, "margin": 44})
+        try:
+            for cls in dataset:
+                output_class_dir = os.path.join(output_dir, cls.name)
+                if not os.path.exists(output_class_dir):
+                    os.makedirs(output_class_dir)
+
+                # Process each image
+                for image_path in cls.image_paths:
+                    full_image_path = os.path.join(input_dir, image_path)
+                    nrof_images_total += 1
+
+                    filename = os.path.splitext(os.path.basename(image_path))[0]
+                    output_filename = os.path.join(output_class_dir, filename + '.png')
+                    source = f"{cls.name}/{image_path}"
+
+                    face_logger.debug("Processing %s", full_image_path)
+
+                    try:
+                        stat = os.stat(full_image_path)
+                        current, entry = manifest.check(source, full_image_path, stat)
+                        if current:
+                            nrof_unchanged += 1
+                            continue
+                        with open(full_image_path, 'rb') as f:
+                            data = f.read()
+                        digest = alignment_manifest.file_digest(data=data)
+                        if manifest.unchanged_content(entry, digest):
+                            manifest.refresh(entry, stat)
+                            nrof_unchanged += 1
+                            continue
+
+                        # Read the image
+                        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                        if img is None:
+                            logger.error("Could not read %s", full_image_path)
+                            continue
+
+                        # MTCNN, else the Haar cascade on a downscaled copy, else a center crop
+                        face = self.aligner.align(img)
+                        Image.fromarray(face.image).save(output_filename, format="PNG")
+                        manifest.record(source, full_image_path, [output_filename], [face.bbox], face.strategy,
+                                        digest=digest, stat=stat, previous=entry)
+                        face_logger.debug("Saved %s crop %s of %s to %s", face.strategy, face.bbox, image_path,
+                                          output_filename)
+                        strategies[face.strategy] = strategies.get(face.strategy, 0) + 1
+                        nrof_successfully_aligned += 1
+                    except Exception as e:
+                        logger.exception("Error processing %s: %s", image_path, e)
+        finally:
+            manifest.close()
+
+        logger.info("Total images: %d, Successfully aligned: %d (by strategy: %s), unchanged: %d",
+                    nrof_images_total, nrof_successfully_aligned, strategies, nrof_unchanged)
+        return nrof_successfully_aligned + nrof_unchanged > 0
 
-        # Try to use the original classifier.py script via subprocess
+    def train_classifier(self):
+        """
+        Retrain the classifier and publish it as a new version. Trainers are serialized
+        by the store's writer lock; recognition keeps using the previous version meanwhile.
+        """
+        with classifier_store.lock:
+            start = time.perf_counter()
+            with classifier_store.staging_path() as output_path:
+                trained = self._train_classifier(output_path)
+                if trained:
+                    classifier_store.publish_file(output_path)
+        metrics.RETRAIN_LATENCY.labels("success" if trained else "failure").observe(time.perf_counter() - start)
+        if trained:
+            metrics.CLASSIFIER_VERSION.set(os.path.getmtime(classifier_store.current_path()))
+        return trained
+
+    def _train_classifier(self, output_path):
+        """Train the classifier (``self.settings.classifier_backend``) in process on the training set"""
+        logger.info("Training %s classifier", self.settings.classifier_backend)
         try:
-            # Use the original classifier.py script via subprocess
-            cmd = [
-                sys.executable,  # Use the current Python interpreter
-                classifier_script_path,
-                "TRAIN",
-                PROCESSED_DATASET_DIR,
-                FACENET_MODEL_PATH,
-                CLASSIFIER_PATH,
-                "--batch_size", "1000"
-            ]
-
-            logger.info(f"Running classifier training command: {' '.join(cmd)}")
-
-            # Run the subprocess and capture output
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = process.communicate()
-
-            # Log the output
-            if stdout:
-                logger.info(f"Classifier training stdout: {stdout}")
-            if stderr:
-                if "error" in stderr.lower() or "exception" in stderr.lower():
-                    logger.error(f"Classifier training stderr: {stderr}")
+            emb_array, labels, class_names = self.training_set()
+            if not class_names:
+                logger.error("No registered faces to train the classifier on")
+                return False
+            logger.info("Training on %d embeddings of %d classes", len(labels), len(class_names))
+            model = classifier_backends.train(self.settings.classifier_backend, emb_array, labels)
+            classifier_artifact.save_model(output_path, model, class_names)
+            logger.info("Successfully trained classifier with %d classes: %s", len(class_names), class_names)
+            return True
+        except Exception as e:
+            logger.exception("Classifier training failed with exception: %s", e)
+            return False
+
+    def training_set(self):
+        """
+        (embeddings, labels, class_names) of everyone registered: the stored per-image
+        samples of live registrations, plus the aligned crops in the processed dataset
+        that have no samples (registrations made before samples were stored, or with
+        another embedding model), embedded here. Live registrations with neither are
+        left out of training and logged: they have to register again.
+        """
+        vectors, names = [], []
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(FaceData.id, FaceData.name, FaceData.deleted_at, FaceSample.embedding,
+                       FaceSample.embedding_dtype)
+                .outerjoin(FaceSample, (FaceSample.face_id == FaceData.id) &
+                           (FaceSample.model_version == self.settings.embedding_model_version))
+                .order_by(FaceData.id, FaceSample.position))
+            # Crops of these registrations are not embedded: they have samples or are deleted
+            covered = set()
+            # Live registrations without samples of the serving embedding model
+            uncovered = set()
+            for face_id, name, deleted_at, blob, dtype in rows:
+                if deleted_at is not None:
+                    covered.add(face_id)
+                elif blob is not None:
+                    covered.add(face_id)
+                    vectors.append(decode_embedding(blob, dtype))
+                    names.append(name)
                 else:
-                    logger.info(f"Classifier training stderr: {stderr}")
+                    uncovered.add(face_id)
+
+        processed_dir = self.settings.processed_dataset_dir
+        if os.path.isdir(processed_dir):
+            for cls in facenet.get_dataset(processed_dir):
+                # Crops are named <face_id>_<n>.png
+                paths = sorted(p for p in cls.image_paths
+                               if os.path.basename(p).rsplit("_", 1)[0] not in covered)
+                if paths:
+                    vectors.extend(self.embed_crops(paths))
+                    names.extend([cls.name] * len(paths))
+                    uncovered.difference_update(os.path.basename(p).rsplit("_", 1)[0] for p in paths)
+        if uncovered:
+            logger.warning("%d registrations have no %s samples and no aligned crops and are left out of training; "
+                           "they have to register again", len(uncovered), self.settings.embedding_model_version,
+                           extra={"face_ids": sorted(uncovered)[:100]})
+
+        classes = sorted(set(names))
+        index = {name: label for label, name in enumerate(classes)}
+        labels = [index[name] for name in names]
+        emb_array = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        return emb_array, labels, [name.replace('_', ' ') for name in classes]
+
+    def embed_crops(self, paths, batch_size=100):
+        """Embeddings of aligned crop files; unchanged files are embedded only once per process"""
+        cache = {}
+        missing = []
+        for path in paths:
+            mtime = os.path.getmtime(path)
+            cached = self._crop_embeddings.get(path)
+            if cached is not None and cached[0] == mtime:
+                cache[path] = cached
+            else:
+                missing.append((path, mtime))
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            images = facenet.load_data([path for path, _ in batch], False, False, self.INPUT_IMAGE_SIZE)
+            for (path, mtime), embedding in zip(batch, self.embed(images)):
+                cache[path] = (mtime, embedding)
+        self._crop_embeddings.update(cache)
+        return [cache[path][1] for path in paths]
+
+    def match_gallery(self, gallery, emb_array, candidates=None):
+        """Nearest template in the gallery (or ``candidates``): (face_id, name, L2 distance), or Nones if empty"""
+        ids, similarities = gallery.search(emb_array, k=1, candidates=candidates)
+        if not ids[0]:
+            return None, None, float("inf")
+        distance = float(np.sqrt(max(0.0, 2.0 - 2.0 * float(similarities[0][0]))))
+        return ids[0][0], gallery.name_of(ids[0][0]), distance
+
+    def detect_faces(self, image_path, gallery=None, candidates=None):
+        """
+        Detect faces in an image and return the face data.
 
-            if process.returncode != 0:
-                logger.error(f"Classifier training process exited with code {process.returncode}")
-                return False
+        ``candidates`` restricts matching to these face ids (the roster of an assessment).
+        """
+        logger.debug("Detecting faces in %s", image_path)
 
-            # Verify the classifier was created
-            if not os.path.exists(CLASSIFIER_PATH):
-                logger.error(f"Classifier file not created: {CLASSIFIER_PATH}")
-                return False
+        INPUT_IMAGE_SIZE = self.INPUT_IMAGE_SIZE
+        use_gallery = self.settings.matcher == "gallery"
 
-            # Try to load the classifier to verify it's valid
+        if use_gallery:
+            if gallery is None:
+                return {"error": "Embedding gallery not loaded"}
+            model = class_names = None
+        # Load classifier model (cached until a new version is published)
+        else:
             try:
-                with open(CLASSIFIER_PATH, 'rb') as file:
-                    model, class_names = pickle.load(file)
-                logger.info(f"Successfully trained classifier with {len(class_names)} classes: {class_names}")
-                return True
+                with time_stage("classifier_load"):
+                    classifier_path, classifier = classifier_cache.get()
             except Exception as e:
-                logger.error(f"Failed to load the trained classifier: {str(e)}")
-                return False
-
+                logger.error("Error loading classifier: %s", e)
+                return {"error": f"Failed to load classifier: {str(e)}"}
+            # Check if classifier exists
+            if classifier is None:
+                logger.error("Classifier not found in %s", classifier_store.directory)
+                return {"error": "Classifier model not found", "path": classifier_store.directory}
+            model, class_names = classifier
+            metrics.GALLERY_SIZE.set(len(class_names))
+            metrics.CLASSIFIER_VERSION.set(os.path.getmtime(classifier_path))
+            logger.debug("Classifier loaded with %d classes", len(class_names))
+            if candidates is not None:
+                # Only the probabilities of classes with a rostered candidate can win
+                roster_names = {gallery.name_of(face_id) for face_id in candidates if face_id in gallery} \
+                    if gallery is not None else set()
+                allowed = np.array([name in roster_names for name in class_names])
+
+        # Load and preprocess image
+        if not os.path.exists(image_path):
+            logger.error("Image not found at path: %s", image_path)
+            return {"error": "Image file not found"}
+
+        with time_stage("decode"):
+            frame = cv2.imread(image_path)
+        if frame is None:
+            logger.error("Failed to read image from %s", image_path)
+            return {"error": "Failed to read image"}
+
+        logger.debug("Image loaded, shape: %s", frame.shape)
+
+        # Don't resize - process at original resolution for better accuracy
+        # This matches the approach in the original GitHub project
+
+        # Detect faces using MTCNN, on RGB like registration (AlignmentEngine.align)
+        try:
+            bounding_boxes, _ = self.detect(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            logger.debug("MTCNN detected %d faces", bounding_boxes.shape[0])
+            metrics.FACES_DETECTED.inc(bounding_boxes.shape[0])
         except Exception as e:
-            logger.error(f"Classifier training failed with exception: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error("Face detection error: %s", e)
+            return {"error": f"Face detection failed: {str(e)}"}
 
-            # If the subprocess approach fails, try direct training as fallback
-            logger.warning("Subprocess training failed, attempting direct training...")
+        faces_data = []
 
-            try:
-                # Get dataset
-                dataset = facenet.get_dataset(PROCESSED_DATASET_DIR)
-
-                # Check that there's at least one image per class
-                for cls in dataset:
-                    if len(cls.image_paths) == 0:
-                        logger.error(f"No images for class {cls.name}")
-                        return False
-
-                logger.info(f"Training on dataset with {len(dataset)} classes")
-
-                # Extract features using FaceNet
-                with self.graph.as_default():
-                    with self.sess.as_default():
-                        # Get input and output tensors
-                        images_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
-                        embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
-                        phase_train_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
-
-                        # Get image paths and labels
-                        paths, labels = facenet.get_image_paths_and_labels(dataset)
-
-                        logger.info(f"Found {len(paths)} images and {len(set(labels))} unique labels")
-
-                        # Calculate embeddings
-                        batch_size = 100
-                        nrof_images = len(paths)
-                        nrof_batches_per_epoch = int(np.ceil(1.0 * nrof_images / batch_size))
-                        emb_array = np.zeros((nrof_images, embeddings.get_shape()[1]))
-
-                        for i in range(nrof_batches_per_epoch):
-                            start_index = i * batch_size
-                            end_index = min((i + 1) * batch_size, nrof_images)
-                            paths_batch = paths[start_index:end_index]
-                            images = facenet.load_data(paths_batch, False, False, 160)
-                            feed_dict = {images_placeholder: images, phase_train_placeholder: False}
-                            emb_array[start_index:end_index, :] = self.sess.run(embeddings, feed_dict=feed_dict)
-
-                        # Train classifier
-                        logger.info("Training SVM classifier")
-                        model = SVC(kernel='linear', probability=True)
-                        model.fit(emb_array, labels)
-
-                        # Create a list of class names
-                        class_names = [cls.name.replace('_', ' ') for cls in dataset]
-
-                        # Save classifier model
-                        with open(CLASSIFIER_PATH, 'wb') as outfile:
-                            pickle.dump((model, class_names), outfile)
-
-                        logger.info(f"Saved classifier to {CLASSIFIER_PATH}")
-                        return True
-
-            except Exception as e2:
-                logger.error(f"Direct training also failed: {str(e2)}")
-                import traceback
-                logger.error(traceback.format_exc())
-                return False
-            
-    def detect_faces(self, image_path):
-        """Detect faces in an image and return the face data"""
-        logger.info(f"Detecting faces in {image_path}")
-
-        MINSIZE = 20
-        THRESHOLD = [0.6, 0.7, 0.7]  # Same thresholds as original GitHub project
-        FACTOR = 0.709
-        INPUT_IMAGE_SIZE = 160
-
-        with self.graph.as_default():
-            with self.sess.as_default():
-                # Check if classifier exists
-                if not os.path.exists(CLASSIFIER_PATH):
-                    logger.error(f"Classifier not found at path: {CLASSIFIER_PATH}")
-                    return {"error": "Classifier model not found", "path": CLASSIFIER_PATH}
-
-                # Load classifier model
+        if bounding_boxes.shape[0] > 0:
+            for i in range(bounding_boxes.shape[0]):
                 try:
-                    with open(CLASSIFIER_PATH, 'rb') as file:
-                        model, class_names = pickle.load(file)
-                    logger.info(f"Classifier loaded successfully with {len(class_names)} classes: {class_names}")
-                except Exception as e:
-                    logger.error(f"Error loading classifier: {str(e)}")
-                    return {"error": f"Failed to load classifier: {str(e)}"}
+                    det = bounding_boxes[i, 0:4]
+                    bb = np.zeros(4, dtype=np.int32)
+                    bb[0] = max(det[0], 0)
+                    bb[1] = max(det[1], 0)
+                    bb[2] = min(det[2], frame.shape[1])
+                    bb[3] = min(det[3], frame.shape[0])
+
+                    if bb[2] <= bb[0] or bb[3] <= bb[1]:
+                        face_logger.warning("Invalid bounding box: %s", bb)
+                        metrics.FACES_REJECTED.labels("invalid_bbox").inc()
+                        continue
+
+                    face_logger.debug("Processing face %d, bounding box: %s", i + 1, bb)
+
+                    with time_stage("align"):
+                        # Extract and process face using same method as original project
+                        margin = 44  # Same as in align_faces
+                        bb_margin = np.zeros(4, dtype=np.int32)
+                        bb_margin[0] = np.maximum(det[0] - margin / 2, 0)
+                        bb_margin[1] = np.maximum(det[1] - margin / 2, 0)
+                        bb_margin[2] = np.minimum(det[2] + margin / 2, frame.shape[1])
+                        bb_margin[3] = np.minimum(det[3] + margin / 2, frame.shape[0])
+
+                        # Same RGB crop and prewhitening as the registration samples and templates,
+                        # which the classifier and the calibrated threshold were built from
+                        scaled_prewhite = facenet.prewhiten(self.aligner.crop(frame, bb_margin))
+
+                        scaled_reshape = scaled_prewhite.reshape(-1, INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE, 3)
+
+                    # Get face embedding
+                    emb_array = self.embed(scaled_reshape)
+
+                    if use_gallery:
+                        with time_stage("classify"):
+                            face_id, best_name, distance = self.match_gallery(gallery, emb_array, candidates)
+                        face_logger.debug("Face %d nearest template '%s' at distance %.4f", i + 1, best_name, distance)
+                        faces_data.append({
+                            "id": face_id,
+                            "name": best_name,
+                            "distance": distance,
+                            # Cosine similarity of the normalized embeddings, in [0, 1] for a plausible match
+                            "confidence": max(0.0, 1.0 - distance ** 2 / 2.0) if face_id is not None else 0.0,
+                            "bbox": bb.tolist()
+                        })
+                        continue
+
+                    # Predict identity
+                    with time_stage("classify"):
+                        predictions = model.predict_proba(emb_array)
+                        if candidates is not None:
+                            if not allowed.any():
+                                metrics.FACES_REJECTED.labels("unregistered").inc()
+                                continue
+                            predictions = np.where(allowed, predictions, -1.0)
+                        best_class_indices = np.argmax(predictions, axis=1)
+                        best_class_probabilities = predictions[
+                            np.arange(len(best_class_indices)), best_class_indices]
 
-                # Load and preprocess image
-                if not os.path.exists(image_path):
-                    logger.error(f"Image not found at path: {image_path}")
-                    return {"error": "Image file not found"}
+                    best_name = class_names[best_class_indices[0]]
+                    best_prob = float(best_class_probabilities[0])
 
-                frame = cv2.imread(image_path)
-                if frame is None:
-                    logger.error(f"Failed to read image from {image_path}")
-                    return {"error": "Failed to read image"}
+                    face_logger.debug("Face %d recognized as '%s' with confidence %.4f", i + 1, best_name, best_prob)
 
-                logger.info(f"Image loaded, shape: {frame.shape}")
+                    face_data = {
+                        "name": best_name,
+                        "confidence": best_prob,
+                        "bbox": bb.tolist()
+                    }
+                    if gallery is not None and gallery.ids_of(best_name):
+                        # Distance to the person's nearest template, for the calibrated acceptance threshold
+                        person_ids = gallery.ids_of(best_name)
+                        if candidates is not None:
+                            person_ids = person_ids & set(candidates)
+                        with time_stage("classify"):
+                            face_data["id"], _, face_data["distance"] = self.match_gallery(
+                                gallery, emb_array, person_ids)
+                    faces_data.append(face_data)
+                except Exception as e:
+                    metrics.FACES_REJECTED.labels("error").inc()
+                    face_logger.exception("Error processing face %d: %s", i + 1, e)
+        else:
+            logger.info("No faces detected in the image")
 
-                # Don't resize - process at original resolution for better accuracy
-                # This matches the approach in the original GitHub project
+        return faces_data
 
-                # Detect faces using MTCNN
-                try:
-                    logger.info("Running MTCNN face detection")
-                    bounding_boxes, _ = align.detect_face.detect_face(
-                        frame, MINSIZE, self.pnet, self.rnet, self.onet, THRESHOLD, FACTOR
-                    )
-                    logger.info(f"MTCNN detected {bounding_boxes.shape[0]} faces")
-                except Exception as e:
-                    logger.error(f"Face detection error: {str(e)}")
-                    return {"error": f"Face detection failed: {str(e)}"}
-
-                faces_data = []
-
-                if bounding_boxes.shape[0] > 0:
-                    for i in range(bounding_boxes.shape[0]):
-                        try:
-                            det = bounding_boxes[i, 0:4]
-                            bb = np.zeros(4, dtype=np.int32)
-                            bb[0] = max(det[0], 0)
-                            bb[1] = max(det[1], 0)
-                            bb[2] = min(det[2], frame.shape[1])
-                            bb[3] = min(det[3], frame.shape[0])
-
-                            if bb[2] <= bb[0] or bb[3] <= bb[1]:
-                                logger.warning(f"Invalid bounding box: {bb}")
-                                continue
+router = APIRouter()
 
-                            logger.info(f"Processing face {i + 1}, bounding box: {bb}")
-
-                            # Extract and process face using same method as original project
-                            margin = 44  # Same as in align_faces
-                            bb_margin = np.zeros(4, dtype=np.int32)
-                            bb_margin[0] = np.maximum(det[0] - margin / 2, 0)
-                            bb_margin[1] = np.maximum(det[1] - margin / 2, 0)
-                            bb_margin[2] = np.minimum(det[2] + margin / 2, frame.shape[1])
-                            bb_margin[3] = np.minimum(det[3] + margin / 2, frame.shape[0])
-
-                            cropped = frame[bb_margin[1]:bb_margin[3], bb_margin[0]:bb_margin[2], :]
-
-                            # Use exact same resizing as in alignment
-                            from PIL import Image
-                            cropped_pil = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB))
-                            scaled = cropped_pil.resize((INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE), Image.BICUBIC)
-                            scaled_np = np.array(scaled)
-
-                            # Convert back to BGR for prewhiten
-                            scaled_bgr = cv2.cvtColor(scaled_np, cv2.COLOR_RGB2BGR)
-                            scaled_prewhite = facenet.prewhiten(scaled_bgr)
-
-                            scaled_reshape = scaled_prewhite.reshape(-1, INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE, 3)
-
-                            # Get face embedding
-                            feed_dict = {
-                                self.images_placeholder: scaled_reshape,
-                                self.phase_train_placeholder: False
-                            }
-                            emb_array = self.sess.run(self.embeddings, feed_dict=feed_dict)
-                            logger.info(f"Generated embedding vector of shape {emb_array.shape}")
-
-                            # Predict identity
-                            predictions = model.predict_proba(emb_array)
-                            best_class_indices = np.argmax(predictions, axis=1)
-                            best_class_probabilities = predictions[
-                                np.arange(len(best_class_indices)), best_class_indices]
-
-                            best_name = class_names[best_class_indices[0]]
-                            best_prob = float(best_class_probabilities[0])
-
-                            logger.info(f"Face {i + 1} recognized as '{best_name}' with confidence {best_prob:.4f}")
-
-                            face_data = {
-                                "name": best_name,
-                                "confidence": best_prob,
-                                "bbox": bb.tolist()
-                            }
-                            faces_data.append(face_data)
-                        except Exception as e:
-                            logger.error(f"Error processing face {i + 1}: {str(e)}")
-                            import traceback
-                            logger.error(traceback.format_exc())
-                else:
-                    logger.warning("No faces detected in the image")
+# Vietnamese messages of the registration rejection reasons (serving/registration.py)
+REJECTION_MESSAGES = {
+    "unreadable": "Không đọc được file ảnh",
+    "blurry": "Ảnh bị mờ",
+    "brightness": "Ảnh quá sáng hoặc quá tối",
+}
 
-                return faces_data
 
-# Create FastAPI app
-app = FastAPI(title="Face Recognition Service", version="1.0")
+def get_face_service(request: Request) -> FaceRecognitionService:
+    """Return the loaded service, or 503 while the models are still loading"""
+    face_service = getattr(request.app.state, "face_service", None)
+    if face_service is None or not request.app.state.ready:
+        raise HTTPException(status_code=503, detail="Face recognition models are not loaded yet")
+    return face_service
 
-# Add middleware for CORS
-from fastapi.middleware.cors import CORSMiddleware
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with specific origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def get_gallery(request: Request):
+    """In-memory embedding gallery loaded on startup"""
+    return request.app.state.gallery
 
-# Initialize face recognition service
-face_service = FaceRecognitionService()
 
-# Helper functions:
-def is_image_blurry(gray_img: np.ndarray, threshold: float = 100.0) -> bool:
-    """Trả về True nếu variance của Laplacian < threshold (tức là ảnh mờ)."""
-    return cv2.Laplacian(gray_img, cv2.CV_64F).var() < threshold
+def get_accept_distance(request: Request):
+    """Calibrated distance threshold for FACE_TARGET_FAR, or None without a threshold table"""
+    return request.app.state.accept_distance
 
-def is_image_bright_or_dark(gray_img: np.ndarray,
-                            min_brightness: float = 30,
-                            max_brightness: float = 220) -> bool:
-    """Trả về True nếu độ sáng trung bình < min hoặc > max."""
-    mean_b = float(np.mean(gray_img))
-    return mean_b < min_brightness or mean_b > max_brightness
+def get_artifact_writer(request: Request):
+    """Background writer of retained registration images"""
+    return request.app.state.artifact_writer
 
-@app.post("/register")
+@router.post("/register")
 async def register_face(
     name: str = Form(...),
-    images: List[UploadFile] = File(...)
+    images: List[UploadFile] = File(...),
+    tenant_id: Optional[str] = Form(None),
+    assessment_id: Optional[str] = Form(None),
+    face_service: FaceRecognitionService = Depends(get_face_service),
+    gallery=Depends(get_gallery),
+    artifact_writer: ArtifactWriter = Depends(get_artifact_writer)
 ):
     """
     Đăng ký một người mới với đúng 3 ảnh khuôn mặt.
 
     - name: Tên của người đăng ký
     - images: Danh sách đúng 3 file ảnh
+    - tenant_id: Tenant SAP (tùy chọn)
+    - assessment_id: Thêm người này vào danh sách thí sinh của bài thi (tùy chọn)
     """
-    logger.info(f"Đang đăng ký khuôn mặt mới: {name}")
+    logger.info("Đang đăng ký khuôn mặt mới: %s", name, extra={"face_name": name})
+    start = time.perf_counter()
 
     # 1) Bắt buộc phải đúng 3 ảnh
     if len(images) != 3:
         raise HTTPException(status_code=400, detail="Bạn phải tải lên đúng 3 ảnh.")
 
-    # Tạo ID và thư mục tạm
     face_id = str(uuid.uuid4())
-    person_dir = os.path.join(RAW_DATASET_DIR, name)
-    os.makedirs(person_dir, exist_ok=True)
-
-    valid_paths = []               # sẽ chứa các path ảnh đạt chuẩn
-    errors: dict[int, List[str]] = {}  # key=thứ tự ảnh, value=list lý do
-
-    # 2) Lưu tạm và validate từng ảnh
-    for idx, upload in enumerate(images, start=1):
-        img_path = os.path.join(person_dir, f"{face_id}_{idx}.jpg")
-        with open(img_path, "wb") as f:
-            shutil.copyfileobj(upload.file, f)
-
-        img = cv2.imread(img_path)
-        if img is None:
-            errors.setdefault(idx, []).append("Không đọc được file ảnh")
-            logger.warning(f"Ảnh thứ {idx} không hợp lệ: Không đọc được file")
-            continue
-
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-        # Kiểm tra mờ
-        if is_image_blurry(gray):
-            errors.setdefault(idx, []).append("Ảnh bị mờ")
-            logger.warning(f"Ảnh thứ {idx} không hợp lệ: Ảnh bị mờ")
+    # 2) Giải mã mỗi ảnh một lần và kiểm tra chất lượng trong bộ nhớ
+    with time_stage("upload"):
+        uploads = [await upload.read() for upload in images]
+    decoded, issues = face_service.registration.validate(uploads)
 
-        # Kiểm tra sáng/tối
-        if is_image_bright_or_dark(gray):
-            errors.setdefault(idx, []).append("Ảnh quá sáng hoặc quá tối")
-            logger.warning(f"Ảnh thứ {idx} không hợp lệ: Ảnh quá sáng/quá tối")
-
-        # Nếu không có lỗi, thêm vào valid_paths
-        if idx not in errors:
-            valid_paths.append(img_path)
+    errors: dict[int, List[str]] = {}  # key=thứ tự ảnh, value=list lý do
+    for idx, reasons in enumerate(issues, start=1):
+        for reason in reasons:
+            metrics.IMAGES_REJECTED.labels(reason).inc()
+            errors.setdefault(idx, []).append(REJECTION_MESSAGES[reason])
+            logger.warning("Ảnh thứ %d không hợp lệ: %s", idx, REJECTION_MESSAGES[reason], extra={"reason": reason})
 
     # 3) Nếu chưa đủ 3 ảnh hợp lệ, trả về lỗi chi tiết multiline
-    if len(valid_paths) < 3:
+    if errors:
         error_messages = ["Đăng ký thất bại: 400", "Các ảnh không hợp lệ:"]
         for idx, reasons in errors.items():
             for reason in reasons:
                 error_messages.append(f"Ảnh thứ {idx} không hợp lệ: {reason}")
 
+        metrics.REGISTRATION_LATENCY.labels("invalid_images").observe(time.perf_counter() - start)
         raise HTTPException(status_code=400, detail=error_messages)
 
-    logger.info(f"Đã lưu {len(valid_paths)} ảnh hợp lệ cho {name}")
-
-    # 4) Tiếp tục flow cũ: align → train → lưu DB
-    if not face_service.align_faces(name):
-        raise HTTPException(status_code=500, detail="Căn chỉnh khuôn mặt thất bại")
-    if not face_service.train_classifier():
-        raise HTTPException(status_code=500, detail="Huấn luyện bộ phân loại thất bại")
-
+    # 4) Căn chỉnh và trích xuất embedding trên ảnh trong bộ nhớ
+    with metrics.INFERENCE_QUEUE_DEPTH.track_inprogress():
+        try:
+            faces, embeddings = face_service.registration.embed_faces(decoded)
+        except Exception:
+            logger.exception("Căn chỉnh khuôn mặt thất bại cho %s", name)
+            metrics.REGISTRATION_LATENCY.labels("align_failed").observe(time.perf_counter() - start)
+            raise HTTPException(status_code=500, detail="Căn chỉnh khuôn mặt thất bại")
+    template = template_of(embeddings)
+    service_settings = face_service.settings
+
+    # 5) Lưu DB (embedding của từng ảnh là dữ liệu huấn luyện), rồi huấn luyện lại bộ phân loại
     db = SessionLocal()
     try:
         db_face = FaceData(
             id=face_id,
             name=name,
-            registered_at=datetime.now()
+            registered_at=datetime.now(),
+            tenant_id=tenant_id,
+            embedding=encode_embedding(template, service_settings.embedding_dtype),
+            embedding_dtype=service_settings.embedding_dtype,
+            model_version=service_settings.embedding_model_version,
         )
         db.add(db_face)
+        db.flush()
+        db.add_all([FaceSample(face_id=face_id, position=position,
+                               embedding=encode_embedding(embedding, service_settings.embedding_dtype),
+                               embedding_dtype=service_settings.embedding_dtype,
+                               model_version=service_settings.embedding_model_version)
+                    for position, embedding in enumerate(embeddings, start=1)])
+        if assessment_id:
+            db.add(RosterEntry(assessment_id=assessment_id, face_id=face_id, tenant_id=tenant_id))
         db.commit()
-        logger.info(f"Đã đăng ký thành công {name} với ID {face_id}")
+
+        with metrics.INFERENCE_QUEUE_DEPTH.track_inprogress():
+            trained = face_service.train_classifier()
+        if not trained:
+            # Registration is all or nothing: drop the identity again
+            db.delete(db_face)
+            db.commit()
+            metrics.REGISTRATION_LATENCY.labels("train_failed").observe(time.perf_counter() - start)
+            raise HTTPException(status_code=500, detail="Huấn luyện bộ phân loại thất bại")
+
+        gallery.add(face_id, name, template, tenant_id)
+        metrics.GALLERY_TEMPLATES.set(len(gallery))
+        if assessment_id:
+            gallery.add_to_roster(assessment_id, face_id)
+        logger.info("Đã đăng ký thành công %s với ID %s", name, face_id, extra={"face_id": face_id})
     finally:
         db.close()
 
+    # 6) Ảnh gốc và ảnh đã căn chỉnh chỉ được ghi (ở nền) khi cấu hình lưu giữ
+    artifact_writer.submit(name, face_id, uploads, faces)
+
+    metrics.REGISTRATION_LATENCY.labels("success").observe(time.perf_counter() - start)
     return JSONResponse(
         status_code=200,
         content={
             "status": "success",
-            "message": f"Đã đăng ký {name} với {len(valid_paths)} ảnh hợp lệ",
+            "message": f"Đã đăng ký {name} với {len(faces)} ảnh hợp lệ",
             "id": face_id
         }
     )
 
-@app.post("/recognition")
-async def recognize_face(image: UploadFile = File(...)):
+@router.post("/recognition")
+async def recognize_face(image: UploadFile = File(...),
+                         tenant_id: Optional[str] = Form(None),
+                         assessment_id: Optional[str] = Form(None),
+                         face_ids: Optional[List[str]] = Form(None),
+                         face_service: FaceRecognitionService = Depends(get_face_service),
+                         gallery=Depends(get_gallery),
+                         accept_distance: Optional[float] = Depends(get_accept_distance)):
     """
     Recognize faces in an uploaded image.
 
+    Matching can be restricted to a roster: the candidates of ``assessment_id``,
+    an explicit list of ``face_ids``, and/or the identities of ``tenant_id``.
+
     Returns:
     - id: The unique ID of the recognized person
     - name: The name of the recognized person
@@ -743,24 +702,28 @@ async def recognize_face(image: UploadFile = File(...)):
     - registered_at: When the person was registered
     """
     try:
-        logger.info("Processing recognition request")
-        logger.info(f"Uploaded image: {image.filename}, size: {image.size} bytes")
+        candidates = gallery.scope(tenant_id, assessment_id, face_ids) if gallery is not None else None
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Assessment {assessment_id} has no roster")
+
+    try:
+        logger.debug("Uploaded image: %s, size: %s bytes", image.filename, image.size)
 
         # Save uploaded image temporarily
-        temp_dir = os.path.join(BASE_DIR, "temp")
+        temp_dir = os.path.join(face_service.settings.base_dir, "temp")
         os.makedirs(temp_dir, exist_ok=True)
         temp_path = os.path.join(temp_dir, f"temp_recognition_{uuid.uuid4()}.jpg")
 
-        logger.info(f"Saving uploaded image to {temp_path}")
-        with open(temp_path, "wb") as f:
+        with time_stage("upload"), open(temp_path, "wb") as f:
             shutil.copyfileobj(image.file, f)
 
         # Detect faces
-        faces_data = face_service.detect_faces(temp_path)
+        with metrics.INFERENCE_QUEUE_DEPTH.track_inprogress():
+            faces_data = face_service.detect_faces(temp_path, gallery, candidates)
 
         # Check if faces_data is an error dictionary
         if isinstance(faces_data, dict) and "error" in faces_data:
-            logger.error(f"Face detection returned error: {faces_data}")
+            logger.error("Face detection returned error: %s", faces_data)
             return JSONResponse(
                 status_code=400,
                 content={"error": faces_data["error"], "details": faces_data}
@@ -772,7 +735,7 @@ async def recognize_face(image: UploadFile = File(...)):
 
         # If no faces found, return detailed message instead of empty array
         if not faces_data:
-            logger.warning("No faces found or recognized in the image")
+            logger.info("No faces found or recognized in the image")
             return JSONResponse(
                 status_code=200,
                 content={
@@ -792,20 +755,40 @@ async def recognize_face(image: UploadFile = File(...)):
             results = []
             for face in faces_data:
                 # Find the person in the database
-                db_face = db.query(FaceData).filter(FaceData.name == face["name"]).first()
-
-                logger.info(f"Found match: {face['name']} with confidence {face['confidence']}")
-                logger.info(f"Database record found: {db_face is not None}")
-
-                # Lowered threshold to 0.4 for testing
-                if db_face and face["confidence"] > 0.4:
+                with time_stage("db_lookup"):
+                    if "id" in face:
+                        db_face = db.get(FaceData, face["id"]) if face["id"] is not None else None
+                        if db_face is not None and db_face.deleted_at is not None:
+                            db_face = None
+                    else:
+                        query = db.query(FaceData).filter(FaceData.name == face["name"], FaceData.deleted_at.is_(None))
+                        if candidates is not None:
+                            query = query.filter(FaceData.id.in_(list(candidates)))
+                        db_face = query.first()
+
+                face_logger.debug("Best match %s (confidence %.4f), registered: %s",
+                                  face["name"], face["confidence"], db_face is not None)
+
+                if accept_distance is not None and "distance" in face:
+                    # Calibrated on the gallery for FACE_TARGET_FAR, accepts like facenet.calculate_val_far
+                    accepted = face["distance"] < accept_distance
+                elif face_service.settings.matcher == "gallery":
+                    accepted = face["distance"] <= face_service.settings.match_threshold
+                else:
+                    # Also for classifier matches without a template to measure the distance to
+                    # Lowered threshold to 0.4 for testing
+                    accepted = face["confidence"] > 0.4
+                if db_face and accepted:
                     results.append({
                         "id": db_face.id,
                         "name": db_face.name,
                         "confidence": face["confidence"],
                         "registered_at": db_face.registered_at.isoformat()
                     })
+                else:
+                    metrics.FACES_REJECTED.labels("low_confidence" if db_face else "unregistered").inc()
 
+            logger.info("Recognition: %d faces detected, %d matched", len(faces_data), len(results))
             if not results:
                 return JSONResponse(
                     status_code=200,
@@ -824,19 +807,30 @@ async def recognize_face(image: UploadFile = File(...)):
             db.close()
 
     except Exception as e:
-        logger.error(f"Recognition error: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception("Recognition error: %s", e)
         raise HTTPException(status_code=500, detail=f"Recognition failed: {str(e)}")
 
 
 
-@app.get("/health")
+@router.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "ok"}
 
-@app.get("/faces", response_model=List[FaceListResponse])
+@router.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@router.get("/ready")
+async def readiness_check(request: Request):
+    """Readiness endpoint: 200 only once the models are loaded and warmed up"""
+    if not request.app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "loading"})
+    return {"status": "ready", "warmup_ms": request.app.state.warmup_ms}
+
+@router.get("/faces", response_model=List[FaceListResponse])
 async def list_faces(db: Session = Depends(get_db)):
     """
     List all registered faces in the database.
@@ -848,7 +842,7 @@ async def list_faces(db: Session = Depends(get_db)):
         logger.info("Listing all registered faces")
         
         # Query all faces from the database
-        faces = db.query(FaceData).all()
+        faces = db.query(FaceData).filter(FaceData.deleted_at.is_(None)).all()
         
         # Convert to response model
         response = [
@@ -859,20 +853,54 @@ async def list_faces(db: Session = Depends(get_db)):
             ) for face in faces
         ]
         
-        logger.info(f"Returning {len(response)} registered faces")
+        logger.info("Returning %d registered faces", len(response))
         return response
         
     except Exception as e:
-        logger.error(f"Error listing faces: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception("Error listing faces: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to list faces: {str(e)}")
 
-@app.delete("/faces/{face_id}")
+@router.put("/assessments/{assessment_id}/roster")
+async def set_roster(roster: RosterRequest,
+                     assessment_id: str = Path(..., description="The assessment the candidates sit"),
+                     db: Session = Depends(get_db),
+                     gallery=Depends(get_gallery)):
+    """
+    Replace the candidates of an assessment. ``/recognition`` with this
+    ``assessment_id`` only matches against them.
+    """
+    face_ids = list(dict.fromkeys(roster.face_ids))
+    known = {face_id for (face_id,) in db.query(FaceData.id).filter(
+        FaceData.id.in_(face_ids), FaceData.deleted_at.is_(None))}
+    unknown = [face_id for face_id in face_ids if face_id not in known]
+    if unknown:
+        raise HTTPException(status_code=400, detail={"unknown_face_ids": unknown})
+    db.query(RosterEntry).filter(RosterEntry.assessment_id == assessment_id).delete()
+    db.add_all(RosterEntry(assessment_id=assessment_id, face_id=face_id, tenant_id=roster.tenant_id)
+               for face_id in face_ids)
+    db.commit()
+    gallery.set_roster(assessment_id, face_ids)
+    logger.info("Roster of assessment %s set to %d candidates", assessment_id, len(face_ids))
+    return {"assessment_id": assessment_id, "candidates": len(face_ids)}
+
+@router.get("/assessments/{assessment_id}/roster")
+async def get_roster(assessment_id: str = Path(..., description="The assessment the candidates sit"),
+                     gallery=Depends(get_gallery)):
+    """List the face ids on the roster of an assessment"""
+    if assessment_id not in gallery.rosters:
+        raise HTTPException(status_code=404, detail=f"Assessment {assessment_id} has no roster")
+    return {"assessment_id": assessment_id, "face_ids": sorted(gallery.rosters[assessment_id])}
+
+@router.delete("/faces/{face_id}")
 async def delete_face(face_id: str = Path(..., description="The ID of the face to delete"), 
-                      db: Session = Depends(get_db)):
+                      db: Session = Depends(get_db),
+                      gallery=Depends(get_gallery)):
     """
     Delete a registered face by ID.
+
+    The face is tombstoned and dropped from the gallery, so it is no longer
+    recognized from the next request on. Its images, the database row and the
+    classifier classes are cleaned up by background maintenance.
     
     Parameters:
     - face_id: The unique ID of the face to delete
@@ -881,55 +909,21 @@ async def delete_face(face_id: str = Path(..., description="The ID of the face t
     - Success message if deletion was successful
     """
     try:
-        logger.info(f"Deleting face with ID: {face_id}")
+        logger.info("Deleting face with ID: %s", face_id, extra={"face_id": face_id})
         
         # Get the face from the database
-        face = db.query(FaceData).filter(FaceData.id == face_id).first()
+        face = db.get(FaceData, face_id)
         
-        if not face:
-            logger.warning(f"Face with ID {face_id} not found in database")
+        if not face or face.deleted_at is not None:
+            logger.warning("Face with ID %s not found in database", face_id)
             raise HTTPException(status_code=404, detail=f"Face with ID {face_id} not found")
         
-        # Remember the person's name before deletion
-        person_name = face.name
-        logger.info(f"Found face: {person_name} with ID {face_id}")
-        
-        # Delete from database
-        db.delete(face)
+        face.deleted_at = datetime.now()
         db.commit()
-        logger.info(f"Deleted face record from database")
-        
-        # Check if there are any more faces for this person
-        remaining_faces = db.query(FaceData).filter(FaceData.name == person_name).count()
-        logger.info(f"Remaining faces for {person_name}: {remaining_faces}")
-        
-        # If no more faces for this person, delete their images from filesystem
-        if remaining_faces == 0:
-            # Delete from raw dataset
-            raw_person_dir = os.path.join(RAW_DATASET_DIR, person_name)
-            if os.path.exists(raw_person_dir):
-                shutil.rmtree(raw_person_dir)
-                logger.info(f"Deleted raw dataset directory for {person_name}")
-            
-            # Delete from processed dataset
-            processed_person_dir = os.path.join(PROCESSED_DATASET_DIR, person_name)
-            if os.path.exists(processed_person_dir):
-                shutil.rmtree(processed_person_dir)
-                logger.info(f"Deleted processed dataset directory for {person_name}")
-            
-            # Retrain the classifier if the person was deleted
-            if os.path.exists(CLASSIFIER_PATH):
-                try:
-                    # Only retrain if there are still other people in the dataset
-                    if len(os.listdir(PROCESSED_DATASET_DIR)) > 0:
-                        logger.info("Retraining classifier after deleting person")
-                        face_service.train_classifier()
-                    else:
-                        # If no people left, delete the classifier
-                        os.remove(CLASSIFIER_PATH)
-                        logger.info("Deleted classifier as no people remain in dataset")
-                except Exception as e:
-                    logger.error(f"Error retraining classifier: {str(e)}")
+        if gallery.remove(face_id):
+            metrics.GALLERY_TEMPLATES.set(len(gallery))
+        metrics.TOMBSTONES.inc()
+        logger.info("Tombstoned face %s with ID %s", face.name, face_id, extra={"face_id": face_id})
         
         return JSONResponse(
             status_code=200,
@@ -943,11 +937,191 @@ async def delete_face(face_id: str = Path(..., description="The ID of the face t
         raise  # Re-raise HTTP exceptions
         
     except Exception as e:
-        logger.error(f"Error deleting face: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception("Error deleting face: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to delete face: {str(e)}")
 
+
+def compact_classifier(face_service):
+    """Retrain the classifier without the people maintenance removed, or delete it if nobody is left"""
+    if classifier_store.current_path() is None:
+        return
+    try:
+        # Only retrain if there are still other people registered
+        with SessionLocal() as db:
+            remaining = db.execute(select(FaceData.id).where(FaceData.deleted_at.is_(None)).limit(1)).first()
+        processed_dir = face_service.settings.processed_dataset_dir
+        if remaining is not None or (os.path.isdir(processed_dir) and
+                                     any(entry.is_dir() for entry in os.scandir(processed_dir))):
+            logger.info("Retraining classifier after deleting people")
+            face_service.train_classifier()
+        else:
+            # If no people left, stop serving a classifier
+            classifier_store.unpublish()
+            logger.info("Deleted classifier as no people remain in dataset")
+    except Exception as e:
+        logger.exception("Error retraining classifier: %s", e)
+
+def backfill_templates(face_service, settings):
+    """
+    Store a template of the serving embedding model for live registrations that have none
+    (made before templates were stored, or under another model), embedding their aligned
+    crops ``<processed>/<name>/<face_id>_<n>.png`` once; the crops also become their samples.
+    Returns the number of registrations backfilled.
+    """
+    version = settings.embedding_model_version
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(FaceData.id, FaceData.name)
+            .where(FaceData.deleted_at.is_(None),
+                   FaceData.embedding.is_(None) | FaceData.model_version.is_(None) |
+                   (FaceData.model_version != version))
+            .order_by(FaceData.registered_at)).all()
+        backfilled, without_crops = 0, []
+        for face_id, name in rows:
+            pattern = os.path.join(settings.processed_dataset_dir, glob.escape(name), glob.escape(face_id) + "_*.png")
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                without_crops.append(face_id)
+                continue
+            try:
+                embeddings = face_service.embed_crops(paths)
+            except Exception as e:
+                logger.exception("Could not embed the crops of %s (%s): %s", name, face_id, e)
+                without_crops.append(face_id)
+                continue
+            face = db.get(FaceData, face_id)
+            face.embedding = encode_embedding(template_of(embeddings), settings.embedding_dtype)
+            face.embedding_dtype = settings.embedding_dtype
+            face.model_version = version
+            db.query(FaceSample).filter(FaceSample.face_id == face_id, FaceSample.model_version == version).delete()
+            db.add_all([FaceSample(face_id=face_id, position=position,
+                                   embedding=encode_embedding(embedding, settings.embedding_dtype),
+                                   embedding_dtype=settings.embedding_dtype, model_version=version)
+                        for position, embedding in enumerate(embeddings, start=1)])
+            db.commit()
+            backfilled += 1
+    if backfilled:
+        logger.info("Backfilled %s templates of %d registrations from their aligned crops", version, backfilled)
+    if without_crops:
+        logger.warning("%d registrations have no %s template and no aligned crops, they cannot be matched "
+                       "until registered again", len(without_crops), version,
+                       extra={"face_ids": without_crops[:100]})
+    return backfilled
+
+
+def create_app(settings: Settings = settings, service_factory=None) -> FastAPI:
+    """
+    Build the FastAPI application.
+
+    Importing this module is cheap; the database tables, dataset directories,
+    TF graphs and warmup pass all run in the lifespan handler so tooling and
+    ``uvicorn --reload`` only pay for them once the server actually starts.
+    """
+    if service_factory is None:
+        service_factory = FaceRecognitionService
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.ready = False
+        configure_logging(settings)
+        init_storage(settings)
+        apply_process_limits(settings.thread_budget)
+        face_service = service_factory(settings)
+        app.state.face_service = face_service
+        maintenance = Maintenance(SessionLocal, settings.raw_dataset_dir, settings.processed_dataset_dir,
+                                  compact=functools.partial(compact_classifier, face_service),
+                                  interval=settings.maintenance_interval)
+        app.state.maintenance = maintenance
+        backfill_templates(face_service, settings)
+        app.state.artifact_writer = ArtifactWriter(
+            settings.raw_dataset_dir, settings.processed_dataset_dir, settings.retain_images,
+            manifest_params={"image_size": FaceRecognitionService.INPUT_IMAGE_SIZE, "margin": 44}).start()
+        with SessionLocal() as db:
+            app.state.gallery = load_gallery(db, settings.embedding_model_version, settings.gallery_snapshot_path)
+            metrics.TOMBSTONES.set(maintenance.pending(db))
+        if settings.ann_index != "none":
+            app.state.gallery.enable_ann(functools.partial(
+                build_index, settings.ann_index, ivf_nlist=settings.ivf_nlist, ivf_nprobe=settings.ivf_nprobe,
+                hnsw_m=settings.hnsw_m, hnsw_ef_construction=settings.hnsw_ef_construction,
+                hnsw_ef_search=settings.hnsw_ef_search), settings.ann_min_size)
+        metrics.GALLERY_TEMPLATES.set(len(app.state.gallery))
+        app.state.accept_distance = load_accept_distance(settings.threshold_table_path, settings.target_far)
+        maintenance.start()
+        if settings.warmup_enabled:
+            timings = warmup(face_service, settings.warmup_batch_sizes,
+                             settings.warmup_frame_size, settings.warmup_iterations)
+            app.state.warmup_ms = {stage: round(seconds * 1000.0, 1) for stage, seconds in timings.items()}
+        app.state.ready = True
+        logger.info("Face recognition service ready")
+        try:
+            yield
+        finally:
+            app.state.ready = False
+            maintenance.stop()
+            app.state.artifact_writer.stop()
+            app.state.face_service = None
+            face_service.close()
+            engine.dispose()
+            stop_logging()
+
+    app = FastAPI(title="Face Recognition Service", version="1.0", lifespan=lifespan)
+    app.state.ready = False
+    app.state.face_service = None
+    app.state.gallery = None
+    app.state.maintenance = None
+    app.state.artifact_writer = None
+    app.state.accept_distance = None
+    app.state.warmup_ms = {}
+
+    trace_sampler = TraceSampler(settings.trace_log_path, settings.trace_sample_rate, settings.trace_slow_ms)
+    tracing_enabled = settings.server_timing or trace_sampler.enabled
+
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        start = time.perf_counter()
+        status = 500
+        trace = None
+        if tracing_enabled:
+            trace, token = start_trace(request.method, request.url.path, request.headers.get("x-request-id"))
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            if trace is not None:
+                trace.finish()
+                response.headers["X-Request-ID"] = trace.request_id
+                if settings.server_timing:
+                    response.headers["Server-Timing"] = trace.server_timing()
+            return response
+        finally:
+            if trace is not None:
+                end_trace(token)
+                if trace.duration is None:
+                    trace.finish()
+                if trace_sampler.enabled and trace_sampler.should_write(trace):
+                    trace_sampler.write(trace)
+            # Label by route template (/faces/{face_id}) to keep the series count bounded
+            route = request.scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            metrics.REQUEST_LATENCY.labels(request.method, path).observe(time.perf_counter() - start)
+            metrics.REQUESTS.labels(request.method, path, str(status)).inc()
+
+    # Add middleware for CORS
+    from fastapi.middleware.cors import CORSMiddleware
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # In production, replace with specific origins
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(router)
+    return app
+
+
+# Module-level app for `uvicorn src.application:app`; models load on startup
+app = create_app()
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -25,19 +25,23 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from scipy import misc
 import sys
 import os
 import argparse
+import multiprocessing
 import tensorflow as tf
 import numpy as np
 import facenet
+import alignment_manifest
 import align.detect_face
 import random
-from time import sleep
+import time
+
+minsize = 20 # minimum size of face
+threshold = [ 0.6, 0.7, 0.7 ]  # three steps's threshold
+factor = 0.709 # scale factor
 
 def main(args):
-    sleep(random.random())
     output_dir = os.path.expanduser(args.output_dir)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -45,100 +49,186 @@ def main(args):
     src_path,_ = os.path.split(os.path.realpath(__file__))
     facenet.store_revision_info(src_path, output_dir, ' '.join(sys.argv))
     dataset = facenet.get_dataset(args.input_dir)
-    
-    print('Creating networks and loading parameters')
-    
+
+    # Only images that are new, changed or were aligned with other parameters are aligned again
+    manifest = alignment_manifest.AlignmentManifest(output_dir, params={
+        'image_size': args.image_size, 'margin': args.margin, 'detect_multiple_faces': bool(args.detect_multiple_faces)})
+
+    if args.random_order:
+        random.shuffle(dataset)
+    tasks = []
+    nrof_unchanged = 0
+    for cls in dataset:
+        output_class_dir = os.path.join(output_dir, cls.name)
+        if not os.path.exists(output_class_dir):
+            os.makedirs(output_class_dir)
+            if args.random_order:
+                random.shuffle(cls.image_paths)
+        for image_path in cls.image_paths:
+            current, entry = manifest.check(source_key(args.input_dir, image_path), image_path)
+            if current:
+                nrof_unchanged += 1
+            else:
+                tasks.append((image_path, output_class_dir, entry['sha1'] if entry else None))
+    print('%d images unchanged since the last run, %d to align' % (nrof_unchanged, len(tasks)))
+
+    nrof_images_total = nrof_unchanged
+    nrof_successfully_aligned = 0
+    if not tasks:
+        results = []
+    elif args.workers > 1:
+        results = align_parallel(tasks, args)
+    else:
+        print('Creating networks and loading parameters')
+        pnet, rnet, onet = create_mtcnn()
+        results = (align_image(image_path, output_class_dir, pnet, rnet, onet, args, digest)
+                   for image_path, output_class_dir, digest in tasks)
+    results = report_progress(results, len(tasks), args.progress_interval)
+    with manifest:
+        for image_path, outputs, boxes, digest, status in results:
+            nrof_images_total += 1
+            nrof_successfully_aligned += len(outputs)
+            source = source_key(args.input_dir, image_path)
+            if status == 'unchanged':
+                manifest.refresh(manifest.entries[source], os.stat(image_path))
+            elif status != 'unreadable':
+                manifest.record(source, image_path, outputs, boxes, 'mtcnn' if outputs else 'none', digest,
+                                previous=manifest.entries.get(source))
+        manifest.write_bounding_boxes(os.path.join(output_dir, 'bounding_boxes.txt'))
+
+    print('Total number of images: %d' % nrof_images_total)
+    print('Number of successfully aligned images: %d' % nrof_successfully_aligned)
+
+
+def source_key(input_dir, image_path):
+    return os.path.relpath(image_path, input_dir).replace(os.sep, '/')
+
+
+def create_mtcnn(session_config=None):
     with tf.Graph().as_default():
         #gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=args.gpu_memory_fraction)
-        sess = tf.compat.v1.Session()#config=tf.ConfigProto())#gpu_options=gpu_options, log_device_placement=False))
+        sess = tf.compat.v1.Session(config=session_config)
         with sess.as_default():
-            pnet, rnet, onet = align.detect_face.create_mtcnn(sess, None)
-    
-    minsize = 20 # minimum size of face
-    threshold = [ 0.6, 0.7, 0.7 ]  # three steps's threshold
-    factor = 0.709 # scale factor
+            return align.detect_face.create_mtcnn(sess, None)
 
-    # Add a random key to the filename to allow alignment using multiple processes
-    random_key = np.random.randint(0, high=99999)
-    bounding_boxes_filename = os.path.join(output_dir, 'bounding_boxes_%05d.txt' % random_key)
-    
-    with open(bounding_boxes_filename, "w") as text_file:
-        nrof_images_total = 0
-        nrof_successfully_aligned = 0
-        if args.random_order:
-            random.shuffle(dataset)
-        for cls in dataset:
-            output_class_dir = os.path.join(output_dir, cls.name)
-            if not os.path.exists(output_class_dir):
-                os.makedirs(output_class_dir)
-                if args.random_order:
-                    random.shuffle(cls.image_paths)
-            for image_path in cls.image_paths:
-                nrof_images_total += 1
-                filename = os.path.splitext(os.path.split(image_path)[1])[0]
-                output_filename = os.path.join(output_class_dir, filename+'.png')
-                print(image_path)
-                if not os.path.exists(output_filename):
-                    try:
-                        import imageio
-                        img = imageio.imread(image_path)
-                    except (IOError, ValueError, IndexError) as e:
-                        errorMessage = '{}: {}'.format(image_path, e)
-                        print(errorMessage)
-                    else:
-                        if img.ndim<2:
-                            print('Unable to align "%s"' % image_path)
-                            text_file.write('%s\n' % (output_filename))
-                            continue
-                        if img.ndim == 2:
-                            img = facenet.to_rgb(img)
-                        img = img[:,:,0:3]
-    
-                        bounding_boxes, _ = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor)
-                        nrof_faces = bounding_boxes.shape[0]
-                        if nrof_faces>0:
-                            det = bounding_boxes[:,0:4]
-                            det_arr = []
-                            img_size = np.asarray(img.shape)[0:2]
-                            if nrof_faces>1:
-                                if args.detect_multiple_faces:
-                                    for i in range(nrof_faces):
-                                        det_arr.append(np.squeeze(det[i]))
-                                else:
-                                    bounding_box_size = (det[:,2]-det[:,0])*(det[:,3]-det[:,1])
-                                    img_center = img_size / 2
-                                    offsets = np.vstack([ (det[:,0]+det[:,2])/2-img_center[1], (det[:,1]+det[:,3])/2-img_center[0] ])
-                                    offset_dist_squared = np.sum(np.power(offsets,2.0),0)
-                                    index = np.argmax(bounding_box_size-offset_dist_squared*2.0) # some extra weight on the centering
-                                    det_arr.append(det[index,:])
-                            else:
-                                det_arr.append(np.squeeze(det))
-
-                            for i, det in enumerate(det_arr):
-                                det = np.squeeze(det)
-                                bb = np.zeros(4, dtype=np.int32)
-                                bb[0] = np.maximum(det[0]-args.margin/2, 0)
-                                bb[1] = np.maximum(det[1]-args.margin/2, 0)
-                                bb[2] = np.minimum(det[2]+args.margin/2, img_size[1])
-                                bb[3] = np.minimum(det[3]+args.margin/2, img_size[0])
-                                cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
-                                from PIL import Image
-                                cropped = Image.fromarray(cropped)
-                                scaled = cropped.resize((args.image_size, args.image_size), Image.BILINEAR)
-                                nrof_successfully_aligned += 1
-                                filename_base, file_extension = os.path.splitext(output_filename)
-                                if args.detect_multiple_faces:
-                                    output_filename_n = "{}_{}{}".format(filename_base, i, file_extension)
-                                else:
-                                    output_filename_n = "{}{}".format(filename_base, file_extension)
-                                imageio.imwrite(output_filename_n, scaled)
-                                text_file.write('%s %d %d %d %d\n' % (output_filename_n, bb[0], bb[1], bb[2], bb[3]))
-                        else:
-                            print('Unable to align "%s"' % image_path)
-                            text_file.write('%s\n' % (output_filename))
-                            
-    print('Total number of images: %d' % nrof_images_total)
-    print('Number of successfully aligned images: %d' % nrof_successfully_aligned)
+
+def align_image(image_path, output_class_dir, pnet, rnet, onet, args, known_digest=None):
+    """
+    Align one image; returns (image_path, output files, boxes, SHA-1 of the source, status) where
+    status is 'aligned', 'failed' (no face), 'unreadable' or 'unchanged' (content still has ``known_digest``)
+    """
+    filename = os.path.splitext(os.path.split(image_path)[1])[0]
+    output_filename = os.path.join(output_class_dir, filename+'.png')
+    try:
+        import imageio
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        digest = alignment_manifest.file_digest(data=data)
+        if digest == known_digest:
+            return image_path, [], [], digest, 'unchanged'
+        img = imageio.imread(data)
+    except (IOError, ValueError, IndexError) as e:
+        errorMessage = '{}: {}'.format(image_path, e)
+        print(errorMessage)
+        return image_path, [], [], None, 'unreadable'
+    if img.ndim<2:
+        print('Unable to align "%s"' % image_path)
+        return image_path, [], [], digest, 'failed'
+    if img.ndim == 2:
+        img = facenet.to_rgb(img)
+    img = img[:,:,0:3]
+
+    bounding_boxes, _ = align.detect_face.detect_face(img, minsize, pnet, rnet, onet, threshold, factor)
+    nrof_faces = bounding_boxes.shape[0]
+    if nrof_faces == 0:
+        print('Unable to align "%s"' % image_path)
+        return image_path, [], [], digest, 'failed'
+    det = bounding_boxes[:,0:4]
+    det_arr = []
+    img_size = np.asarray(img.shape)[0:2]
+    if nrof_faces>1:
+        if args.detect_multiple_faces:
+            for i in range(nrof_faces):
+                det_arr.append(np.squeeze(det[i]))
+        else:
+            bounding_box_size = (det[:,2]-det[:,0])*(det[:,3]-det[:,1])
+            img_center = img_size / 2
+            offsets = np.vstack([ (det[:,0]+det[:,2])/2-img_center[1], (det[:,1]+det[:,3])/2-img_center[0] ])
+            offset_dist_squared = np.sum(np.power(offsets,2.0),0)
+            index = np.argmax(bounding_box_size-offset_dist_squared*2.0) # some extra weight on the centering
+            det_arr.append(det[index,:])
+    else:
+        det_arr.append(np.squeeze(det))
+
+    outputs, boxes = [], []
+    for i, det in enumerate(det_arr):
+        det = np.squeeze(det)
+        bb = np.zeros(4, dtype=np.int32)
+        bb[0] = np.maximum(det[0]-args.margin/2, 0)
+        bb[1] = np.maximum(det[1]-args.margin/2, 0)
+        bb[2] = np.minimum(det[2]+args.margin/2, img_size[1])
+        bb[3] = np.minimum(det[3]+args.margin/2, img_size[0])
+        cropped = img[bb[1]:bb[3],bb[0]:bb[2],:]
+        from PIL import Image
+        cropped = Image.fromarray(cropped)
+        scaled = cropped.resize((args.image_size, args.image_size), Image.BILINEAR)
+        filename_base, file_extension = os.path.splitext(output_filename)
+        if args.detect_multiple_faces:
+            output_filename_n = "{}_{}{}".format(filename_base, i, file_extension)
+        else:
+            output_filename_n = "{}{}".format(filename_base, file_extension)
+        imageio.imwrite(output_filename_n, scaled)
+        outputs.append(output_filename_n)
+        boxes.append(bb.tolist())
+    return image_path, outputs, boxes, digest, 'aligned'
+
+
+# Per-process state of the --workers pool: each worker owns one MTCNN session
+_worker = {}
+
+def _init_worker(args, intra_op_threads):
+    config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                      inter_op_parallelism_threads=1)
+    _worker['mtcnn'] = create_mtcnn(config)
+    _worker['args'] = args
+
+def _align_task(task):
+    image_path, output_class_dir, known_digest = task
+    pnet, rnet, onet = _worker['mtcnn']
+    return align_image(image_path, output_class_dir, pnet, rnet, onet, _worker['args'], known_digest)
+
+
+def align_parallel(tasks, args):
+    """
+    Yield align_image results of ``tasks`` computed by ``args.workers`` processes. Images are
+    handed out in small chunks so that workers stay busy whatever the class sizes are.
+    """
+    nrof_tasks = len(tasks)
+    intra_op_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    print('Aligning %d images with %d workers (%d threads each)' % (nrof_tasks, args.workers, intra_op_threads))
+    # TensorFlow sessions do not survive fork()
+    context = multiprocessing.get_context('spawn')
+    chunksize = max(1, min(64, nrof_tasks // (args.workers * 16)))
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(args, intra_op_threads)) as pool:
+        for result in pool.imap_unordered(_align_task, tasks, chunksize=chunksize):
+            yield result
+
+
+def report_progress(results, nrof_tasks, interval):
+    """Pass align_image ``results`` through, printing throughput and ETA every ``interval`` seconds"""
+    start_time = last_report = time.time()
+    nrof_done = nrof_aligned = 0
+    for result in results:
+        nrof_done += 1
+        nrof_aligned += len(result[1])
+        now = time.time()
+        if now - last_report >= interval or nrof_done == nrof_tasks:
+            last_report = now
+            rate = nrof_done / max(now - start_time, 1e-9)
+            print('%d/%d images, %d faces aligned, %.1f images/s, ETA %.0f s' % (
+                nrof_done, nrof_tasks, nrof_aligned, rate, (nrof_tasks - nrof_done) / rate))
+            sys.stdout.flush()
+        yield result
             
 
 def parse_arguments(argv):
@@ -156,6 +246,10 @@ def parse_arguments(argv):
         help='Upper bound on the amount of GPU memory that will be used by the process.', default=1.0)
     parser.add_argument('--detect_multiple_faces', type=bool,
                         help='Detect and align multiple faces per image.', default=False)
+    parser.add_argument('--workers', type=int,
+                        help='Number of alignment processes, each with its own MTCNN session.', default=1)
+    parser.add_argument('--progress_interval', type=float,
+                        help='Seconds between progress reports with --workers.', default=5.0)
     return parser.parse_args(argv)
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+"""Manifest of an aligned (processed) dataset for incremental, resumable alignment.
+
+One ``manifest.jsonl`` per processed dataset records, for every source image,
+what alignment produced from it::
+
+    {"source": "person/img_01.jpg", "size": 48213, "mtime_ns": 1700000000000000000,
+     "sha1": "9f2c...", "outputs": ["person/img_01.png"], "boxes": [[x1, y1, x2, y2]],
+     "detector": "mtcnn", "params": {"image_size": 160, "margin": 44}}
+
+Sources are relative to the raw dataset and outputs relative to the processed
+dataset. The file is an append-only log: an entry is appended (one ``write``,
+flushed) after its outputs are written, and the last entry of a source wins, so
+a crash loses at most the image being aligned and a rerun resumes where it
+stopped. A ``{"source": ..., "deleted": true}`` line forgets a source.
+
+An image is skipped when its entry has the current parameters and the source
+still has the recorded size and mtime. A changed stat falls back to comparing
+the SHA-1 of the content, so only edited images are aligned again and their
+previous (stale) outputs are removed. Outputs are never probed with
+``os.path.exists``; the manifest is the source of truth.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import tempfile
+
+FILENAME = "manifest.jsonl"
+
+
+def file_digest(path=None, data=None):
+    """SHA-1 hex digest of a file (or of ``data``, its bytes)"""
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AlignmentManifest(object):
+
+    def __init__(self, processed_dir, params=None):
+        """``params``: alignment parameters (image size, margin, ...); entries made with others are stale"""
+        self.processed_dir = processed_dir
+        self.path = os.path.join(processed_dir, FILENAME)
+        self.params = dict(params or {})
+        self.entries = {}
+        self._file = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by a crash
+                    if entry.get("deleted"):
+                        self.entries.pop(entry["source"], None)
+                    else:
+                        self.entries[entry["source"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, source):
+        return source in self.entries
+
+    def output_path(self, output):
+        return os.path.join(self.processed_dir, output)
+
+    def check(self, source, source_path, stat=None):
+        """
+        (current, entry): ``current`` if ``source_path`` needs no alignment, judged by the
+        entry's parameters and the source's size and mtime. ``entry`` is the previous entry, if any.
+        """
+        entry = self.entries.get(source)
+        if entry is None or entry.get("params", {}) != self.params:
+            return False, entry
+        stat = stat or os.stat(source_path)
+        return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns, entry
+
+    def unchanged_content(self, entry, digest):
+        """True if a source whose stat changed still has the recorded content and parameters"""
+        return entry is not None and entry.get("params", {}) == self.params and entry.get("sha1") == digest
+
+    def record(self, source, source_path, outputs, boxes, detector, digest=None, stat=None, previous=None):
+        """
+        Append the entry of an aligned source; ``outputs`` are paths inside the processed
+        dataset. Outputs of ``previous`` (the entry it replaces) that were not written again are removed.
+        """
+        stat = stat or os.stat(source_path)
+        entry = {
+            "source": source,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": digest if digest is not None else file_digest(source_path),
+            "outputs": [os.path.relpath(output, self.processed_dir) if os.path.isabs(output) else output
+                        for output in outputs],
+            "boxes": [[int(v) for v in box] for box in boxes],
+            "detector": detector,
+            "params": self.params,
+        }
+        if previous is not None:
+            for output in set(previous.get("outputs", ())) - set(entry["outputs"]):
+                try:
+                    os.remove(self.output_path(output))
+                except FileNotFoundError:
+                    pass
+        self._append(entry)
+        self.entries[source] = entry
+        return entry
+
+    def refresh(self, entry, stat):
+        """Record the new stat of a source whose content did not change"""
+        entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        self._append(entry)
+        self.entries[entry["source"]] = entry
+        return entry
+
+    def forget(self, prefix):
+        """Drop the entries of sources under ``prefix`` (e.g. ``"person/"`` for a removed person)"""
+        for source in [source for source in self.entries if source.startswith(prefix)]:
+            self._append({"source": source, "deleted": True})
+            del self.entries[source]
+
+    def _append(self, entry):
+        if self._file is None:
+            os.makedirs(self.processed_dir, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        # One write per line so concurrent appenders do not interleave within an entry
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def compact(self):
+        """Rewrite the log with only the current entry of each source"""
+        self.close()
+        fd, tmp_path = tempfile.mkstemp(dir=self.processed_dir, prefix=".manifest-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def write_bounding_boxes(self, path):
+        """Export ``output x1 y1 x2 y2`` lines like the former ``bounding_boxes_*.txt`` files"""
+        with open(path, "w") as f:
+            for entry in self.entries.values():
+                if not entry["outputs"]:
+                    f.write("%s\n" % os.path.join(self.processed_dir, os.path.splitext(entry["source"])[0] + ".png"))
+                for output, box in zip(entry["outputs"], entry["boxes"]):
+                    f.write("%s %d %d %d %d\n" % ((self.output_path(output),) + tuple(box)))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
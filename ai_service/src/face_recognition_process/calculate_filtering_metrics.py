@@ -1,4 +1,15 @@
 """Calculate filtering metrics for a dataset and store in a .hdf file.
+
+Images are embedded in class order and reduced by a streaming statistics engine
+(``ClassStatistics``): each class keeps a running (Welford) center and sum of
+squared deviations while its embeddings arrive, and is finalized as soon as its
+last image is seen. Memory holds one class at a time whatever the dataset size.
+
+The .hdf file has the datasets ``class_names``, ``image_list``, ``label_list``
+and ``distance_to_center`` read by ``train_softmax.filter_dataset``. Embeddings
+come from the frozen ``model_file``, or with ``--service_backend`` from the
+service's inference backend (``FACE_INFERENCE_BACKEND``, run with ``src`` on
+the PYTHONPATH).
 """
 # MIT License
 # 
@@ -30,98 +41,148 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import facenet
-import os
 import sys
 import time
 import h5py
+import packed_dataset
 import math
-from tensorflow.python.platform import gfile
 from six import iteritems
 
+class ClassStatistics(object):
+    """
+    Per-class center, variance and distance to center of embeddings that arrive
+    in class order (the order of ``facenet.get_image_paths_and_labels``).
+    """
+
+    def __init__(self, nrof_examples_per_class, embedding_size):
+        nrof_examples_per_class = np.asarray(nrof_examples_per_class, dtype=np.int64)
+        self.offsets = np.append(0, np.cumsum(nrof_examples_per_class))
+        self.class_center = np.zeros((len(nrof_examples_per_class), embedding_size))
+        self.class_variance = np.zeros((len(nrof_examples_per_class),))
+        self.distance_to_center = np.ones((self.offsets[-1],))*np.nan
+        self.nrof_images = 0
+        # The class being accumulated: count, running mean, sum of squared deviations and its embeddings
+        self._count = 0
+        self._mean = np.zeros((embedding_size,))
+        self._m2 = 0.0
+        self._embeddings = np.zeros((max(nrof_examples_per_class.max(initial=0), 1), embedding_size))
+
+    def update(self, embeddings):
+        """Add the embeddings of the next images"""
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        if self.nrof_images + len(embeddings) > self.offsets[-1]:
+            raise ValueError('%d embeddings for %d images' % (self.nrof_images + len(embeddings), self.offsets[-1]))
+        start = 0
+        while start < len(embeddings):
+            # The last class starting at or before the next image, so empty classes are skipped
+            cls = np.searchsorted(self.offsets, self.nrof_images, side='right') - 1
+            n = min(self.offsets[cls+1] - self.nrof_images, len(embeddings) - start)
+            self._add(embeddings[start:start+n])
+            start += n
+            self.nrof_images += n
+            if self.nrof_images == self.offsets[cls+1]:
+                self._finish(cls)
+
+    def _add(self, emb):
+        # Chan et al. merge of the running statistics with those of the chunk
+        n = len(emb)
+        mean = np.mean(emb, axis=0)
+        m2 = np.sum(np.square(emb - mean))
+        delta = mean - self._mean
+        total = self._count + n
+        self._mean += delta * n / total
+        self._m2 += m2 + np.sum(np.square(delta)) * self._count * n / total
+        self._embeddings[self._count:total,:] = emb
+        self._count = total
+
+    def _finish(self, cls):
+        center = self._mean
+        self.class_center[cls,:] = center
+        self.class_variance[cls] = self._m2 / self._count
+        self.distance_to_center[self.offsets[cls]:self.offsets[cls+1]] = \
+            np.sqrt(np.sum(np.square(self._embeddings[:self._count,:] - center), axis=1))
+        self._count = 0
+        self._mean = np.zeros_like(center)
+        self._m2 = 0.0
+
+
+def calculate_statistics(dataset, embed, batch_size, image_size):
+    """ClassStatistics of ``dataset`` embedded batch by batch with ``embed(prewhitened images)``"""
+    image_list, _ = facenet.get_image_paths_and_labels(dataset)
+    nrof_images = len(image_list)
+    if nrof_images == 0:
+        raise ValueError('The dataset has no images')
+    stats = None
+    for i in range(int(math.ceil(nrof_images / batch_size))):
+        t = time.time()
+        # Packed datasets are read from their memory map, without decoding
+        images = packed_dataset.load_data(image_list[i*batch_size:(i+1)*batch_size], False, False, image_size)
+        emb = embed(images)
+        if stats is None:
+            stats = ClassStatistics([len(cls.image_paths) for cls in dataset], emb.shape[1])
+        stats.update(emb)
+        print('Batch %d in %.3f seconds' % (i, time.time()-t))
+    return stats
+
+
+def write_filtering_data(data_file_name, dataset, distance_to_center):
+    image_list, label_list = facenet.get_image_paths_and_labels(dataset)
+    mdict = {'class_names':np.array([cls.name for cls in dataset], dtype=h5py.string_dtype()),
+             'image_list':np.array(image_list, dtype=h5py.string_dtype()),
+             'label_list':np.array(label_list, dtype=np.int64),
+             'distance_to_center':distance_to_center }
+    with h5py.File(data_file_name, 'w') as f:
+        for key, value in iteritems(mdict):
+            f.create_dataset(key, data=value)
+
+
+def create_service_backend():
+    """The service's inference backend configured by the FACE_* environment variables"""
+    from serving.backends import create_backend
+    from serving.settings import Settings
+    return create_backend(Settings.from_env())
+
+
 def main(args):
-    dataset = facenet.get_dataset(args.dataset_dir)
-  
-    with tf.Graph().as_default():
-      
-        # Get a list of image paths and their labels
-        image_list, label_list = facenet.get_image_paths_and_labels(dataset)
-        nrof_images = len(image_list)
-        image_indices = range(nrof_images)
-
-        image_batch, label_batch = facenet.read_and_augment_data(image_list,
-            image_indices, args.image_size, args.batch_size, None, 
-            False, False, False, nrof_preprocess_threads=4, shuffle=False)
-        
-        model_exp = os.path.expanduser(args.model_file)
-        with gfile.FastGFile(model_exp,'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            input_map={'input':image_batch, 'phase_train':False}
-            tf.import_graph_def(graph_def, input_map=input_map, name='net')
-        
-        embeddings = tf.get_default_graph().get_tensor_by_name("net/embeddings:0")
-
-        with tf.compat.v1.Session() as sess:
-            tf.train.start_queue_runners(sess=sess)
-                
-            embedding_size = int(embeddings.get_shape()[1])
-            nrof_batches = int(math.ceil(nrof_images / args.batch_size))
-            nrof_classes = len(dataset)
-            label_array = np.array(label_list)
-            class_names = [cls.name for cls in dataset]
-            nrof_examples_per_class = [ len(cls.image_paths) for cls in dataset ]
-            class_variance = np.zeros((nrof_classes,))
-            class_center = np.zeros((nrof_classes,embedding_size))
-            distance_to_center = np.ones((len(label_list),))*np.NaN
-            emb_array = np.zeros((0,embedding_size))
-            idx_array = np.zeros((0,), dtype=np.int32)
-            lab_array = np.zeros((0,), dtype=np.int32)
-            index_arr = np.append(0, np.cumsum(nrof_examples_per_class))
-            for i in range(nrof_batches):
-                t = time.time()
-                emb, idx = sess.run([embeddings, label_batch])
-                emb_array = np.append(emb_array, emb, axis=0)
-                idx_array = np.append(idx_array, idx, axis=0)
-                lab_array = np.append(lab_array, label_array[idx], axis=0)
-                for cls in set(lab_array):
-                    cls_idx = np.where(lab_array==cls)[0]
-                    if cls_idx.shape[0]==nrof_examples_per_class[cls]:
-                        # We have calculated all the embeddings for this class
-                        i2 = np.argsort(idx_array[cls_idx])
-                        emb_class = emb_array[cls_idx,:]
-                        emb_sort = emb_class[i2,:]
-                        center = np.mean(emb_sort, axis=0)
-                        diffs = emb_sort - center
-                        dists_sqr = np.sum(np.square(diffs), axis=1)
-                        class_variance[cls] = np.mean(dists_sqr)
-                        class_center[cls,:] = center
-                        distance_to_center[index_arr[cls]:index_arr[cls+1]] = np.sqrt(dists_sqr)
-                        emb_array = np.delete(emb_array, cls_idx, axis=0)
-                        idx_array = np.delete(idx_array, cls_idx, axis=0)
-                        lab_array = np.delete(lab_array, cls_idx, axis=0)
-
-                        
-                print('Batch %d in %.3f seconds' % (i, time.time()-t))
-                
-            print('Writing filtering data to %s' % args.data_file_name)
-            mdict = {'class_names':class_names, 'image_list':image_list, 'label_list':label_list, 'distance_to_center':distance_to_center }
-            with h5py.File(args.data_file_name, 'w') as f:
-                for key, value in iteritems(mdict):
-                    f.create_dataset(key, data=value)
-                        
+    dataset = packed_dataset.get_dataset(args.dataset_dir)
+
+    if args.service_backend:
+        backend = create_service_backend()
+        try:
+            stats = calculate_statistics(dataset, backend.embed, args.batch_size, args.image_size)
+        finally:
+            backend.close()
+    else:
+        with tf.Graph().as_default():
+            facenet.load_model(args.model_file)
+            images_placeholder, embeddings, phase_train_placeholder = \
+                facenet.get_embedding_tensors(tf.get_default_graph())
+
+            with tf.compat.v1.Session() as sess:
+                def embed(images):
+                    return sess.run(embeddings, feed_dict=facenet.embedding_feed_dict(
+                        images_placeholder, phase_train_placeholder, images))
+                stats = calculate_statistics(dataset, embed, args.batch_size, args.image_size)
+
+    print('Mean class variance: %.4f' % np.mean(stats.class_variance))
+    print('Writing filtering data to %s' % args.data_file_name)
+    write_filtering_data(args.data_file_name, dataset, stats.distance_to_center)
+
 def parse_arguments(argv):
     parser = argparse.ArgumentParser()
     
     parser.add_argument('dataset_dir', type=str,
-        help='Path to the directory containing aligned dataset.')
+        help='Path to the directory containing aligned dataset, or a packed dataset (pack_dataset.py).')
     parser.add_argument('model_file', type=str,
-        help='File containing the frozen model in protobuf (.pb) format to use for feature extraction.')
+        help='File containing the frozen model in protobuf (.pb) format to use for feature extraction (unused with --service_backend).')
     parser.add_argument('data_file_name', type=str,
         help='The name of the file to store filtering data in.')
     parser.add_argument('--image_size', type=int,
         help='Image size.', default=160)
     parser.add_argument('--batch_size', type=int,
         help='Number of images to process in a batch.', default=90)
+    parser.add_argument('--service_backend',
+        help='Embed with the inference backend of the service (FACE_INFERENCE_BACKEND and its model settings).', action='store_true')
     return parser.parse_args(argv)
 
 if __name__ == '__main__':
@@ -33,8 +33,11 @@ import facenet
 import os
 import sys
 import math
+import time
 import pickle
-from sklearn.svm import SVC
+import classifier_artifact
+import classifier_backends
+import packed_dataset
 
 def main(args):
   
@@ -45,14 +48,14 @@ def main(args):
             np.random.seed(seed=args.seed)
             
             if args.use_split_dataset:
-                dataset_tmp = facenet.get_dataset(args.data_dir)
+                dataset_tmp = packed_dataset.get_dataset(args.data_dir)
                 train_set, test_set = split_dataset(dataset_tmp, args.min_nrof_images_per_class, args.nrof_train_images_per_class)
                 if (args.mode=='TRAIN'):
                     dataset = train_set
                 elif (args.mode=='CLASSIFY'):
                     dataset = test_set
             else:
-                dataset = facenet.get_dataset(args.data_dir)
+                dataset = packed_dataset.get_dataset(args.data_dir)
 
             # Check that there are at least one training image per class
             for cls in dataset:
@@ -69,9 +72,8 @@ def main(args):
             facenet.load_model(args.model)
             
             # Get input and output tensors
-            images_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
-            embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
-            phase_train_placeholder = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+            images_placeholder, embeddings, phase_train_placeholder = \
+                facenet.get_embedding_tensors(tf.compat.v1.get_default_graph())
             embedding_size = embeddings.get_shape()[1]
             
             # Run forward pass to calculate embeddings
@@ -83,31 +85,37 @@ def main(args):
                 start_index = i*args.batch_size
                 end_index = min((i+1)*args.batch_size, nrof_images)
                 paths_batch = paths[start_index:end_index]
-                images = facenet.load_data(paths_batch, False, False, args.image_size)
-                feed_dict = { images_placeholder:images, phase_train_placeholder:False }
+                images = packed_dataset.load_data(paths_batch, False, False, args.image_size)
+                feed_dict = facenet.embedding_feed_dict(images_placeholder, phase_train_placeholder, images)
                 emb_array[start_index:end_index,:] = sess.run(embeddings, feed_dict=feed_dict)
             
             classifier_filename_exp = os.path.expanduser(args.classifier_filename)
 
             if (args.mode=='TRAIN'):
                 # Train classifier
-                print('Training classifier')
-                model = SVC(kernel='linear', probability=True)
-                model.fit(emb_array, labels)
+                print('Training %s classifier' % args.backend)
+                start_time = time.time()
+                model = classifier_backends.train(args.backend, emb_array, labels, C=args.C,
+                    calibration_fraction=args.calibration_fraction, seed=args.seed)
+                print('Trained in %.1f seconds' % (time.time() - start_time))
             
                 # Create a list of class names
                 class_names = [ cls.name.replace('_', ' ') for cls in dataset]
 
-                # Saving classifier model
-                with open(classifier_filename_exp, 'wb') as outfile:
-                    pickle.dump((model, class_names), outfile)
+                # Saving classifier model: write a temporary file and rename it so readers never see a partial file
+                tmp_filename = '%s.tmp-%d' % (classifier_filename_exp, os.getpid())
+                if classifier_filename_exp.endswith(classifier_artifact.SUFFIX):
+                    classifier_artifact.save_model(tmp_filename, model, class_names)
+                else:
+                    with open(tmp_filename, 'wb') as outfile:
+                        pickle.dump((model, class_names), outfile)
+                os.replace(tmp_filename, classifier_filename_exp)
                 print('Saved classifier model to file "%s"' % classifier_filename_exp)
                 
             elif (args.mode=='CLASSIFY'):
                 # Classify images
                 print('Testing classifier')
-                with open(classifier_filename_exp, 'rb') as infile:
-                    (model, class_names) = pickle.load(infile)
+                (model, class_names) = classifier_artifact.load_classifier(classifier_filename_exp)
 
                 print('Loaded classifier model from file "%s"' % classifier_filename_exp)
 
@@ -142,12 +150,19 @@ def parse_arguments(argv):
         help='Indicates if a new classifier should be trained or a classification ' + 
         'model should be used for classification', default='CLASSIFY')
     parser.add_argument('data_dir', type=str,
-        help='Path to the data directory containing aligned LFW face patches.')
+        help='Path to the data directory containing aligned LFW face patches, or a packed dataset.')
     parser.add_argument('model', type=str, 
         help='Could be either a directory containing the meta_file and ckpt_file or a model protobuf (.pb) file')
     parser.add_argument('classifier_filename', 
-        help='Classifier model file name as a pickle (.pkl) file. ' + 
+        help='Classifier model file name as a pickle (.pkl) or memory-mappable artifact (.fca) file. ' + 
         'For training this is the output and for classification this is an input.')
+    parser.add_argument('--backend', type=str, choices=classifier_backends.BACKENDS,
+        help='Classifier to train: linear SVC with Platt scaling (svc), nearest class mean (ncm), ' +
+        'multinomial logistic regression (logreg) or calibrated one-vs-rest LinearSVC (linear_svc).', default='svc')
+    parser.add_argument('--C', type=float,
+        help='Inverse regularization strength of the logreg and linear_svc backends.', default=1.0)
+    parser.add_argument('--calibration_fraction', type=float,
+        help='Fraction of the images held out to calibrate the ncm and linear_svc scores.', default=0.2)
     parser.add_argument('--use_split_dataset', 
         help='Indicates that the dataset specified by data_dir should be split into a training and test set. ' +  
         'Otherwise a separate test set can be specified using the test_data_dir option.', action='store_true')
@@ -0,0 +1,255 @@
+"""Memory-mappable classifier artifacts (``.fca``) replacing pickled classifiers.
+
+A pickled ``(SVC, class_names)`` tuple has to be deserialized into private
+memory by every process and can execute code when loaded. An artifact is a
+flat little-endian file that ``load`` maps read-only: every worker process
+shares the page-cache copy and loading costs an ``mmap`` plus a small JSON
+parse. Prediction is plain NumPy on the mapped arrays.
+
+Layout::
+
+    offset  size  content
+    0       8     magic b"FACEART\\0"
+    8       4     uint32 format version (1)
+    12      4     uint32 header length H
+    16      H     UTF-8 JSON header:
+                    {"kind": ..., "meta": {...},
+                     "arrays": {name: {"dtype": "<f4", "shape": [...], "offset": o}}}
+    D             data section, D = 16 + H rounded up to 64 bytes; array ``name``
+                  starts at D + o, every o is a multiple of 64
+
+The class-name table is the array ``class_names``: NUL-separated UTF-8 names
+(uint8). Weights and templates are float32. Kinds:
+
+``svc_ovo``
+    A (linear) ``sklearn.svm.SVC(probability=True)``: one-vs-one hyperplanes
+    ``coef`` (P, D) and ``intercept`` (P,) with the Platt parameters ``prob_a``,
+    ``prob_b`` (P,); probabilities are coupled like libsvm does.
+``linear``
+    ``scores = X @ weights.T + bias`` turned into probabilities by
+    ``meta["link"]``: ``softmax`` (multinomial logistic regression) or
+    ``sigmoid`` (one-vs-rest scores normalized to sum to one).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b"FACEART\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+SUFFIX = ".fca"
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def encode_class_names(class_names):
+    return np.frombuffer("\0".join(class_names).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_class_names(table):
+    if len(table) == 0:
+        return []
+    return bytes(table).decode("utf-8").split("\0")
+
+
+def save(path, kind, class_names, arrays, meta=None):
+    """Write an artifact; ``arrays`` maps names to arrays (float arrays are stored as float32)"""
+    arrays = dict(arrays)
+    arrays["class_names"] = encode_class_names(class_names)
+    entries, blobs, offset = {}, [], 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if array.dtype.kind == "f":
+            array = array.astype("<f4")
+        array = np.ascontiguousarray(array)
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        blobs.append((offset, array.tobytes()))
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"kind": kind, "meta": meta or {}, "arrays": entries}).encode("utf-8")
+    data_start = _align(_PREAMBLE.size + len(header))
+    with open(path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for array_offset, blob in blobs:
+            f.seek(data_start + array_offset)
+            f.write(blob)
+        f.truncate(data_start + offset)
+
+
+class Artifact(object):
+
+    def __init__(self, kind, class_names, arrays, meta):
+        self.kind = kind
+        self.class_names = class_names
+        self.arrays = arrays
+        self.meta = meta
+
+
+def load(path):
+    """Map an artifact read-only; the arrays are views of one shared ``np.memmap``"""
+    with open(path, "rb") as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a classifier artifact" % path)
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported classifier artifact version %d in %s" % (version, path))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _align(_PREAMBLE.size + header_length)
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=mapped, offset=data_start + entry["offset"])
+    class_names = decode_class_names(arrays.pop("class_names"))
+    return Artifact(header["kind"], class_names, arrays, header["meta"])
+
+
+def _softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    np.exp(scores, out=scores)
+    return scores / scores.sum(axis=1, keepdims=True)
+
+
+def _sigmoid(x):
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+def couple_pairwise(pairwise):
+    """
+    libsvm ``multiclass_probability`` (Wu, Lin and Weng 2004), vectorized over samples:
+    class probabilities from the (N, K, K) pairwise probabilities r[i, j] = P(i | i or j).
+    """
+    n, k, _ = pairwise.shape
+    q = -pairwise.transpose(0, 2, 1) * pairwise
+    diagonal = np.einsum("nji,nji->ni", pairwise, pairwise) - np.einsum("nii,nii->ni", pairwise, pairwise)
+    idx = np.arange(k)
+    q[:, idx, idx] = diagonal
+    p = np.full((n, k), 1.0 / k)
+    eps = 0.005 / k
+    active = np.ones(n, dtype=bool)
+    for _ in range(max(100, k)):
+        qp = np.einsum("nij,nj->ni", q, p)
+        pqp = np.einsum("ni,ni->n", p, qp)
+        active &= np.abs(qp - pqp[:, None]).max(axis=1) >= eps
+        if not active.any():
+            break
+        for t in range(k):
+            diff = np.where(active, (-qp[:, t] + pqp) / q[:, t, t], 0.0)
+            p[:, t] += diff
+            pqp = (pqp + diff * (diff * q[:, t, t] + 2 * qp[:, t])) / (1 + diff) ** 2
+            qp = (qp + diff[:, None] * q[:, t, :]) / (1 + diff)[:, None]
+            p /= (1 + diff)[:, None]
+    return p
+
+
+class SVCPredictor(object):
+    """``predict_proba`` of a linear one-vs-one SVC from its mapped hyperplanes"""
+
+    MIN_PROB = 1e-7
+
+    def __init__(self, artifact):
+        self.coef = artifact.arrays["coef"]
+        self.intercept = artifact.arrays["intercept"]
+        self.prob_a = artifact.arrays["prob_a"]
+        self.prob_b = artifact.arrays["prob_b"]
+        self.n_classes = artifact.meta["n_classes"]
+        self._pairs = np.array([(i, j) for i in range(self.n_classes) for j in range(i + 1, self.n_classes)])
+
+    def predict_proba(self, embeddings):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        decision = embeddings @ self.coef.T + self.intercept
+        # libsvm sigmoid_predict: 1 / (1 + exp(A * f + B))
+        r = _sigmoid(-(decision * self.prob_a + self.prob_b)).astype(np.float64)
+        r = np.clip(r, self.MIN_PROB, 1 - self.MIN_PROB)
+        pairwise = np.zeros((len(embeddings), self.n_classes, self.n_classes))
+        i, j = self._pairs[:, 0], self._pairs[:, 1]
+        pairwise[:, i, j] = r
+        pairwise[:, j, i] = 1 - r
+        return couple_pairwise(pairwise)
+
+
+class LinearPredictor(object):
+
+    def __init__(self, artifact):
+        self.weights = artifact.arrays["weights"]
+        self.bias = artifact.arrays["bias"]
+        self.link = artifact.meta.get("link", "softmax")
+
+    def decision_function(self, embeddings):
+        return np.atleast_2d(np.asarray(embeddings, dtype=np.float32)) @ self.weights.T + self.bias
+
+    def predict_proba(self, embeddings):
+        scores = self.decision_function(embeddings).astype(np.float64)
+        if self.link == "softmax":
+            return _softmax(scores)
+        probabilities = _sigmoid(scores)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+PREDICTORS = {
+    "svc_ovo": SVCPredictor,
+    "linear": LinearPredictor,
+}
+
+
+def predictor(artifact):
+    return PREDICTORS[artifact.kind](artifact)
+
+
+def from_sklearn(model):
+    """(kind, arrays, meta) of a fitted scikit-learn classifier"""
+    name = type(model).__name__
+    if name == "SVC":
+        if model.kernel != "linear" or not model.probability:
+            raise ValueError("Only SVC(kernel='linear', probability=True) can be converted")
+        coef, intercept = model.coef_, model.intercept_
+        if len(model.classes_) == 2:
+            # scikit-learn negates the binary hyperplane so that positive means classes_[1]; libsvm's favours [0]
+            coef, intercept = -coef, -intercept
+        return "svc_ovo", {
+            "coef": coef,
+            "intercept": intercept,
+            "prob_a": model.probA_,
+            "prob_b": model.probB_,
+        }, {"n_classes": int(len(model.classes_))}
+    if name == "LogisticRegression":
+        coef, intercept = model.coef_, model.intercept_
+        if coef.shape[0] == 1:
+            # Binary: P(class 1) = sigmoid(w x + b) = softmax([0, w x + b])
+            coef = np.vstack([np.zeros_like(coef), coef])
+            intercept = np.concatenate([[0.0], intercept])
+        return "linear", {"weights": coef, "bias": intercept}, {"link": "softmax"}
+    if name == "SoftmaxClassifier":
+        return "linear", {"weights": model.weights, "bias": model.bias}, {"link": "softmax"}
+    raise ValueError("Cannot convert a %s classifier" % name)
+
+
+def save_model(path, model, class_names):
+    """Write a fitted scikit-learn classifier as an artifact"""
+    kind, arrays, meta = from_sklearn(model)
+    meta["source"] = getattr(model, "source", type(model).__name__)
+    save(path, kind, class_names, arrays, meta)
+
+
+def load_classifier(path):
+    """
+    (model, class_names) where ``model.predict_proba`` works like the pickled
+    classifier's. Legacy ``.pkl`` files are still unpickled; only load trusted ones.
+    """
+    if os.path.splitext(path)[1] == ".pkl":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    artifact = load(path)
+    return predictor(artifact), artifact.class_names
@@ -0,0 +1,138 @@
+"""Training backends for the identity classifier on top of FaceNet embeddings.
+
+``SVC(kernel='linear', probability=True)`` trains K(K-1)/2 one-vs-one machines
+and runs an internal 5-fold cross-validation for Platt scaling, so retraining
+grows roughly quadratically with the number of samples and classes. The other
+backends all produce one linear scorer per class turned into probabilities by a
+softmax, which the ``linear`` artifact kind serves as one matrix product:
+
+``svc``
+    The original ``SVC(kernel='linear', probability=True)``.
+``ncm``
+    Nearest class mean: the normalized mean embedding of each class, scored by
+    cosine similarity. Fitting is one pass over the embeddings.
+``logreg``
+    Multinomial logistic regression (L-BFGS) on the normalized embeddings.
+``linear_svc``
+    One-vs-rest ``LinearSVC`` (liblinear).
+
+``ncm`` and ``linear_svc`` scores are calibrated with a single softmax
+temperature fitted on a held-out fraction of the samples, and the final model is
+refitted on all of them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.special import logsumexp
+from sklearn.linear_model import LogisticRegression
+from sklearn.svm import SVC, LinearSVC
+
+BACKENDS = ("svc", "ncm", "logreg", "linear_svc")
+
+
+class SoftmaxClassifier(object):
+    """``predict_proba(X) = softmax(X @ weights.T + bias)``, what the ``ncm`` and ``linear_svc`` backends fit"""
+
+    def __init__(self, weights, bias, classes, source):
+        self.weights = weights
+        self.bias = bias
+        self.classes_ = classes
+        self.source = source
+
+    def decision_function(self, embeddings):
+        return np.atleast_2d(embeddings) @ self.weights.T + self.bias
+
+    def predict_proba(self, embeddings):
+        scores = self.decision_function(embeddings)
+        return np.exp(scores - logsumexp(scores, axis=1, keepdims=True))
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings)
+    embeddings = embeddings.astype(np.result_type(embeddings.dtype, np.float32), copy=False)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+def class_means(embeddings, labels, nrof_classes):
+    """(nrof_classes, D) mean embedding per label, one sorted pass"""
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    sums = np.zeros((nrof_classes, embeddings.shape[1]))
+    sums[sorted_labels[starts]] = np.add.reduceat(embeddings[order], starts, axis=0)
+    counts = np.bincount(labels, minlength=nrof_classes)
+    return sums / np.maximum(counts, 1)[:, None]
+
+
+def fit_ncm(embeddings, labels, nrof_classes):
+    centroids = normalize(class_means(embeddings, labels, nrof_classes))
+    return centroids, np.zeros(nrof_classes)
+
+
+def fit_linear_svc(embeddings, labels, nrof_classes, C=1.0):
+    model = LinearSVC(C=C).fit(embeddings, labels)
+    weights, bias = model.coef_, model.intercept_
+    if nrof_classes == 2:
+        # One hyperplane for classes_[1]: softmax([0, s]) == sigmoid(s)
+        weights = np.vstack([np.zeros_like(weights), weights])
+        bias = np.concatenate([[0.0], bias])
+    return weights, bias
+
+
+def held_out_mask(labels, fraction, rng):
+    """Random ``fraction`` of the samples, never the only remaining sample of a class"""
+    order = rng.permutation(len(labels))
+    _, first = np.unique(labels[order], return_index=True)
+    eligible = np.ones(len(labels), dtype=bool)
+    eligible[order[first]] = False
+    return eligible & (rng.uniform(size=len(labels)) < fraction)
+
+
+def fit_temperature(scores, labels):
+    """Softmax temperature minimizing the negative log-likelihood of ``labels`` under ``scores``"""
+    true_scores = scores[np.arange(len(labels)), labels]
+
+    def nll(log_t):
+        t = np.exp(log_t)
+        return np.mean(logsumexp(t * scores, axis=1) - t * true_scores)
+
+    return float(np.exp(minimize_scalar(nll, bounds=(-5.0, 8.0), method="bounded").x))
+
+
+def calibrated(fit, embeddings, labels, nrof_classes, fraction, default_temperature, seed):
+    """Fit on all samples with the temperature fitted on a held-out ``fraction`` of them"""
+    temperature = default_temperature
+    held = held_out_mask(labels, fraction, np.random.RandomState(seed)) if fraction > 0 else None
+    if held is not None and held.any():
+        weights, bias = fit(embeddings[~held], labels[~held], nrof_classes)
+        temperature = fit_temperature(embeddings[held] @ weights.T + bias, labels[held])
+    weights, bias = fit(embeddings, labels, nrof_classes)
+    return weights * temperature, bias * temperature, temperature
+
+
+def train(backend, embeddings, labels, C=1.0, max_iter=1000, calibration_fraction=0.2, ncm_scale=16.0, seed=666):
+    """
+    Fit the ``backend`` classifier; ``labels`` are class indices 0..K-1. The result has
+    ``predict_proba`` and can be saved with ``classifier_artifact.save_model``.
+    """
+    labels = np.asarray(labels)
+    if backend == "svc":
+        return SVC(kernel="linear", probability=True).fit(embeddings, labels)
+    embeddings = normalize(embeddings)
+    nrof_classes = int(labels.max()) + 1
+    classes = np.arange(nrof_classes)
+    if backend == "logreg":
+        return LogisticRegression(C=C, max_iter=max_iter).fit(embeddings, labels)
+    if backend == "ncm":
+        weights, bias, _ = calibrated(fit_ncm, embeddings, labels, nrof_classes,
+                                      calibration_fraction, ncm_scale, seed)
+        return SoftmaxClassifier(weights, bias, classes, "NearestClassMean")
+    if backend == "linear_svc":
+        def fit(x, y, k):
+            return fit_linear_svc(x, y, k, C=C)
+        weights, bias, _ = calibrated(fit, embeddings, labels, nrof_classes, calibration_fraction, 1.0, seed)
+        return SoftmaxClassifier(weights, bias, classes, "LinearSVC")
+    raise ValueError("Unknown classifier backend %r (expected one of %s)" % (backend, ", ".join(BACKENDS)))
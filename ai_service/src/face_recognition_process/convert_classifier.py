@@ -0,0 +1,58 @@
+"""Convert a pickled ``(classifier, class_names)`` file to a classifier artifact.
+
+    python src/face_recognition_process/convert_classifier.py Models/facemodel.pkl Models/facemodel.fca
+
+The artifact (``classifier_artifact.py``) is memory-mapped by the service instead of
+unpickled. With ``--check`` the probabilities of both files are compared on random
+unit-norm embeddings.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import classifier_artifact
+
+
+def main(args):
+    # Only convert pickles you trust: unpickling can execute code
+    with open(os.path.expanduser(args.input_file), 'rb') as f:
+        model, class_names = pickle.load(f)
+    output_file = os.path.expanduser(args.output_file)
+    tmp_file = '%s.tmp-%d' % (output_file, os.getpid())
+    classifier_artifact.save_model(tmp_file, model, class_names)
+    os.replace(tmp_file, output_file)
+    print('Wrote %s classifier with %d classes to %s (%d bytes)' % (
+        type(model).__name__, len(class_names), output_file, os.path.getsize(output_file)))
+
+    if args.check:
+        converted, converted_names = classifier_artifact.load_classifier(output_file)
+        embeddings = np.random.RandomState(0).normal(size=(args.check, model.coef_.shape[1]))
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        expected = model.predict_proba(embeddings)
+        actual = converted.predict_proba(embeddings)
+        max_diff = float(np.abs(expected - actual).max())
+        agreement = float(np.mean(expected.argmax(axis=1) == actual.argmax(axis=1)))
+        print('Max probability difference: %.2e, top-1 agreement: %.4f' % (max_diff, agreement))
+        if converted_names != list(class_names) or agreement < 1.0:
+            return 1
+    return 0
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_file', type=str, help='Pickled (classifier, class_names) file, e.g. facemodel.pkl.')
+    parser.add_argument('output_file', type=str, help='Artifact to write (.fca).')
+    parser.add_argument('--check', type=int, default=0,
+        help='Compare the predictions of both files on this many random embeddings.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_arguments(sys.argv[1:])))
@@ -0,0 +1,98 @@
+"""Converts the MTCNN networks and the FaceNet embedder to ONNX models for the
+onnxruntime inference backend of the service.
+
+Writes pnet.onnx, rnet.onnx, onet.onnx and facenet.onnx to the output directory.
+Each model keeps the input layout and output order of the TensorFlow functions
+returned by align.detect_face.create_mtcnn, so align.detect_face.detect_face can
+use either runtime unchanged. A frozen training graph is first passed through
+export_inference_graph.optimize_graph_def so no phase_train branches are converted.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import tensorflow as tf
+
+import facenet
+
+# Output tensors in the order the TensorFlow pnet/rnet/onet functions return them
+MTCNN_OUTPUTS = {
+    'pnet': ['pnet/conv4-2/BiasAdd:0', 'pnet/prob1:0'],
+    'rnet': ['rnet/conv5-2/conv5-2:0', 'rnet/prob1:0'],
+    'onet': ['onet/conv6-2/conv6-2:0', 'onet/conv6-3/conv6-3:0', 'onet/prob1:0'],
+}
+
+
+def main(args):
+    output_dir = os.path.expanduser(args.output_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if not args.skip_mtcnn:
+        for name, path in convert_mtcnn(args.mtcnn_model_dir, output_dir, args.opset).items():
+            print('Saved %s to %s' % (name, path))
+
+    if args.facenet_model:
+        output_file = os.path.join(output_dir, args.facenet_output_name)
+        convert_facenet(args.facenet_model, output_file, args.image_size, args.opset)
+        print('Saved facenet to %s' % output_file)
+
+
+def convert_mtcnn(mtcnn_model_dir, output_dir, opset=13):
+    import align.detect_face
+    paths = {}
+    with tf.Graph().as_default() as graph:
+        with tf.compat.v1.Session() as sess:
+            align.detect_face.create_mtcnn(sess, mtcnn_model_dir)
+            for name, outputs in MTCNN_OUTPUTS.items():
+                output_nodes = [output.split(':')[0] for output in outputs]
+                graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                    sess, graph.as_graph_def(), output_nodes)
+                paths[name] = os.path.join(output_dir, name + '.onnx')
+                graph_def_to_onnx(graph_def, [name + '/input:0'], outputs, paths[name], opset)
+    return paths
+
+
+def convert_facenet(model_file, output_file, image_size=160, opset=13):
+    with tf.io.gfile.GFile(os.path.expanduser(model_file), 'rb') as f:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(f.read())
+    if any(node.name == 'phase_train' for node in graph_def.node):
+        import export_inference_graph
+        graph_def = export_inference_graph.optimize_graph_def(graph_def, image_size)
+    graph_def_to_onnx(graph_def, ['input:0'], ['embeddings:0'], output_file, opset)
+
+
+def graph_def_to_onnx(graph_def, input_names, output_names, output_file, opset=13):
+    import tf2onnx
+    tf2onnx.convert.from_graph_def(graph_def, input_names=input_names, output_names=output_names,
+        opset=opset, output_path=output_file)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('output_dir', type=str,
+        help='Directory the .onnx models are written to.')
+    parser.add_argument('--facenet_model', type=str,
+        help='Frozen FaceNet graph (.pb) to convert, e.g. Models/20180402-114759.pb')
+    parser.add_argument('--facenet_output_name', type=str,
+        help='File name of the converted FaceNet model.', default='facenet.onnx')
+    parser.add_argument('--mtcnn_model_dir', type=str,
+        help='Directory with det1.npy, det2.npy and det3.npy. Defaults to src/align.')
+    parser.add_argument('--skip_mtcnn',
+        help='Only convert the FaceNet model.', action='store_true')
+    parser.add_argument('--image_size', type=int,
+        help='Image size (height, width) of the FaceNet input.', default=160)
+    parser.add_argument('--opset', type=int,
+        help='ONNX opset version.', default=13)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,101 @@
+"""Outlier filtering of a dataset with the metrics of ``calculate_filtering_metrics.py``.
+
+Images whose distance to their class center is at or above the ``percentile``
+threshold of all distances are removed, and a class that has fewer than
+``min_nrof_images_per_class`` images left after losing outliers is removed
+altogether. Outliers are grouped by class with one sort and removed with a
+hashed path set per class, so filtering is linear in the dataset size.
+
+``filter_dataset`` also returns a report of what was removed::
+
+    {"data_filename": ..., "percentile": 95.0, "threshold": 1.07, "min_nrof_images_per_class": 10,
+     "nrof_images": 1000, "nrof_kept_images": 940, "nrof_classes": 50, "nrof_kept_classes": 49,
+     "removed_images": ["Ann/Ann_0003.png", ...],
+     "removed_classes": [{"name": "Bob", "nrof_images": 12, "nrof_outliers": 3}, ...]}
+
+``removed_images`` lists the outliers; the other images of a removed class are
+only counted in its ``removed_classes`` entry.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import h5py
+import numpy as np
+
+import facenet
+
+
+def find_threshold(var, percentile):
+    hist, bin_edges = np.histogram(var, 100)
+    cdf = np.float32(np.cumsum(hist)) / np.sum(hist)
+    bin_centers = (bin_edges[:-1]+bin_edges[1:])/2
+    #plt.plot(bin_centers, cdf)
+    threshold = np.interp(percentile*0.01, cdf, bin_centers)
+    return threshold
+
+
+def read_filtering_data(data_filename):
+    """(distance_to_center, label_list, image_list) of a filtering metrics file"""
+    with h5py.File(data_filename, 'r') as f:
+        distance_to_center = np.array(f.get('distance_to_center'))
+        label_list = np.array(f.get('label_list'), dtype=np.int64)
+        # h5py returns variable-length strings as bytes
+        image_list = [image.decode('utf-8') if isinstance(image, bytes) else str(image)
+                      for image in np.array(f.get('image_list'))]
+    return distance_to_center, label_list, image_list
+
+
+def filter_dataset(dataset, data_filename, percentile, min_nrof_images_per_class):
+    """
+    (filtered dataset, report). ``dataset`` must be the class list the metrics were
+    calculated on (labels index it); it is not modified.
+    """
+    distance_to_center, label_list, image_list = read_filtering_data(data_filename)
+    if len(label_list) and label_list.max() >= len(dataset):
+        raise ValueError('%s has labels up to %d, the dataset has %d classes' % (
+            data_filename, label_list.max(), len(dataset)))
+    threshold = find_threshold(distance_to_center, percentile)
+    outliers = np.where(distance_to_center>=threshold)[0]
+    outliers = outliers[np.argsort(label_list[outliers], kind='stable')]
+    labels, starts = np.unique(label_list[outliers], return_index=True)
+    outlier_paths = {int(label): set(image_list[i] for i in rows)
+                     for label, rows in zip(labels, np.split(outliers, starts[1:]))}
+
+    filtered_dataset = []
+    removed_images = []
+    removed_classes = []
+    for label, cls in enumerate(dataset):
+        paths = outlier_paths.get(label)
+        if not paths:
+            filtered_dataset.append(cls)
+            continue
+        image_paths = [image for image in cls.image_paths if image not in paths]
+        nrof_outliers = len(cls.image_paths) - len(image_paths)
+        removed_images += [image for image in cls.image_paths if image in paths]
+        if len(image_paths)<min_nrof_images_per_class:
+            removed_classes.append({'name': cls.name, 'nrof_images': len(cls.image_paths),
+                                    'nrof_outliers': nrof_outliers})
+        else:
+            filtered_dataset.append(facenet.ImageClass(cls.name, image_paths))
+
+    report = {
+        'data_filename': data_filename,
+        'percentile': percentile,
+        'threshold': float(threshold),
+        'min_nrof_images_per_class': min_nrof_images_per_class,
+        'nrof_images': sum(len(cls.image_paths) for cls in dataset),
+        'nrof_kept_images': sum(len(cls.image_paths) for cls in filtered_dataset),
+        'nrof_classes': len(dataset),
+        'nrof_kept_classes': len(filtered_dataset),
+        'removed_images': removed_images,
+        'removed_classes': removed_classes,
+    }
+    return filtered_dataset, report
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
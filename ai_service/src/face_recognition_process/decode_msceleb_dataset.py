@@ -1,5 +1,18 @@
 """Decode the MsCelebV1 dataset in TSV (tab separated values) format downloaded from
 https://www.microsoft.com/en-us/research/project/ms-celeb-1m-challenge-recognizing-one-million-celebrities-real-world/
+
+The TSV files are split into byte ranges (``--chunk_size``) that ``--workers``
+processes decode in parallel, each reading only its own range of the file. A
+range owns the lines that start inside it. Images are resized with OpenCV and
+written either as one directory per class (optionally spread over ``--shards``
+subtrees) or straight into a packed dataset (``--packed``, see packed_dataset.py).
+With ``--packed`` each worker writes its range to a small packed shard under
+``.ranges/`` that the parent appends and deletes, so images never travel through
+the pool's result pipe. At most two ranges per worker are in flight at any time.
+
+The run is resumable: every finished range is appended to ``decode_progress.jsonl``
+in the output directory, and a rerun with the same ``--chunk_size`` skips those
+ranges. Throughput is printed every ``--progress_interval`` seconds.
 """
 # MIT License
 # 
@@ -27,14 +40,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from scipy import misc
 import numpy as np
 import base64
+import binascii
+import json
+import multiprocessing
+import queue
+import shutil
 import sys
 import os
+import time
+import zlib
 import cv2
 import argparse
 import facenet
+import packed_dataset
 
 
 # File format: text files, each line is an image record containing 6 columns, delimited by TAB.
@@ -45,43 +65,248 @@ import facenet
 # Column5: PageURL
 # Column6: ImageData_Base64Encoded
 
+PROGRESS_FILE = 'decode_progress.jsonl'
+RANGES_DIR = '.ranges'
+
+
+def split_ranges(tsv_file, chunk_size):
+    """(file, start, end) byte ranges of ``chunk_size`` bytes covering ``tsv_file``"""
+    size = os.path.getsize(tsv_file)
+    return [(tsv_file, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def read_lines(tsv_file, start, end):
+    """Yield the lines of ``tsv_file`` that start in the byte range [start, end)"""
+    with open(tsv_file, 'rb') as f:
+        if start > 0:
+            # The line running through ``start`` belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def decode_record(line, size):
+    """(class name, image name, BGR image) of a TSV line, or None if it does not hold an image"""
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    if len(fields) < 6:
+        return None
+    try:
+        img_data = np.frombuffer(base64.b64decode(fields[5]), dtype=np.uint8)
+    except (binascii.Error, ValueError):
+        return None
+    img = cv2.imdecode(img_data, cv2.IMREAD_COLOR) if img_data.size else None
+    if img is None:
+        return None
+    if size:
+        shrink = img.shape[0] > size or img.shape[1] > size
+        img = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+    class_name = fields[0].decode('utf-8', 'replace')
+    img_name = (fields[1] + b'-' + fields[4]).decode('utf-8', 'replace').replace('/', '_')
+    return class_name, img_name, img
+
+
+def class_directory(class_name, shards):
+    """Directory of a class relative to the output directory; a class always lands in the same shard"""
+    if not shards:
+        return class_name
+    return os.path.join('%03d' % (zlib.crc32(class_name.encode('utf-8')) % shards), class_name)
+
+
+# Per-process state of the --workers pool
+_worker = {}
+
+def _init_worker(args):
+    _worker['args'] = args
+
+def range_shard(output_dir, task):
+    """Directory of the packed shard a worker writes the range ``task`` to"""
+    tsv_file, start, end = task
+    return os.path.join(output_dir, RANGES_DIR, '%08x-%d-%d' % (zlib.crc32(tsv_file.encode('utf-8')), start, end))
+
+
+def decode_range(task):
+    """
+    Decode the lines of a (file, start, end) range: (task, nrof_images, nrof_failed, shard).
+    Images are written to their class directories, except with --packed where they go
+    to the packed ``shard`` directory for the parent to append.
+    """
+    args = _worker['args']
+    output_dir = os.path.expanduser(args.output_dir)
+    nrof_images = nrof_failed = 0
+    shard = writer = None
+    if args.packed:
+        shard = range_shard(output_dir, task)
+        writer = packed_dataset.PackedWriter(shard, (args.size, args.size))
+    try:
+        for line in read_lines(*task):
+            record = decode_record(line, args.size)
+            if record is None:
+                nrof_failed += 1
+                continue
+            class_name, img_name, img = record
+            img_name += '.' + args.output_format
+            if writer is not None:
+                writer.append(class_name, class_name + '/' + img_name, cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+            else:
+                full_class_dir = os.path.join(output_dir, class_directory(class_name, args.shards))
+                if not os.path.exists(full_class_dir):
+                    os.makedirs(full_class_dir, exist_ok=True)
+                cv2.imwrite(os.path.join(full_class_dir, img_name), img) #pylint: disable=maybe-no-member
+            nrof_images += 1
+        if writer is not None:
+            writer.commit()
+    finally:
+        if writer is not None:
+            writer.close()
+    return task, nrof_images, nrof_failed, shard
+
+
+def append_shard(writer, shard):
+    """Append the rows of a range's packed shard to ``writer`` and delete the shard"""
+    dataset = packed_dataset.PackedDataset(shard)
+    for row in range(len(dataset)):
+        # Rows of a range decoded again after a crash are already packed and skipped
+        writer.append(dataset.classes[dataset.labels[row]], dataset.paths[row], dataset.images[row])
+    del dataset
+    shutil.rmtree(shard)
+
+
+def read_progress(path):
+    """Set of the (file, start, end) ranges a previous run finished"""
+    done = set()
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line torn by a crash
+                done.add((entry['file'], entry['start'], entry['end']))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def decode_parallel(tasks, args, max_pending=None):
+    """
+    Yield the decode_range results of ``tasks`` as ``args.workers`` processes finish them.
+    Ranges are submitted as results are consumed, at most ``max_pending`` at a time.
+    """
+    if args.workers <= 1:
+        _init_worker(args)
+        for task in tasks:
+            yield decode_range(task)
+        return
+    max_pending = max_pending or 2 * args.workers
+    context = multiprocessing.get_context('spawn')
+    finished = queue.Queue()
+    tasks = iter(tasks)
+    nrof_pending = 0
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        while True:
+            while nrof_pending < max_pending:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pool.apply_async(decode_range, (task,), callback=finished.put, error_callback=finished.put)
+                nrof_pending += 1
+            if nrof_pending == 0:
+                return
+            result = finished.get()
+            nrof_pending -= 1
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+
+
 def main(args):
     output_dir = os.path.expanduser(args.output_dir)
   
     if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+        os.makedirs(output_dir)
   
     # Store some git revision info in a text file in the output directory
     src_path,_ = os.path.split(os.path.realpath(__file__))
     facenet.store_revision_info(src_path, output_dir, ' '.join(sys.argv))
-    
-    i = 0
-    for f in args.tsv_files:
-        for line in f:
-            fields = line.split('\t')
-            class_dir = fields[0]
-            img_name = fields[1] + '-' + fields[4] + '.' + args.output_format
-            img_string = fields[5]
-            img_dec_string = base64.b64decode(img_string)
-            img_data = np.fromstring(img_dec_string, dtype=np.uint8)
-            img = cv2.imdecode(img_data, cv2.IMREAD_COLOR) #pylint: disable=maybe-no-member
-            if args.size:
-                img = misc.imresize(img, (args.size, args.size), interp='bilinear')
-            full_class_dir = os.path.join(output_dir, class_dir)
-            if not os.path.exists(full_class_dir):
-                os.mkdir(full_class_dir)
-            full_path = os.path.join(full_class_dir, img_name.replace('/','_'))
-            cv2.imwrite(full_path, img) #pylint: disable=maybe-no-member
-            print('%8d: %s' % (i, full_path))
-            i += 1
-  
-if __name__ == '__main__':
+
+    tasks = []
+    for tsv_file in args.tsv_files:
+        tasks += split_ranges(os.path.abspath(os.path.expanduser(tsv_file)), int(args.chunk_size * 2**20))
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    done = read_progress(progress_path)
+    tasks = [task for task in tasks if task not in done]
+    nrof_bytes_total = sum(end - start for _, start, end in tasks)
+    print('Decoding %d byte ranges (%.1f MB), %d already decoded' % (
+        len(tasks), nrof_bytes_total / 2**20, len(done)))
+
+    writer = None
+    if args.packed:
+        writer = packed_dataset.PackedWriter(output_dir, (args.size, args.size))
+        # Shards of ranges an interrupted run had not appended yet; those ranges are decoded again
+        shutil.rmtree(os.path.join(output_dir, RANGES_DIR), ignore_errors=True)
+    start_time = last_report = time.time()
+    nrof_bytes = nrof_images = nrof_failed = nrof_ranges = 0
+    try:
+        with open(progress_path, 'a') as progress:
+            for task, nrof_range_images, nrof_range_failed, shard in decode_parallel(tasks, args):
+                if writer is not None:
+                    append_shard(writer, shard)
+                    writer.commit()
+                tsv_file, start, end = task
+                progress.write(json.dumps({'file': tsv_file, 'start': start, 'end': end,
+                                           'images': nrof_range_images, 'failed': nrof_range_failed}) + '\n')
+                progress.flush()
+                nrof_ranges += 1
+                nrof_bytes += end - start
+                nrof_images += nrof_range_images
+                nrof_failed += nrof_range_failed
+                now = time.time()
+                if now - last_report >= args.progress_interval or nrof_ranges == len(tasks):
+                    last_report = now
+                    elapsed = max(now - start_time, 1e-9)
+                    rate = nrof_bytes / elapsed
+                    print('%d/%d ranges, %d images (%d undecodable), %.1f images/s, %.1f MB/s, ETA %.0f s' % (
+                        nrof_ranges, len(tasks), nrof_images, nrof_failed, nrof_images / elapsed,
+                        rate / 2**20, (nrof_bytes_total - nrof_bytes) / max(rate, 1e-9)))
+                    sys.stdout.flush()
+    finally:
+        if writer is not None:
+            writer.close()
+            shutil.rmtree(os.path.join(output_dir, RANGES_DIR), ignore_errors=True)
+    return nrof_images, nrof_failed
+
+
+def parse_arguments(argv):
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('output_dir', type=str, help='Output base directory for the image dataset')
-    parser.add_argument('tsv_files', type=argparse.FileType('r'), nargs='+', help='Input TSV file name(s)')
+    parser.add_argument('output_dir', type=str,
+        help='Output base directory for the image dataset, or the packed dataset directory with --packed')
+    parser.add_argument('tsv_files', type=str, nargs='+', help='Input TSV file name(s)')
     parser.add_argument('--size', type=int, help='Images are resized to the given size')
     parser.add_argument('--output_format', type=str, help='Format of the output images', default='png', choices=['png', 'jpg'])
+    parser.add_argument('--workers', type=int,
+        help='Number of decoding processes.', default=1)
+    parser.add_argument('--chunk_size', type=float,
+        help='Size in MB of the byte ranges handed to the workers; keep it when resuming a run.', default=64)
+    parser.add_argument('--shards', type=int,
+        help='Spread the class directories over this many numbered subdirectories (0: no sharding).', default=0)
+    parser.add_argument('--packed',
+        help='Write a packed dataset (requires --size) instead of image files.', action='store_true')
+    parser.add_argument('--progress_interval', type=float,
+        help='Seconds between throughput reports.', default=10.0)
+    args = parser.parse_args(argv)
+    if args.packed and not args.size:
+        parser.error('--packed requires --size')
+    if args.packed and args.shards:
+        parser.error('--shards does not apply to --packed')
+    return args
 
-    main(parser.parse_args())
 
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""Exports an inference-only version of a frozen FaceNet graph.
+
+The frozen training graph (e.g. 20180402-114759.pb produced by freeze_graph.py) still
+contains the phase_train switch, the training branch of every batch norm, un-fused
+batch norm ops and the input queue kept alive by the 'label_batch' output. This tool
+fixes phase_train to False, replaces the input with a NHWC float32 placeholder, prunes
+everything that 'embeddings' does not depend on, folds constants (which removes the
+dead Switch/Merge training branches) and folds batch norm into the preceding
+convolutions. The result loads with facenet.load_model() like any other frozen graph.
+
+With --lfw_dir the original and the exported graph are run on the same LFW pairs and
+the embedding difference and verification accuracy of both are reported.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2, tensor_shape_pb2, types_pb2
+from tensorflow.core.protobuf import config_pb2
+from tensorflow.python.grappler import tf_optimizer
+from tensorflow.python.tools import optimize_for_inference_lib
+
+import facenet
+import packed_dataset
+
+
+def main(args):
+    with tf.io.gfile.GFile(os.path.expanduser(args.input_file), 'rb') as f:
+        input_graph_def = tf.compat.v1.GraphDef()
+        input_graph_def.ParseFromString(f.read())
+
+    output_graph_def = optimize_graph_def(input_graph_def, args.image_size,
+        input_name=args.input_name, output_name=args.output_name)
+
+    with tf.io.gfile.GFile(os.path.expanduser(args.output_file), 'wb') as f:
+        f.write(output_graph_def.SerializeToString())
+    print('%d ops in the input graph, %d ops in the inference graph: %s' % (
+        len(input_graph_def.node), len(output_graph_def.node), args.output_file))
+
+    if args.lfw_dir:
+        import lfw
+        pairs = lfw.read_pairs(os.path.expanduser(args.lfw_pairs))
+        if args.lfw_nrof_pairs > 0:
+            pairs = pairs[:args.lfw_nrof_pairs]
+        paths, actual_issame = lfw.get_paths(os.path.expanduser(args.lfw_dir), pairs)
+        stats = check_parity(args.input_file, args.output_file, paths, actual_issame,
+            args.lfw_batch_size, args.image_size)
+        print('Max abs embedding difference: %.2e' % stats['max_abs_diff'])
+        print('Min cosine similarity: %.6f' % stats['min_cosine'])
+        print('Accuracy original: %2.5f, exported: %2.5f' % (stats['accuracy_original'], stats['accuracy_exported']))
+        if stats['max_abs_diff'] > args.tolerance:
+            print('Embeddings differ by more than %g' % args.tolerance)
+            sys.exit(1)
+
+
+def optimize_graph_def(input_graph_def, image_size, input_name='input', output_name='embeddings'):
+    """Returns an inference-only copy of a frozen FaceNet graph def"""
+    graph_def = tf.compat.v1.GraphDef()
+    graph_def.CopyFrom(input_graph_def)
+
+    node_names = set(node.name for node in graph_def.node)
+    if input_name not in node_names or output_name not in node_names:
+        raise ValueError('Graph must contain the nodes "%s" and "%s"' % (input_name, output_name))
+
+    for node in graph_def.node:
+        if node.name == 'phase_train':
+            _make_const_false(node)
+        elif node.name == input_name:
+            _make_image_placeholder(node, image_size)
+
+    # Drop the input queue, label_batch and anything else embeddings does not need
+    graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph_def, [output_name])
+
+    # With phase_train constant the training branches of every cond are dead;
+    # constant folding plus the loop optimizer remove the Switch/Merge pairs
+    graph_def = _fold_constants(graph_def, output_name)
+
+    # Fold FusedBatchNorm into the preceding Conv2D weights
+    graph_def = optimize_for_inference_lib.optimize_for_inference(
+        graph_def, [input_name], [output_name], types_pb2.DT_FLOAT)
+    return graph_def
+
+
+def _make_const_false(node):
+    del node.input[:]
+    node.op = 'Const'
+    node.attr.clear()
+    node.attr['dtype'].CopyFrom(attr_value_pb2.AttrValue(type=types_pb2.DT_BOOL))
+    node.attr['value'].CopyFrom(attr_value_pb2.AttrValue(tensor=tf.make_tensor_proto(False)))
+
+
+def _make_image_placeholder(node, image_size):
+    del node.input[:]
+    node.op = 'Placeholder'
+    node.attr.clear()
+    dims = [tensor_shape_pb2.TensorShapeProto.Dim(size=size) for size in (-1, image_size, image_size, 3)]
+    node.attr['dtype'].CopyFrom(attr_value_pb2.AttrValue(type=types_pb2.DT_FLOAT))
+    node.attr['shape'].CopyFrom(attr_value_pb2.AttrValue(shape=tensor_shape_pb2.TensorShapeProto(dim=dims)))
+
+
+def _fold_constants(graph_def, output_name):
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        meta_graph = tf.compat.v1.train.export_meta_graph(graph_def=graph.as_graph_def(), graph=graph)
+    # Grappler keeps every node listed in the train_op collection
+    meta_graph.collection_def['train_op'].node_list.value.extend([output_name])
+
+    config = config_pb2.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_options.optimizers.extend(['constfold', 'loop', 'dependency', 'constfold'])
+    rewrite_options.min_graph_nodes = -1
+    return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def compute_embeddings(model_file, paths, batch_size, image_size):
+    with tf.Graph().as_default() as graph:
+        with tf.compat.v1.Session() as sess:
+            facenet.load_model(model_file)
+            images_placeholder, embeddings, phase_train_placeholder = facenet.get_embedding_tensors(graph)
+            emb_array = np.zeros((len(paths), int(embeddings.get_shape()[1])), dtype=np.float32)
+            for start_index in range(0, len(paths), batch_size):
+                end_index = min(start_index + batch_size, len(paths))
+                images = packed_dataset.load_data(paths[start_index:end_index], False, False, image_size)
+                feed_dict = facenet.embedding_feed_dict(images_placeholder, phase_train_placeholder, images)
+                emb_array[start_index:end_index, :] = sess.run(embeddings, feed_dict=feed_dict)
+    return emb_array
+
+
+def check_parity(original_file, exported_file, paths, actual_issame, batch_size, image_size, nrof_folds=10):
+    """Embeds LFW-style pairs with both graphs and compares the results"""
+    import lfw
+    emb_original = compute_embeddings(original_file, paths, batch_size, image_size)
+    emb_exported = compute_embeddings(exported_file, paths, batch_size, image_size)
+
+    cosine = np.sum(emb_original * emb_exported, axis=1) / (
+        np.linalg.norm(emb_original, axis=1) * np.linalg.norm(emb_exported, axis=1))
+    nrof_folds = min(nrof_folds, len(actual_issame))
+    _, _, accuracy_original, _, _, _ = lfw.evaluate(emb_original, actual_issame, nrof_folds=nrof_folds)
+    _, _, accuracy_exported, _, _, _ = lfw.evaluate(emb_exported, actual_issame, nrof_folds=nrof_folds)
+    return {
+        'max_abs_diff': float(np.max(np.abs(emb_original - emb_exported))),
+        'min_cosine': float(np.min(cosine)),
+        'accuracy_original': float(np.mean(accuracy_original)),
+        'accuracy_exported': float(np.mean(accuracy_exported)),
+    }
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('input_file', type=str,
+        help='Frozen training graph (.pb), e.g. the output of freeze_graph.py')
+    parser.add_argument('output_file', type=str,
+        help='Filename for the exported inference graph (.pb)')
+    parser.add_argument('--image_size', type=int,
+        help='Image size (height, width) of the fixed NHWC float32 input.', default=160)
+    parser.add_argument('--input_name', type=str,
+        help='Name of the image input node.', default='input')
+    parser.add_argument('--output_name', type=str,
+        help='Name of the embeddings output node.', default='embeddings')
+    parser.add_argument('--lfw_dir', type=str,
+        help='Path to aligned LFW face patches, or a packed dataset. When given, runs a parity check of both graphs.')
+    parser.add_argument('--lfw_pairs', type=str,
+        help='The file containing the pairs to use for the parity check.', default='data/pairs.txt')
+    parser.add_argument('--lfw_nrof_pairs', type=int,
+        help='Only use the first N pairs for the parity check (0 = all).', default=0)
+    parser.add_argument('--lfw_batch_size', type=int,
+        help='Number of images to process in a batch during the parity check.', default=100)
+    parser.add_argument('--tolerance', type=float,
+        help='Maximum allowed absolute embedding difference in the parity check.', default=1e-4)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -29,18 +29,18 @@ from __future__ import print_function
 
 import os
 from subprocess import Popen, PIPE
-import tensorflow as tf
 import numpy as np
 from scipy import misc
 from sklearn.model_selection import KFold
 from scipy import interpolate
-from tensorflow.python.training import training
 import random
 import re
-from tensorflow.python.platform import gfile
 import math
 from six import iteritems
 
+# TensorFlow is imported by the functions that build or load graphs, so the image
+# helpers can be used (e.g. by the onnxruntime service) without the TF runtime
+
 def triplet_loss(anchor, positive, negative, alpha):
     """Calculate the triplet loss according to the FaceNet paper
     
@@ -52,6 +52,7 @@ def triplet_loss(anchor, positive, negative, alpha):
     Returns:
       the triplet loss according to the FaceNet paper as a float tensor.
     """
+    import tensorflow as tf
     with tf.variable_scope('triplet_loss'):
         pos_dist = tf.reduce_sum(tf.square(tf.subtract(anchor, positive)), 1)
         neg_dist = tf.reduce_sum(tf.square(tf.subtract(anchor, negative)), 1)
@@ -65,6 +66,7 @@ def center_loss(features, label, alfa, nrof_classes):
     """Center loss based on the paper "A Discriminative Feature Learning Approach for Deep Face Recognition"
        (http://ydwen.github.io/papers/WenECCV16.pdf)
     """
+    import tensorflow as tf
     nrof_features = features.get_shape()[1]
     centers = tf.get_variable('centers', [nrof_classes, nrof_features], dtype=tf.float32,
         initializer=tf.constant_initializer(0), trainable=False)
@@ -100,14 +102,19 @@ RANDOM_CROP = 2
 RANDOM_FLIP = 4
 FIXED_STANDARDIZATION = 8
 FLIP = 16
-def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder):
+def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder, read_image=None):
+    # read_image(filename) returns the uint8 image tensor, e.g. packed_dataset.read_image; decodes the file by default
+    import tensorflow as tf
     images_and_labels_list = []
     for _ in range(nrof_preprocess_threads):
         filenames, label, control = input_queue.dequeue()
         images = []
         for filename in tf.unstack(filenames):
-            file_contents = tf.read_file(filename)
-            image = tf.image.decode_image(file_contents, 3)
+            if read_image is not None:
+                image = read_image(filename)
+            else:
+                file_contents = tf.read_file(filename)
+                image = tf.image.decode_image(file_contents, 3)
             image = tf.cond(get_control_flag(control[0], RANDOM_ROTATE),
                             lambda:tf.py_func(random_rotate_image, [image], tf.uint8), 
                             lambda:tf.identity(image))
@@ -137,6 +144,7 @@ def create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batc
     return image_batch, label_batch
 
 def get_control_flag(control, field):
+    import tensorflow as tf
     return tf.equal(tf.mod(tf.floor_div(control, field), 2), 1)
   
 def _add_loss_summaries(total_loss):
@@ -150,6 +158,7 @@ def _add_loss_summaries(total_loss):
     Returns:
       loss_averages_op: op for generating moving averages of losses.
     """
+    import tensorflow as tf
     # Compute the moving average of all individual losses and the total loss.
     loss_averages = tf.train.ExponentialMovingAverage(0.9, name='avg')
     losses = tf.get_collection('losses')
@@ -166,6 +175,7 @@ def _add_loss_summaries(total_loss):
     return loss_averages_op
 
 def train(total_loss, global_step, optimizer, learning_rate, moving_average_decay, update_gradient_vars, log_histograms=True):
+    import tensorflow as tf
     # Generate moving averages of all losses and associated summaries.
     loss_averages_op = _add_loss_summaries(total_loss)
 
@@ -368,6 +378,7 @@ def split_dataset(dataset, split_ratio, min_nrof_images_per_class, mode):
 def load_model(model, input_map=None):
     # Check if the model is a model directory (containing a metagraph and a checkpoint file)
     #  or if it is a protobuf file with a frozen graph
+    import tensorflow as tf
     model_exp = os.path.expanduser(model)
     if (os.path.isfile(model_exp)):
         print('Model filename: %s' % model_exp)
@@ -385,7 +396,26 @@ def load_model(model, input_map=None):
         saver = tf.train.import_meta_graph(os.path.join(model_exp, meta_file), input_map=input_map)
         saver.restore(tf.get_default_session(), os.path.join(model_exp, ckpt_file))
     
+def get_embedding_tensors(graph):
+    """Returns (images_placeholder, embeddings, phase_train_placeholder) of a loaded model.
+    phase_train_placeholder is None for inference-only graphs exported by export_inference_graph.py
+    """
+    images_placeholder = graph.get_tensor_by_name("input:0")
+    embeddings = graph.get_tensor_by_name("embeddings:0")
+    try:
+        phase_train_placeholder = graph.get_tensor_by_name("phase_train:0")
+    except KeyError:
+        phase_train_placeholder = None
+    return images_placeholder, embeddings, phase_train_placeholder
+
+def embedding_feed_dict(images_placeholder, phase_train_placeholder, images):
+    feed_dict = { images_placeholder:images }
+    if phase_train_placeholder is not None:
+        feed_dict[phase_train_placeholder] = False
+    return feed_dict
+
 def get_model_filenames(model_dir):
+    import tensorflow as tf
     files = os.listdir(model_dir)
     meta_files = [s for s in files if s.endswith('.meta')]
     if len(meta_files)==0:
@@ -496,7 +526,9 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
         for threshold_idx, threshold in enumerate(thresholds):
             _, far_train[threshold_idx] = calculate_val_far(threshold, dist[train_set], actual_issame[train_set])
         if np.max(far_train)>=far_target:
-            f = interpolate.interp1d(far_train, thresholds, kind='slinear')
+            # FAR is flat over ranges of thresholds; keep the smallest threshold per FAR value
+            far_unique, unique_idx = np.unique(far_train, return_index=True)
+            f = interpolate.interp1d(far_unique, thresholds[unique_idx], kind='slinear')
             threshold = f(far_target)
         else:
             threshold = 0.0
@@ -520,6 +552,7 @@ def calculate_val_far(threshold, dist, actual_issame):
     return val, far
 
 def store_revision_info(src_path, output_dir, arg_string):
+    import tensorflow as tf
     try:
         # Get git hash
         cmd = ['git', 'rev-parse', 'HEAD']
@@ -547,6 +580,7 @@ def store_revision_info(src_path, output_dir, arg_string):
         text_file.write('%s' % git_diff)
 
 def list_variables(filename):
+    from tensorflow.python.training import training
     reader = training.NewCheckpointReader(filename)
     variable_map = reader.get_variable_to_shape_map()
     names = sorted(variable_map.keys())
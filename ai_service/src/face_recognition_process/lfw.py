@@ -30,6 +30,7 @@ from __future__ import print_function
 import os
 import numpy as np
 import facenet
+import packed_dataset
 
 def evaluate(embeddings, actual_issame, nrof_folds=10, distance_metric=0, subtract_mean=False):
     # Calculate evaluation metrics
@@ -43,7 +44,15 @@ def evaluate(embeddings, actual_issame, nrof_folds=10, distance_metric=0, subtra
         np.asarray(actual_issame), 1e-3, nrof_folds=nrof_folds, distance_metric=distance_metric, subtract_mean=subtract_mean)
     return tpr, fpr, accuracy, val, val_std, far
 
+def calculate_eer(fpr, tpr):
+    """Equal error rate of a ROC curve as returned by evaluate()"""
+    from scipy.optimize import brentq
+    from scipy import interpolate
+    return brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
+
 def get_paths(lfw_dir, pairs):
+    if packed_dataset.is_packed(lfw_dir):
+        return get_packed_paths(packed_dataset.open_packed(lfw_dir), pairs)
     nrof_skipped_pairs = 0
     path_list = []
     issame_list = []
@@ -66,6 +75,29 @@ def get_paths(lfw_dir, pairs):
     
     return path_list, issame_list
   
+def get_packed_paths(dataset, pairs):
+    """get_paths for a packed LFW: references of the pair images, which were packed from name/name_NNNN.(jpg|png)"""
+    def find(name, number):
+        stem = '%s/%s_%04d' % (name, name, int(number))
+        return dataset.ref_of(stem + '.jpg') or dataset.ref_of(stem + '.png')
+
+    nrof_skipped_pairs = 0
+    path_list = []
+    issame_list = []
+    for pair in pairs:
+        if len(pair) == 3:
+            path0, path1, issame = find(pair[0], pair[1]), find(pair[0], pair[2]), True
+        else:
+            path0, path1, issame = find(pair[0], pair[1]), find(pair[2], pair[3]), False
+        if path0 and path1:
+            path_list += (path0, path1)
+            issame_list.append(issame)
+        else:
+            nrof_skipped_pairs += 1
+    if nrof_skipped_pairs>0:
+        print('Skipped %d image pairs' % nrof_skipped_pairs)
+    return path_list, issame_list
+
 def add_extension(path):
     if os.path.exists(path+'.jpg'):
         return path+'.jpg'
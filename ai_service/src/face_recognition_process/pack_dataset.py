@@ -0,0 +1,45 @@
+"""Pack an aligned dataset into one memory-mapped array (``packed_dataset.py``).
+
+    python src/face_recognition_process/pack_dataset.py Dataset/FaceData/processed Dataset/FaceData/processed.packed
+
+Rerunning it on a grown tree only appends the images that are not packed yet.
+The output directory can then be passed wherever an aligned dataset directory
+is expected (``classifier.py``, ``train_softmax.py``, ``train_tripletloss.py``,
+``calculate_filtering_metrics.py``, and ``validate_on_lfw.py`` for ``--lfw_dir``).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import packed_dataset
+
+
+def main(args):
+    start = time.time()
+    image_size = (args.image_size, args.image_size) if args.image_size else None
+    added, skipped = packed_dataset.pack(args.input_dir, args.output_dir, image_size, args.commit_interval)
+    elapsed = time.time() - start
+    dataset = packed_dataset.PackedDataset(args.output_dir)
+    print('Packed %d new images (%d already packed) in %.1f s, %.0f images/s' % (
+        added, skipped, elapsed, added / max(elapsed, 1e-9)))
+    print('%s: %d images of %d classes, %dx%d' % (
+        args.output_dir, len(dataset), len(dataset.classes), dataset.image_size[0], dataset.image_size[1]))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_dir', type=str, help='Directory with aligned face images, one folder per class.')
+    parser.add_argument('output_dir', type=str, help='Packed dataset directory to create or append to.')
+    parser.add_argument('--image_size', type=int, default=0,
+        help='Expected image size (height and width) in pixels; the first image decides by default.')
+    parser.add_argument('--commit_interval', type=int, default=1000,
+        help='Publish the appended images every this many images, so an interrupted run keeps them.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
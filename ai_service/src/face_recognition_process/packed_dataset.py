@@ -0,0 +1,276 @@
+"""Packed, memory-mapped aligned-face dataset.
+
+A packed dataset is a directory holding every aligned image of a ``processed/``
+tree in one array, so training and evaluation read pixels instead of decoding
+a PNG per image and epoch::
+
+    meta.json     {"version", "image_size": [H, W], "count", "classes", "paths_bytes"}
+    images.u8     uint8 (count, H, W, 3) RGB, C order, mapped with np.memmap
+    labels.i32    int32 (count,) index into meta["classes"]
+    paths.txt     the path of each image relative to the packed tree, one per line
+
+``meta.json`` is the commit point: it is replaced atomically after the array
+files are flushed, and rows past its ``count`` (left by an interrupted append)
+are truncated by the next writer. Appending keeps existing rows in place, so a
+grown ``processed/`` tree is packed incrementally (``pack_dataset.py``).
+
+Consumers keep working on lists of image "paths". ``get_dataset`` returns the
+usual ``facenet.ImageClass`` list with references of the form
+``packed:<dataset dir>:<row>`` as paths; ``load_data`` and the ``read_image``
+graph op read a reference from the memory map and decode anything else from
+its file, so packed and plain datasets (e.g. an unpacked LFW) can be mixed.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import facenet
+
+META = "meta.json"
+IMAGES = "images.u8"
+LABELS = "labels.i32"
+PATHS = "paths.txt"
+FORMAT_VERSION = 1
+REF_PREFIX = "packed:"
+
+
+def is_packed(path):
+    return os.path.isfile(os.path.join(os.path.expanduser(path), META))
+
+
+def ref(path, row):
+    return "%s%s:%d" % (REF_PREFIX, path, row)
+
+
+def is_ref(path):
+    if isinstance(path, bytes):
+        return path.startswith(REF_PREFIX.encode("utf-8"))
+    return path.startswith(REF_PREFIX)
+
+
+def parse_ref(reference):
+    """(dataset dir, row) of a reference"""
+    if isinstance(reference, bytes):
+        reference = reference.decode("utf-8")
+    path, _, row = reference[len(REF_PREFIX):].rpartition(":")
+    return path, int(row)
+
+
+def read_meta(path):
+    with open(os.path.join(path, META), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError("%s: unsupported packed dataset version %r" % (path, meta.get("version")))
+    return meta
+
+
+class PackedDataset(object):
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        meta = read_meta(self.path)
+        self.count = meta["count"]
+        self.image_size = tuple(meta["image_size"] or (0, 0))
+        self.classes = list(meta["classes"])
+        shape = (self.count,) + self.image_size + (3,)
+        if self.count:
+            self.images = np.memmap(os.path.join(self.path, IMAGES), dtype=np.uint8, mode="r", shape=shape)
+        else:
+            self.images = np.zeros(shape, dtype=np.uint8)
+        self.labels = np.fromfile(os.path.join(self.path, LABELS), dtype="<i4", count=self.count)
+        with open(os.path.join(self.path, PATHS), "rb") as f:
+            self.paths = f.read(meta["paths_bytes"]).decode("utf-8").split("\n")[:self.count]
+        self._rows = None
+
+    def __len__(self):
+        return self.count
+
+    def get_dataset(self):
+        """``facenet.ImageClass`` list (classes sorted by name, like ``facenet.get_dataset``) of references"""
+        order = np.argsort(self.labels, kind="stable")
+        bounds = np.searchsorted(self.labels[order], np.arange(len(self.classes) + 1))
+        dataset = []
+        for label in sorted(range(len(self.classes)), key=lambda label: self.classes[label]):
+            rows = order[bounds[label]:bounds[label + 1]]
+            if len(rows):
+                dataset.append(facenet.ImageClass(self.classes[label], [ref(self.path, row) for row in rows]))
+        return dataset
+
+    def ref_of(self, relative_path):
+        """Reference of the image packed from ``relative_path``, or None"""
+        if self._rows is None:
+            self._rows = {path: row for row, path in enumerate(self.paths)}
+        row = self._rows.get(relative_path.replace(os.sep, "/"))
+        return ref(self.path, row) if row is not None else None
+
+
+_open_datasets = {}
+
+
+def open_packed(path):
+    """PackedDataset of ``path``, opened once per process"""
+    dataset = _open_datasets.get(path)
+    if dataset is None:
+        dataset = _open_datasets[path] = PackedDataset(path)
+    return dataset
+
+
+def get_dataset(path, has_class_directories=True):
+    """``facenet.get_dataset`` that also accepts a packed dataset directory"""
+    if is_packed(path):
+        return open_packed(os.path.expanduser(path)).get_dataset()
+    return facenet.get_dataset(path, has_class_directories)
+
+
+def read_ref(reference):
+    """uint8 (H, W, 3) image of a reference (a view of the memory map)"""
+    path, row = parse_ref(reference)
+    return open_packed(path).images[row]
+
+
+def load_image(path):
+    """uint8 RGB image of a reference or an image file"""
+    if is_ref(path):
+        return read_ref(path)
+    import imageio
+    img = imageio.imread(path)
+    if img.ndim == 2:
+        img = facenet.to_rgb(img)
+    return img[:, :, :3]
+
+
+def load_data(image_paths, do_random_crop, do_random_flip, image_size, do_prewhiten=True):
+    """``facenet.load_data`` reading references from the memory map"""
+    images = np.zeros((len(image_paths), image_size, image_size, 3))
+    for i, path in enumerate(image_paths):
+        img = load_image(path)
+        if do_prewhiten:
+            img = facenet.prewhiten(img)
+        img = facenet.crop(img, do_random_crop, image_size)
+        img = facenet.flip(img, do_random_flip)
+        images[i, :, :, :] = img
+    return images
+
+
+def read_image(filename):
+    """Graph op for ``facenet.create_input_pipeline``: a reference from the memory map, else the decoded file"""
+    def read_packed():
+        image = tf.compat.v1.py_func(lambda reference: np.ascontiguousarray(read_ref(reference)), [filename],
+                                     tf.uint8, stateful=False)
+        image.set_shape([None, None, 3])
+        return image
+
+    def decode_file():
+        return tf.image.decode_image(tf.io.read_file(filename), 3)
+
+    return tf.cond(tf.equal(tf.strings.substr(filename, 0, len(REF_PREFIX)), REF_PREFIX), read_packed, decode_file)
+
+
+class PackedWriter(object):
+    """Appends images to a packed dataset; ``commit`` publishes them"""
+
+    def __init__(self, path, image_size=None):
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        if is_packed(self.path):
+            meta = read_meta(self.path)
+            if image_size is not None and tuple(image_size) != tuple(meta["image_size"]):
+                raise ValueError("%s holds %s images, not %s" % (self.path, meta["image_size"], image_size))
+        else:
+            meta = {"version": FORMAT_VERSION, "image_size": list(image_size) if image_size else None,
+                    "count": 0, "classes": [], "paths_bytes": 0}
+        self.meta = meta
+        self.count = meta["count"]
+        self.classes = list(meta["classes"])
+        self._labels = {name: label for label, name in enumerate(self.classes)}
+        self._paths_bytes = meta["paths_bytes"]
+        self._files = {}
+        row_bytes = self._row_bytes()
+        # Drop rows an interrupted writer appended after the last commit
+        for name, size in ((IMAGES, self.count * row_bytes), (LABELS, self.count * 4), (PATHS, self._paths_bytes)):
+            f = open(os.path.join(self.path, name), "ab")
+            f.truncate(size)
+            self._files[name] = f
+        with open(os.path.join(self.path, PATHS), "rb") as f:
+            self.known = set(f.read(self._paths_bytes).decode("utf-8").split("\n")[:self.count])
+
+    def _row_bytes(self):
+        size = self.meta["image_size"]
+        return size[0] * size[1] * 3 if size else 0
+
+    def append(self, class_name, relative_path, image):
+        """Append one uint8 RGB image; False if ``relative_path`` is already packed"""
+        relative_path = relative_path.replace(os.sep, "/")
+        if relative_path in self.known:
+            return False
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if self.meta["image_size"] is None:
+            self.meta["image_size"] = [image.shape[0], image.shape[1]]
+        if image.shape != tuple(self.meta["image_size"]) + (3,):
+            raise ValueError("%s: %s image, the packed dataset holds %s RGB images"
+                             % (relative_path, image.shape, tuple(self.meta["image_size"])))
+        label = self._labels.get(class_name)
+        if label is None:
+            label = self._labels[class_name] = len(self.classes)
+            self.classes.append(class_name)
+        line = relative_path.encode("utf-8") + b"\n"
+        self._files[IMAGES].write(image.tobytes())
+        self._files[LABELS].write(np.int32(label).astype("<i4").tobytes())
+        self._files[PATHS].write(line)
+        self._paths_bytes += len(line)
+        self.count += 1
+        self.known.add(relative_path)
+        return True
+
+    def commit(self):
+        """Flush the appended rows and publish them in ``meta.json``"""
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta.update(count=self.count, classes=self.classes, paths_bytes=self._paths_bytes)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".meta-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.meta, f)
+            os.replace(tmp_path, os.path.join(self.path, META))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+
+def pack(input_dir, output_dir, image_size=None, commit_interval=1000):
+    """Append the images of an aligned ``input_dir`` tree not packed yet; returns (added, skipped)"""
+    input_dir = os.path.expanduser(input_dir)
+    added = skipped = 0
+    with PackedWriter(output_dir, image_size) as writer:
+        for cls in facenet.get_dataset(input_dir):
+            for path in sorted(cls.image_paths):
+                relative_path = os.path.relpath(path, input_dir).replace(os.sep, "/")
+                if relative_path in writer.known:
+                    skipped += 1
+                    continue
+                writer.append(cls.name, relative_path, load_image(path))
+                added += 1
+                if added % commit_interval == 0:
+                    writer.commit()
+    return added, skipped
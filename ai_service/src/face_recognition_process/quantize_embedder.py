@@ -0,0 +1,199 @@
+"""Post-training INT8 quantization of the ONNX FaceNet embedder with an accuracy gate.
+
+Calibrates static INT8 quantization on a sample of aligned crops (by default the
+service's processed dataset), then embeds verification pairs with the float and the
+INT8 model and compares accuracy, VAL@FAR and EER using lfw.evaluate. Pairs come
+from --lfw_dir/--lfw_pairs, or are sampled from the held-out part of the calibration
+dataset. The INT8 model is only written when the accuracy drop stays within
+--max_accuracy_drop; otherwise it is discarded and the script exits with status 1.
+
+The float model is the facenet.onnx written by convert_to_onnx.py; the output is
+picked up by the onnxruntime backend when FACE_QUANTIZED_EMBEDDER is enabled.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+import facenet
+import lfw
+import packed_dataset
+
+
+class CropCalibrationReader(object):
+    """Feeds prewhitened aligned crops to the onnxruntime calibrator"""
+
+    def __init__(self, input_name, paths, image_size, batch_size):
+        self.input_name = input_name
+        self.paths = paths
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.index = 0
+
+    def get_next(self):
+        if self.index >= len(self.paths):
+            return None
+        batch = self.paths[self.index:self.index + self.batch_size]
+        self.index += self.batch_size
+        images = packed_dataset.load_data(batch, False, False, self.image_size)
+        return {self.input_name: images.astype(np.float32)}
+
+    def rewind(self):
+        self.index = 0
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    dataset = packed_dataset.get_dataset(os.path.expanduser(args.calibration_dir))
+    calibration_paths, holdout = split_calibration_set(dataset, args.nrof_calibration_images, rng)
+    print('Calibrating on %d images from %d classes' % (len(calibration_paths), len(dataset)))
+
+    if args.lfw_dir:
+        pairs = lfw.read_pairs(os.path.expanduser(args.lfw_pairs))
+        paths, actual_issame = lfw.get_paths(os.path.expanduser(args.lfw_dir), pairs)
+    else:
+        paths, actual_issame = sample_pairs(holdout, args.nrof_pairs, rng)
+    print('Evaluating on %d pairs' % len(actual_issame))
+
+    report = quantize(args.float_model, args.output_model, calibration_paths, paths, actual_issame,
+        args.image_size, args.batch_size, args.max_accuracy_drop, per_channel=not args.per_tensor)
+
+    for key in ('accuracy', 'val', 'far', 'eer'):
+        print('%-8s float %.5f  int8 %.5f  delta %+.5f' % (key, report['float'][key], report['int8'][key],
+            report['int8'][key] - report['float'][key]))
+    if not report['accepted']:
+        print('Rejected: accuracy dropped by %.5f (max %.5f), %s not written' % (
+            report['accuracy_drop'], args.max_accuracy_drop, args.output_model))
+        sys.exit(1)
+    print('Saved INT8 model to %s' % args.output_model)
+
+
+def split_calibration_set(dataset, nrof_calibration_images, rng):
+    """Samples calibration images across classes; returns (calibration_paths, holdout_dataset)"""
+    paths, labels = facenet.get_image_paths_and_labels(dataset)
+    order = list(range(len(paths)))
+    rng.shuffle(order)
+    calibration = set(order[:nrof_calibration_images])
+    holdout = [facenet.ImageClass(cls.name, []) for cls in dataset]
+    for i, (path, label) in enumerate(zip(paths, labels)):
+        if i not in calibration:
+            holdout[label].image_paths.append(path)
+    return [paths[i] for i in sorted(calibration)], holdout
+
+
+def sample_pairs(dataset, nrof_pairs, rng):
+    """Alternating genuine/impostor pairs in the flat layout lfw.evaluate expects"""
+    classes = [cls for cls in dataset if len(cls.image_paths) > 0]
+    multi = [cls for cls in classes if len(cls.image_paths) > 1]
+    if not multi or len(classes) < 2:
+        raise ValueError('Need at least two classes and one class with two images to sample pairs')
+    paths = []
+    actual_issame = []
+    for i in range(nrof_pairs):
+        if i % 2 == 0:
+            cls = rng.choice(multi)
+            paths += rng.sample(cls.image_paths, 2)
+            actual_issame.append(True)
+        else:
+            cls1, cls2 = rng.sample(classes, 2)
+            paths += [rng.choice(cls1.image_paths), rng.choice(cls2.image_paths)]
+            actual_issame.append(False)
+    return paths, actual_issame
+
+
+def quantize(float_model, output_model, calibration_paths, paths, actual_issame, image_size=160,
+             batch_size=32, max_accuracy_drop=0.005, per_channel=True, nrof_folds=10):
+    import onnxruntime as ort
+    from onnxruntime import quantization
+
+    input_name = ort.InferenceSession(float_model, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    reader = CropCalibrationReader(input_name, calibration_paths, image_size, batch_size)
+
+    output_dir = os.path.dirname(os.path.abspath(output_model))
+    fd, tmp_model = tempfile.mkstemp(suffix='.onnx', dir=output_dir)
+    os.close(fd)
+    try:
+        quantization.quantize_static(float_model, tmp_model, reader,
+            quant_format=quantization.QuantFormat.QDQ, per_channel=per_channel,
+            activation_type=quantization.QuantType.QInt8, weight_type=quantization.QuantType.QInt8,
+            calibrate_method=quantization.CalibrationMethod.MinMax)
+
+        nrof_folds = min(nrof_folds, len(actual_issame))
+        report = {
+            'float': evaluate_model(float_model, paths, actual_issame, image_size, batch_size, nrof_folds),
+            'int8': evaluate_model(tmp_model, paths, actual_issame, image_size, batch_size, nrof_folds),
+            'nrof_calibration_images': len(calibration_paths),
+            'nrof_pairs': len(actual_issame),
+            'max_accuracy_drop': max_accuracy_drop,
+        }
+        report['accuracy_drop'] = report['float']['accuracy'] - report['int8']['accuracy']
+        report['accepted'] = bool(report['accuracy_drop'] <= max_accuracy_drop)
+        if report['accepted']:
+            os.replace(tmp_model, output_model)
+            with open(os.path.splitext(output_model)[0] + '.json', 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if os.path.exists(tmp_model):
+            os.remove(tmp_model)
+    return report
+
+
+def evaluate_model(model_file, paths, actual_issame, image_size, batch_size, nrof_folds):
+    import onnxruntime as ort
+    session = ort.InferenceSession(model_file, providers=['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    batches = []
+    for start_index in range(0, len(paths), batch_size):
+        images = packed_dataset.load_data(paths[start_index:start_index + batch_size], False, False, image_size)
+        batches.append(session.run(None, {input_name: images.astype(np.float32)})[0])
+    embeddings = np.concatenate(batches, axis=0)
+    tpr, fpr, accuracy, val, val_std, far = lfw.evaluate(embeddings, actual_issame, nrof_folds=nrof_folds)
+    return {
+        'accuracy': float(np.mean(accuracy)),
+        'val': float(val),
+        'far': float(far),
+        'eer': float(lfw.calculate_eer(fpr, tpr)),
+    }
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('float_model', type=str,
+        help='Float FaceNet ONNX model, e.g. Models/onnx/facenet.onnx')
+    parser.add_argument('output_model', type=str,
+        help='Where to write the INT8 model, e.g. Models/onnx/facenet_int8.onnx')
+    parser.add_argument('--calibration_dir', type=str,
+        help='Aligned face crops used for calibration, or a packed dataset (pack_dataset.py).', default='Dataset/FaceData/processed')
+    parser.add_argument('--nrof_calibration_images', type=int,
+        help='Number of crops sampled for calibration.', default=500)
+    parser.add_argument('--lfw_dir', type=str,
+        help='Aligned LFW face patches (or a packed dataset) used for the accuracy gate. Defaults to pairs sampled from the calibration dataset.')
+    parser.add_argument('--lfw_pairs', type=str,
+        help='The file containing the LFW pairs.', default='data/pairs.txt')
+    parser.add_argument('--nrof_pairs', type=int,
+        help='Number of pairs sampled when --lfw_dir is not given.', default=600)
+    parser.add_argument('--max_accuracy_drop', type=float,
+        help='Reject the INT8 model if verification accuracy drops by more than this.', default=0.005)
+    parser.add_argument('--per_tensor',
+        help='Quantize weights per tensor instead of per channel.', action='store_true')
+    parser.add_argument('--image_size', type=int,
+        help='Image size (height, width) in pixels.', default=160)
+    parser.add_argument('--batch_size', type=int,
+        help='Number of images to process in a batch.', default=32)
+    parser.add_argument('--seed', type=int,
+        help='Random seed.', default=666)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -37,6 +37,8 @@ import importlib
 import argparse
 import facenet
 import lfw
+import packed_dataset
+import dataset_filter
 import h5py
 import math
 import tensorflow.contrib.slim as slim
@@ -68,10 +70,11 @@ def main(args):
 
     np.random.seed(seed=args.seed)
     random.seed(args.seed)
-    dataset = facenet.get_dataset(args.data_dir)
+    dataset = packed_dataset.get_dataset(args.data_dir)
     if args.filter_filename:
         dataset = filter_dataset(dataset, os.path.expanduser(args.filter_filename), 
-            args.filter_percentile, args.filter_min_nrof_images_per_class)
+            args.filter_percentile, args.filter_min_nrof_images_per_class,
+            os.path.join(log_dir, 'filter_report.json'))
         
     if args.validation_set_split_ratio>0.0:
         train_set, val_set = facenet.split_dataset(dataset, args.validation_set_split_ratio, args.min_nrof_val_images_per_class, 'SPLIT_IMAGES')
@@ -125,7 +128,8 @@ def main(args):
                                     shapes=[(1,), (1,), (1,)],
                                     shared_name=None, name=None)
         enqueue_op = input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='enqueue_op')
-        image_batch, label_batch = facenet.create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder)
+        image_batch, label_batch = facenet.create_input_pipeline(input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder,
+            read_image=packed_dataset.read_image)
 
         image_batch = tf.identity(image_batch, 'image_batch')
         image_batch = tf.identity(image_batch, 'input')
@@ -262,35 +266,13 @@ def main(args):
     
     return model_dir
   
-def find_threshold(var, percentile):
-    hist, bin_edges = np.histogram(var, 100)
-    cdf = np.float32(np.cumsum(hist)) / np.sum(hist)
-    bin_centers = (bin_edges[:-1]+bin_edges[1:])/2
-    #plt.plot(bin_centers, cdf)
-    threshold = np.interp(percentile*0.01, cdf, bin_centers)
-    return threshold
-  
-def filter_dataset(dataset, data_filename, percentile, min_nrof_images_per_class):
-    with h5py.File(data_filename,'r') as f:
-        distance_to_center = np.array(f.get('distance_to_center'))
-        label_list = np.array(f.get('label_list'))
-        image_list = np.array(f.get('image_list'))
-        distance_to_center_threshold = find_threshold(distance_to_center, percentile)
-        indices = np.where(distance_to_center>=distance_to_center_threshold)[0]
-        filtered_dataset = dataset
-        removelist = []
-        for i in indices:
-            label = label_list[i]
-            image = image_list[i]
-            if image in filtered_dataset[label].image_paths:
-                filtered_dataset[label].image_paths.remove(image)
-            if len(filtered_dataset[label].image_paths)<min_nrof_images_per_class:
-                removelist.append(label)
-
-        ix = sorted(list(set(removelist)), reverse=True)
-        for i in ix:
-            del(filtered_dataset[i])
-
+def filter_dataset(dataset, data_filename, percentile, min_nrof_images_per_class, report_filename=None):
+    filtered_dataset, report = dataset_filter.filter_dataset(dataset, data_filename, percentile, min_nrof_images_per_class)
+    print('Filtering removed %d outlier images and %d classes: %d of %d images left (distance threshold %.4f)' % (
+        len(report['removed_images']), len(report['removed_classes']), report['nrof_kept_images'],
+        report['nrof_images'], report['threshold']))
+    if report_filename:
+        dataset_filter.write_report(report, report_filename)
     return filtered_dataset
   
 def train(args, sess, epoch, image_list, label_list, index_dequeue_op, enqueue_op, image_paths_placeholder, labels_placeholder, 
@@ -489,7 +471,7 @@ def parse_arguments(argv):
     parser.add_argument('--pretrained_model', type=str,
         help='Load a pretrained model before training starts.')
     parser.add_argument('--data_dir', type=str,
-        help='Path to the data directory containing aligned face patches.',
+        help='Path to the data directory containing aligned face patches, or a packed dataset (pack_dataset.py).',
         default='~/datasets/casia/casia_maxpy_mtcnnalign_182_160')
     parser.add_argument('--model_def', type=str,
         help='Model definition. Points to a module containing the definition of the inference graph.', default='models.inception_resnet_v1')
@@ -562,7 +544,7 @@ def parse_arguments(argv):
     parser.add_argument('--lfw_pairs', type=str,
         help='The file containing the pairs to use for validation.', default='data/pairs.txt')
     parser.add_argument('--lfw_dir', type=str,
-        help='Path to the data directory containing aligned face patches.', default='')
+        help='Path to the data directory containing aligned face patches, or a packed dataset.', default='')
     parser.add_argument('--lfw_batch_size', type=int,
         help='Number of images to process in a batch in the LFW test set.', default=100)
     parser.add_argument('--lfw_nrof_folds', type=int,
@@ -34,12 +34,11 @@ import numpy as np
 import argparse
 import facenet
 import lfw
+import packed_dataset
 import os
 import sys
 from tensorflow.python.ops import data_flow_ops
 from sklearn import metrics
-from scipy.optimize import brentq
-from scipy import interpolate
 
 def main(args):
   
@@ -66,7 +65,8 @@ def main(args):
                                         shapes=[(1,), (1,), (1,)],
                                         shared_name=None, name=None)
             eval_enqueue_op = eval_input_queue.enqueue_many([image_paths_placeholder, labels_placeholder, control_placeholder], name='eval_enqueue_op')
-            image_batch, label_batch = facenet.create_input_pipeline(eval_input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder)
+            image_batch, label_batch = facenet.create_input_pipeline(eval_input_queue, image_size, nrof_preprocess_threads, batch_size_placeholder,
+                read_image=packed_dataset.read_image)
      
             # Load the model
             input_map = {'image_batch': image_batch, 'label_batch': label_batch, 'phase_train': phase_train_placeholder}
@@ -132,14 +132,14 @@ def evaluate(sess, enqueue_op, image_paths_placeholder, labels_placeholder, phas
     
     auc = metrics.auc(fpr, tpr)
     print('Area Under Curve (AUC): %1.3f' % auc)
-    eer = brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
+    eer = lfw.calculate_eer(fpr, tpr)
     print('Equal Error Rate (EER): %1.3f' % eer)
     
 def parse_arguments(argv):
     parser = argparse.ArgumentParser()
     
     parser.add_argument('lfw_dir', type=str,
-        help='Path to the data directory containing aligned LFW face patches.')
+        help='Path to the data directory containing aligned LFW face patches, or a packed dataset.')
     parser.add_argument('--lfw_batch_size', type=int,
         help='Number of images to process in a batch in the LFW test set.', default=100)
     parser.add_argument('model', type=str, 
@@ -0,0 +1,142 @@
+"""Face alignment for registration with staged fallbacks.
+
+``AlignmentEngine.align`` turns a decoded image into one square crop of the
+largest face, trying progressively cheaper-to-trust strategies:
+
+``mtcnn``
+    The MTCNN box plus a fixed pixel margin, as in ``align_dataset_mtcnn.py``.
+``haar``
+    OpenCV's frontal-face Haar cascade, run on a grayscale copy downscaled to at
+    most ``fallback_max_side`` pixels (the box is scaled back up), plus a
+    relative margin.
+``center``
+    A square center crop, shifted up for portrait images.
+
+The cascade XML is located and parsed once, when the service starts, not per
+image. Every crop carries the strategy that produced it and is counted in
+``face_alignment_crops_total{strategy}``, so the rate of fallbacks is visible
+in ``/metrics``.
+"""
+import logging
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from serving import metrics
+from serving.metrics import time_stage
+
+logger = logging.getLogger("face_recognition_service.alignment")
+
+STRATEGIES = ("mtcnn", "haar", "center")
+
+# image: (image_size, image_size, 3) uint8 RGB; bbox: [x1, y1, x2, y2] of the crop in the source image
+AlignedFace = namedtuple("AlignedFace", ["image", "bbox", "strategy"])
+
+
+def find_cascade(base_dir=""):
+    """Path of haarcascade_frontalface_default.xml shipped with OpenCV (or next to the sources), or None"""
+    candidates = []
+    if getattr(cv2, "data", None) is not None:
+        candidates.append(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    candidates.append(os.path.join(cv2.__path__[0], "data", "haarcascade_frontalface_default.xml"))
+    if base_dir:
+        candidates.append(os.path.join(base_dir, "src", "haarcascade_frontalface_default.xml"))
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_cascade(path):
+    """Parsed ``cv2.CascadeClassifier``, or None (with a warning) if it cannot be loaded"""
+    if not path or getattr(cv2, "CascadeClassifier", None) is None:
+        logger.warning("No Haar cascade available (%s), alignment falls back to center crops", path or "not found")
+        return None
+    cascade = cv2.CascadeClassifier(path)
+    if cascade.empty():
+        logger.warning("Could not load Haar cascade %s, alignment falls back to center crops", path)
+        return None
+    return cascade
+
+
+class AlignmentEngine(object):
+
+    def __init__(self, detect, image_size=160, margin=44, cascade=None, fallback_max_side=640, haar_margin=0.4):
+        """
+        ``detect(rgb_image)`` returns MTCNN (bounding_boxes, points); ``cascade`` is a
+        loaded ``cv2.CascadeClassifier`` (see ``load_cascade``), None skips the Haar stage.
+        """
+        self.detect = detect
+        self.image_size = image_size
+        self.margin = margin
+        self.cascade = cascade
+        self.fallback_max_side = fallback_max_side
+        self.haar_margin = haar_margin
+
+    def align(self, img):
+        """AlignedFace of the largest face in a BGR image (never None for a non-empty image)"""
+        bounding_boxes, _ = self.detect(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        if bounding_boxes.shape[0] > 0:
+            bb = self.mtcnn_box(img, bounding_boxes)
+            strategy = "mtcnn"
+        else:
+            bb = self.haar_box(img) if self.cascade is not None else None
+            strategy = "haar"
+            if bb is None:
+                bb = self.center_box(img)
+                strategy = "center"
+        metrics.ALIGNMENT_CROPS.labels(strategy).inc()
+        return AlignedFace(self.crop(img, bb), bb.tolist(), strategy)
+
+    def mtcnn_box(self, img, bounding_boxes):
+        areas = (bounding_boxes[:, 2] - bounding_boxes[:, 0]) * (bounding_boxes[:, 3] - bounding_boxes[:, 1])
+        det = bounding_boxes[np.argmax(areas), 0:4]
+        bb = np.zeros(4, dtype=np.int32)
+        bb[0] = np.maximum(det[0] - self.margin / 2, 0)
+        bb[1] = np.maximum(det[1] - self.margin / 2, 0)
+        bb[2] = np.minimum(det[2] + self.margin / 2, img.shape[1])
+        bb[3] = np.minimum(det[3] + self.margin / 2, img.shape[0])
+        return bb
+
+    def haar_box(self, img):
+        """Largest Haar detection on a downscaled grayscale copy, in source pixels, or None"""
+        with time_stage("align_fallback"):
+            height, width = img.shape[:2]
+            scale = min(1.0, float(self.fallback_max_side) / max(height, width))
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if scale < 1.0:
+                gray = cv2.resize(gray, (int(round(width * scale)), int(round(height * scale))),
+                                  interpolation=cv2.INTER_AREA)
+            faces = self.cascade.detectMultiScale(gray, 1.1, 5)
+        if len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3]) / scale
+        center_x, center_y = x + w / 2, y + h / 2
+        size = max(w, h) * (1 + self.haar_margin)
+        bb = np.zeros(4, dtype=np.int32)
+        bb[0] = max(0, int(center_x - size / 2))
+        bb[1] = max(0, int(center_y - size / 2))
+        bb[2] = min(width, int(center_x + size / 2))
+        bb[3] = min(height, int(center_y + size / 2))
+        return bb
+
+    def center_box(self, img):
+        height, width = img.shape[:2]
+        center_x = width // 2
+        # Faces sit in the upper part of portrait shots
+        center_y = int(height * 0.4) if height > width else height // 2
+        crop_size = min(width, height)
+        bb = np.zeros(4, dtype=np.int32)
+        bb[0] = max(0, center_x - crop_size // 2)
+        bb[1] = max(0, center_y - crop_size // 2)
+        bb[2] = min(width, center_x + crop_size // 2)
+        bb[3] = min(height, center_y + crop_size // 2)
+        return bb
+
+    def crop(self, img, bb):
+        cropped = img[bb[1]:bb[3], bb[0]:bb[2], :]
+        cropped_pil = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB))
+        return np.asarray(cropped_pil.resize((self.image_size, self.image_size), Image.BICUBIC))
@@ -0,0 +1,230 @@
+"""Approximate nearest-neighbour indexes over the embedding gallery.
+
+Brute-force matching costs O(N) per face, which is fine for one exam but not
+for every SAP tenant in one gallery. Two indexes trade a little recall for
+sub-linear search; both are keyed by face id and support incremental
+``add``/``remove`` so they can mirror ``/register`` and ``DELETE /faces/{id}``:
+
+``hnsw``
+    Hierarchical navigable small world graph (``hnswlib``). Knobs: ``M``
+    (graph degree, memory), ``ef_construction`` (build quality) and
+    ``ef_search`` (recall vs latency at query time).
+``ivf``
+    Inverted file index in pure NumPy: k-means coarse quantizer with ``nlist``
+    cells; a query scans the ``nprobe`` closest cells (recall vs latency).
+
+Embeddings are L2-normalized, so similarity is the inner product and
+``distance = sqrt(2 - 2 * similarity)`` is the usual FaceNet L2 distance.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("face_recognition_service.ann")
+
+ANN_INDEXES = ("none", "auto", "ivf", "hnsw")
+
+
+def exact_search(matrix, queries, k):
+    """Top-k rows of ``matrix`` by inner product; returns (rows, similarities), both (nq, k)"""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    k = min(k, matrix.shape[0])
+    if k == 0:
+        return np.zeros((queries.shape[0], 0), dtype=np.int64), np.zeros((queries.shape[0], 0), dtype=np.float32)
+    sims = queries @ matrix.T
+    rows = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(sims, rows, axis=1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+class VectorIndex(object):
+    name = None
+
+    def add(self, face_id, embedding):
+        raise NotImplementedError
+
+    def remove(self, face_id):
+        raise NotImplementedError
+
+    def search(self, queries, k=1):
+        """Returns (ids, similarities): lists of length nq with up to k entries each, best first"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class IVFIndex(VectorIndex):
+    name = "ivf"
+
+    def __init__(self, centroids, nprobe=8):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        nlist, dim = self.centroids.shape
+        self._vectors = [np.empty((0, dim), dtype=np.float32) for _ in range(nlist)]
+        self._ids = [[] for _ in range(nlist)]
+        self._sizes = [0] * nlist
+        self._where = {}  # face_id -> (cell, row)
+
+    @classmethod
+    def build(cls, ids, embeddings, nlist=0, nprobe=8, niter=10, seed=0):
+        """Train the coarse quantizer on (a sample of) ``embeddings`` and insert them"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if nlist <= 0:
+            nlist = max(1, int(4 * np.sqrt(len(embeddings))))
+        nlist = max(1, min(nlist, len(embeddings)))
+        rng = np.random.RandomState(seed)
+        sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), 64 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(niter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cell in range(nlist):
+                members = sample[assignment == cell]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[cell] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        index = cls(centroids, nprobe)
+        cells = np.argmax(embeddings @ centroids.T, axis=1)
+        for cell in range(nlist):
+            rows = np.flatnonzero(cells == cell)
+            index._vectors[cell] = embeddings[rows].copy()
+            index._ids[cell] = [ids[row] for row in rows]
+            index._sizes[cell] = len(rows)
+            for position, row in enumerate(rows):
+                index._where[ids[row]] = (cell, position)
+        return index
+
+    def __len__(self):
+        return len(self._where)
+
+    def add(self, face_id, embedding):
+        self.remove(face_id)
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        cell = int(np.argmax(self.centroids @ embedding))
+        size = self._sizes[cell]
+        if size == self._vectors[cell].shape[0]:
+            grown = np.empty((max(16, 2 * size), self.centroids.shape[1]), dtype=np.float32)
+            grown[:size] = self._vectors[cell][:size]
+            self._vectors[cell] = grown
+        self._vectors[cell][size] = embedding
+        self._ids[cell].append(face_id)
+        self._sizes[cell] = size + 1
+        self._where[face_id] = (cell, size)
+
+    def remove(self, face_id):
+        location = self._where.pop(face_id, None)
+        if location is None:
+            return False
+        cell, row = location
+        last = self._sizes[cell] - 1
+        if row != last:
+            self._vectors[cell][row] = self._vectors[cell][last]
+            moved = self._ids[cell][last]
+            self._ids[cell][row] = moved
+            self._where[moved] = (cell, row)
+        self._ids[cell].pop()
+        self._sizes[cell] = last
+        return True
+
+    def search(self, queries, k=1):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(self.nprobe, len(self.centroids))
+        cells = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        all_ids, all_sims = [], []
+        for query, query_cells in zip(queries, cells):
+            candidates = [self._vectors[cell][:self._sizes[cell]] for cell in query_cells]
+            candidate_ids = [face_id for cell in query_cells for face_id in self._ids[cell]]
+            if not candidate_ids:
+                all_ids.append([])
+                all_sims.append(np.zeros(0, dtype=np.float32))
+                continue
+            rows, sims = exact_search(np.concatenate(candidates), query, k)
+            all_ids.append([candidate_ids[row] for row in rows[0]])
+            all_sims.append(sims[0])
+        return all_ids, all_sims
+
+
+class HnswIndex(VectorIndex):
+    name = "hnsw"
+
+    def __init__(self, dim, capacity=1024, M=16, ef_construction=200, ef_search=64):
+        import hnswlib
+        self._index = hnswlib.Index(space="ip", dim=dim)
+        self._index.init_index(max_elements=max(capacity, 1), M=M, ef_construction=ef_construction,
+                               allow_replace_deleted=True)
+        self._index.set_ef(ef_search)
+        self._labels = {}  # face_id -> int label
+        self._ids = {}  # int label -> face_id
+        self._next_label = 0
+
+    @classmethod
+    def build(cls, ids, embeddings, M=16, ef_construction=200, ef_search=64):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        index = cls(embeddings.shape[1], capacity=int(len(ids) * 1.25) + 1024, M=M,
+                    ef_construction=ef_construction, ef_search=ef_search)
+        labels = np.arange(len(ids))
+        if len(ids):
+            index._index.add_items(embeddings, labels)
+        index._labels = {face_id: int(label) for face_id, label in zip(ids, labels)}
+        index._ids = {int(label): face_id for face_id, label in zip(ids, labels)}
+        index._next_label = len(ids)
+        return index
+
+    @property
+    def ef_search(self):
+        return self._index.ef
+
+    @ef_search.setter
+    def ef_search(self, value):
+        self._index.set_ef(value)
+
+    def __len__(self):
+        return len(self._labels)
+
+    def add(self, face_id, embedding):
+        self.remove(face_id)
+        if self._index.get_current_count() >= self._index.get_max_elements():
+            self._index.resize_index(2 * self._index.get_max_elements())
+        label = self._next_label
+        self._next_label += 1
+        self._index.add_items(np.asarray(embedding, dtype=np.float32).reshape(1, -1), [label],
+                              replace_deleted=True)
+        self._labels[face_id] = label
+        self._ids[label] = face_id
+
+    def remove(self, face_id):
+        label = self._labels.pop(face_id, None)
+        if label is None:
+            return False
+        self._index.mark_deleted(label)
+        del self._ids[label]
+        return True
+
+    def search(self, queries, k=1):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self._labels))
+        if k == 0:
+            return [[] for _ in queries], [np.zeros(0, dtype=np.float32) for _ in queries]
+        self._index.set_ef(max(self._index.ef, k))
+        labels, distances = self._index.knn_query(queries, k=k)
+        # hnswlib "ip" distance is 1 - inner product
+        return [[self._ids[int(label)] for label in row] for row in labels], list(1.0 - distances)
+
+
+def build_index(kind, ids, embeddings, ivf_nlist=0, ivf_nprobe=8, hnsw_m=16, hnsw_ef_construction=200,
+                hnsw_ef_search=64):
+    """Build the index selected by ``kind``; ``auto`` prefers hnsw and falls back to the NumPy IVF"""
+    if kind == "auto":
+        try:
+            import hnswlib  # noqa: F401
+            kind = "hnsw"
+        except ImportError:
+            logger.info("hnswlib is not installed, using the NumPy IVF index")
+            kind = "ivf"
+    if kind == "hnsw":
+        return HnswIndex.build(ids, embeddings, M=hnsw_m, ef_construction=hnsw_ef_construction,
+                               ef_search=hnsw_ef_search)
+    if kind == "ivf":
+        return IVFIndex.build(ids, embeddings, nlist=ivf_nlist, nprobe=ivf_nprobe)
+    raise ValueError(f"Unknown ANN index '{kind}', expected one of {ANN_INDEXES}")
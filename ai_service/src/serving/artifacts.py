@@ -0,0 +1,194 @@
+"""Versioned model artifacts with atomic publishing.
+
+Every trained classifier is a new immutable file in the artifact directory,
+``<name>-<version><suffix>``. A small ``CURRENT`` file names the version in
+use. Both are written to a temporary file in the same directory and moved into
+place with ``os.replace``, so a reader sees either the old or the new model,
+never a torn file, and never has to wait for a trainer.
+
+Trainers are serialized by ``WriterLock``: a re-entrant thread lock plus an
+``flock`` on ``<directory>/.lock`` so several service workers on one host do
+not retrain over each other either. Readers take no lock at all.
+"""
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: the thread lock still serializes trainers within a process
+    fcntl = None
+
+logger = logging.getLogger("face_recognition_service.artifacts")
+
+POINTER = "CURRENT"
+
+
+def write_atomic(path, data):
+    """Write ``data`` (bytes) to ``path`` through a temporary file and ``os.replace``"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class WriterLock(object):
+    """Re-entrant single-writer lock, shared by the threads of a process and (via flock) by processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+class ArtifactStore(object):
+
+    def __init__(self, directory, name="facemodel", suffix=".fca", keep=5, legacy_path=""):
+        """
+        ``keep`` (at least 1) versions stay on disk, the current one always among them.
+        ``legacy_path`` (e.g. a pickled facemodel.pkl) is served while nothing has been published yet.
+        """
+        if keep < 1:
+            raise ValueError(f"At least one artifact version must be kept, got keep={keep}")
+        self.directory = directory
+        self.name = name
+        self.suffix = suffix
+        self.keep = keep
+        self.legacy_path = legacy_path
+        self.lock = WriterLock(os.path.join(directory, ".lock"))
+
+    @property
+    def pointer_path(self):
+        return os.path.join(self.directory, POINTER)
+
+    def path_of(self, version):
+        return os.path.join(self.directory, f"{self.name}-{version}{self.suffix}")
+
+    def versions(self):
+        """Published versions, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = self.name + "-"
+        return sorted(f[len(prefix):-len(self.suffix)] for f in os.listdir(self.directory)
+                      if f.startswith(prefix) and f.endswith(self.suffix))
+
+    def current_version(self):
+        try:
+            with open(self.pointer_path, encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current_path(self):
+        """Path of the model in use: the current version, else the legacy path, else None"""
+        version = self.current_version()
+        if version is not None:
+            return self.path_of(version)
+        if self.legacy_path and os.path.exists(self.legacy_path):
+            return self.legacy_path
+        return None
+
+    @contextmanager
+    def staging_path(self):
+        """
+        A temporary path in the artifact directory for a trainer to write to; publish
+        it with ``publish_file`` inside the ``with`` block. Removed if left unpublished.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f".staging-{uuid.uuid4().hex}{self.suffix}")
+        try:
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def publish_file(self, path):
+        """Move a complete artifact into the store and make it current; returns the version"""
+        with self.lock:
+            version = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+            os.replace(path, self.path_of(version))
+            write_atomic(self.pointer_path, version.encode("utf-8"))
+            self._prune(version)
+        logger.info("Published %s version %s", self.name, version)
+        return version
+
+    def publish_bytes(self, data):
+        with self.staging_path() as path:
+            with open(path, "wb") as f:
+                f.write(data)
+            return self.publish_file(path)
+
+    def unpublish(self):
+        """Stop serving any version (e.g. the last identity was deleted)"""
+        with self.lock:
+            for path in (self.pointer_path, self.legacy_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def _prune(self, current):
+        # Older versions may still be mapped by a reader; unlinking keeps their pages alive until unmapped
+        versions = self.versions()
+        for version in versions[:max(0, len(versions) - self.keep)]:
+            if version != current:
+                os.remove(self.path_of(version))
+
+
+class CachedArtifact(object):
+    """
+    Load the current artifact once and reload it only when a new version is published.
+    ``get()`` costs one ``stat`` of the pointer file while the version is unchanged.
+    """
+
+    def __init__(self, store, load):
+        self.store = store
+        self.load = load
+        self._key = None
+        self._value = None
+
+    def get(self):
+        """Returns (path, loaded artifact), or (None, None) if no model is published"""
+        try:
+            stat = os.stat(self.store.pointer_path)
+            key = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            path = self.store.current_path()
+            if path is None:
+                return None, None
+            stat = os.stat(path)
+            key = (path, stat.st_ino, stat.st_mtime_ns)
+        if key != self._key:
+            path = self.store.current_path()
+            if path is None:
+                return None, None
+            self._value = (path, self.load(path))
+            self._key = key
+        return self._value
@@ -0,0 +1,134 @@
+"""Inference backends for the MTCNN stages and the FaceNet embedder.
+
+A backend exposes ``pnet``, ``rnet`` and ``onet`` with the same inputs and
+outputs as the functions returned by ``align.detect_face.create_mtcnn`` (so
+``align.detect_face.detect_face`` works with any of them) and ``embed`` for
+batches of prewhitened NHWC float32 faces.
+
+``tensorflow`` runs the original graphs in a ``tf.compat.v1.Session``;
+``onnxruntime`` runs models converted by
+``face_recognition_process/convert_to_onnx.py`` on the CPU execution provider.
+"""
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger("face_recognition_service.backends")
+
+BACKENDS = ("tensorflow", "onnxruntime")
+
+
+class InferenceBackend(object):
+    name = None
+    # File name of the FaceNet model, reported in the face_model_info metric
+    embedding_model = None
+
+    def pnet(self, img):
+        raise NotImplementedError
+
+    def rnet(self, img):
+        raise NotImplementedError
+
+    def onet(self, img):
+        raise NotImplementedError
+
+    def embed(self, images):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TensorFlowBackend(InferenceBackend):
+    name = "tensorflow"
+
+    def __init__(self, mtcnn_model_dir, facenet_model_path, session_config=None):
+        import tensorflow as tf
+        import align.detect_face
+        from face_recognition_process import facenet
+
+        # The TF1 graphs run in graph mode; only this backend loads TensorFlow at all
+        tf.compat.v1.disable_eager_execution()
+        if not os.path.exists(os.path.join(mtcnn_model_dir, "det1.npy")):
+            raise FileNotFoundError(f"MTCNN model files not found in {mtcnn_model_dir}")
+
+        self.embedding_model = os.path.basename(facenet_model_path)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.sess = tf.compat.v1.Session(config=session_config)
+            with self.sess.as_default():
+                self._pnet, self._rnet, self._onet = align.detect_face.create_mtcnn(self.sess, mtcnn_model_dir)
+                facenet.load_model(facenet_model_path)
+                self.images_placeholder, self.embeddings, self.phase_train_placeholder = \
+                    facenet.get_embedding_tensors(self.graph)
+        self._feed_dict = facenet.embedding_feed_dict
+
+    def pnet(self, img):
+        return self._pnet(img)
+
+    def rnet(self, img):
+        return self._rnet(img)
+
+    def onet(self, img):
+        return self._onet(img)
+
+    def embed(self, images):
+        feed_dict = self._feed_dict(self.images_placeholder, self.phase_train_placeholder, images)
+        return self.sess.run(self.embeddings, feed_dict=feed_dict)
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = "onnxruntime"
+
+    def __init__(self, model_dir, embedding_model="facenet.onnx", session_options=None):
+        import onnxruntime as ort
+
+        if session_options is None:
+            session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        def load(filename):
+            path = os.path.join(model_dir, filename)
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"ONNX model not found: {path}")
+            session = ort.InferenceSession(path, sess_options=session_options, providers=["CPUExecutionProvider"])
+            return session, session.get_inputs()[0].name
+
+        self._pnet, self._pnet_input = load("pnet.onnx")
+        self._rnet, self._rnet_input = load("rnet.onnx")
+        self._onet, self._onet_input = load("onet.onnx")
+        self._facenet, self._facenet_input = load(embedding_model)
+        self.embedding_model = embedding_model
+
+    def pnet(self, img):
+        return self._pnet.run(None, {self._pnet_input: np.asarray(img, dtype=np.float32)})
+
+    def rnet(self, img):
+        return self._rnet.run(None, {self._rnet_input: np.asarray(img, dtype=np.float32)})
+
+    def onet(self, img):
+        return self._onet.run(None, {self._onet_input: np.asarray(img, dtype=np.float32)})
+
+    def embed(self, images):
+        return self._facenet.run(None, {self._facenet_input: np.asarray(images, dtype=np.float32)})[0]
+
+
+def create_backend(settings):
+    """Instantiate the backend selected by ``settings.inference_backend``"""
+    if settings.inference_backend == "tensorflow":
+        if settings.quantized_embedder:
+            logger.warning("FACE_QUANTIZED_EMBEDDER is only supported by the onnxruntime backend, "
+                           "using the float FaceNet graph")
+        return TensorFlowBackend(settings.mtcnn_model_dir, settings.embedding_model_path,
+                                 session_config=settings.thread_budget.tf_session_config())
+    if settings.inference_backend == "onnxruntime":
+        embedding_model = settings.quantized_embedder_name if settings.quantized_embedder else "facenet.onnx"
+        return OnnxRuntimeBackend(settings.onnx_model_dir, embedding_model=embedding_model,
+                                  session_options=settings.thread_budget.ort_session_options())
+    raise ValueError(f"Unknown inference backend '{settings.inference_backend}', expected one of {BACKENDS}")
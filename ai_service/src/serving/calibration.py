@@ -0,0 +1,219 @@
+"""Open-set acceptance thresholds calibrated on the gallery.
+
+A classifier probability is not a usable acceptance score: SVC probabilities
+over N classes shrink as N grows, so a fixed cut-off such as 0.4 drifts with the
+number of enrolled people. The L2 distance between a probe and the nearest
+template of the predicted person does not depend on N, and its false accept
+rate can be measured on the enrolled data itself. Like a probe at serving time,
+each stored per-image embedding (``face_samples``) is compared with templates,
+and registrations are told apart by face id (two people may share a name):
+
+- genuine pairs are a sample and the template of its own registration,
+- impostor pairs are a sample and the template of any other registration (all
+  of them for small galleries, otherwise a uniform sample of
+  ``max_impostor_pairs``).
+
+A template is the mean of its registration's samples, so VAL is measured on
+images the template was built from and is an optimistic estimate.
+
+For each target FAR the table stores the largest distance threshold whose
+impostor accept rate stays within the target, plus the validation rate (genuine
+accept rate) it achieves. FAR and VAL follow ``facenet.calculate_val_far``
+(accept when ``dist < threshold``) but are evaluated for all thresholds at once
+with sorted distances and ``np.searchsorted``.
+
+The table is written as JSON (``FACE_THRESHOLD_TABLE``); the service resolves
+``FACE_TARGET_FAR`` to a distance once at startup, so applying it costs one
+comparison per face. Regenerate it after larger enrollment changes::
+
+    PYTHONPATH=src python -m serving.calibration --far 1e-2 1e-3 1e-4 1e-5
+"""
+import argparse
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import select
+
+from serving.artifacts import write_atomic
+from serving.gallery import decode_embedding
+from serving.storage import FaceData, FaceSample
+
+logger = logging.getLogger("face_recognition_service.calibration")
+
+DEFAULT_FAR_TARGETS = (1e-2, 1e-3, 1e-4, 1e-5)
+
+
+def _distances(a, b):
+    # L2 distance between rows of normalized embeddings, like match_gallery
+    return np.sqrt(np.maximum(0.0, 2.0 - 2.0 * np.einsum("ij,ij->i", a, b)))
+
+
+def genuine_impostor_distances(samples, sample_ids, templates, template_ids, max_impostor_pairs=2000000, seed=0):
+    """
+    (genuine, impostor) L2 distances between per-image ``samples`` of the registrations
+    ``sample_ids`` and the ``templates`` of the registrations ``template_ids``. Samples
+    without a template (e.g. of another model version) are ignored.
+    """
+    samples = np.asarray(samples, dtype=np.float32).reshape(len(sample_ids), -1)
+    samples = samples / np.maximum(np.linalg.norm(samples, axis=1, keepdims=True), 1e-12)
+    templates = np.asarray(templates, dtype=np.float32)
+    row_of = {face_id: row for row, face_id in enumerate(template_ids)}
+    own = np.array([row_of.get(face_id, -1) for face_id in sample_ids], dtype=np.int64)
+    samples, own = samples[own >= 0], own[own >= 0]
+    n, m = len(samples), len(templates)
+
+    genuine = _distances(samples, templates[own]) if n else np.zeros(0, dtype=np.float32)
+
+    # Impostor: every (sample, template) pair if that is few enough, else a uniform sample
+    if n * m <= max_impostor_pairs:
+        i, j = np.divmod(np.arange(n * m, dtype=np.int64), m)
+    else:
+        rng = np.random.RandomState(seed)
+        i = rng.randint(n, size=max_impostor_pairs)
+        j = rng.randint(m, size=max_impostor_pairs)
+    keep = own[i] != j
+    i, j = i[keep], j[keep]
+    impostor = np.concatenate([_distances(samples[i[s:s + 65536]], templates[j[s:s + 65536]])
+                               for s in range(0, len(i), 65536)]) if len(i) else np.zeros(0, dtype=np.float32)
+    return genuine, impostor
+
+
+def load_samples(session, model_version):
+    """(face ids, embeddings) of the stored per-image samples of live registrations"""
+    rows = session.execute(
+        select(FaceSample.face_id, FaceSample.embedding, FaceSample.embedding_dtype)
+        .join(FaceData, FaceData.id == FaceSample.face_id)
+        .where(FaceSample.model_version == model_version, FaceData.deleted_at.is_(None))
+        .order_by(FaceSample.face_id, FaceSample.position)).all()
+    face_ids = [face_id for face_id, _, _ in rows]
+    embeddings = [decode_embedding(blob, dtype) for _, blob, dtype in rows]
+    return face_ids, np.asarray(embeddings, dtype=np.float32).reshape(len(rows), -1)
+
+
+def val_far(thresholds, genuine, impostor):
+    """Vectorized ``calculate_val_far``: (val, far) arrays, accepting pairs with ``dist < threshold``"""
+    thresholds = np.asarray(thresholds)
+    val = np.searchsorted(np.sort(genuine), thresholds, side="left") / float(max(len(genuine), 1))
+    far = np.searchsorted(np.sort(impostor), thresholds, side="left") / float(max(len(impostor), 1))
+    return val, far
+
+
+def far_thresholds(impostor, far_targets):
+    """Largest threshold per target with FAR <= target (the k-th smallest impostor distance, k = target * n)"""
+    impostor = np.sort(impostor)
+    counts = np.floor(np.asarray(far_targets, dtype=np.float64) * len(impostor)).astype(np.int64)
+    return np.where(counts < len(impostor), impostor[np.minimum(counts, len(impostor) - 1)], np.inf)
+
+
+class ThresholdTable(object):
+
+    def __init__(self, rows, meta=None):
+        """``rows``: dicts with far_target, threshold, far, val, sorted by decreasing far_target"""
+        self.rows = sorted(rows, key=lambda row: -row["far_target"])
+        self.meta = meta or {}
+
+    @classmethod
+    def from_distances(cls, genuine, impostor, far_targets=DEFAULT_FAR_TARGETS, meta=None):
+        if len(impostor) == 0:
+            raise ValueError("At least two people are needed to measure false accepts")
+        far_targets = sorted(set(float(t) for t in far_targets), reverse=True)
+        thresholds = far_thresholds(impostor, far_targets)
+        val, far = val_far(thresholds, genuine, impostor)
+        rows = [{
+            "far_target": target,
+            "threshold": float(threshold) if np.isfinite(threshold) else None,
+            "far": float(f),
+            "val": float(v),
+            # Fewer than 1 / far_target impostor pairs cannot tell this FAR from zero
+            "resolved": bool(target * len(impostor) >= 1.0),
+        } for target, threshold, f, v in zip(far_targets, thresholds, far, val)]
+        meta = dict(meta or {}, genuine_pairs=int(len(genuine)), impostor_pairs=int(len(impostor)))
+        return cls(rows, meta)
+
+    def threshold(self, far_target):
+        """Distance threshold for the largest tabulated target not above ``far_target``"""
+        for row in self.rows:
+            if row["far_target"] <= far_target * (1 + 1e-9):
+                return row["threshold"] if row["threshold"] is not None else float("inf")
+        raise KeyError(f"No threshold for FAR {far_target:g}; the table starts at {self.rows[-1]['far_target']:g}")
+
+    def save(self, path):
+        data = {"meta": self.meta, "thresholds": self.rows}
+        write_atomic(path, json.dumps(data, indent=2).encode("utf-8"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["thresholds"], data.get("meta"))
+
+
+def calibrate(gallery, sample_ids, samples, far_targets=DEFAULT_FAR_TARGETS, max_impostor_pairs=2000000, seed=0):
+    """Threshold table from the distances of the per-image ``samples`` to the gallery's templates"""
+    genuine, impostor = genuine_impostor_distances(samples, sample_ids, gallery.embeddings, gallery.ids,
+                                                   max_impostor_pairs, seed)
+    meta = {
+        "model_version": gallery.model_version,
+        "templates": len(gallery),
+        "samples": int(len(genuine)),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    table = ThresholdTable.from_distances(genuine, impostor, far_targets, meta)
+    logger.info("Calibrated thresholds on %d genuine and %d impostor pairs", len(genuine), len(impostor))
+    return table
+
+
+def load_accept_distance(path, far_target):
+    """Distance threshold for ``far_target`` from the table at ``path``, or None if there is no table"""
+    try:
+        table = ThresholdTable.load(path)
+    except FileNotFoundError:
+        return None
+    try:
+        threshold = table.threshold(far_target)
+    except KeyError as e:
+        logger.warning("%s (%s); calibrated acceptance is disabled", e.args[0], path)
+        return None
+    logger.info("Accepting matches within distance %.4f (FAR %g, calibrated on %s templates)",
+                threshold, far_target, table.meta.get("templates", "?"))
+    return threshold
+
+
+def main(args):
+    from serving.gallery import load_gallery
+    from serving.settings import Settings
+    from serving.storage import create_db_engine, create_session_factory, init_db
+
+    settings = Settings.from_env()
+    engine = create_db_engine(settings.database_url, schema=settings.db_schema)
+    init_db(engine, settings.db_schema)
+    with create_session_factory(engine)() as session:
+        gallery = load_gallery(session, settings.embedding_model_version)
+        sample_ids, samples = load_samples(session, settings.embedding_model_version)
+    table = calibrate(gallery, sample_ids, samples, args.far, args.max_impostor_pairs)
+    output = args.output or settings.threshold_table_path
+    table.save(output)
+    for row in table.rows:
+        print("FAR %-8g threshold %-8s VAL %.4f%s" % (
+            row["far_target"], "%.4f" % row["threshold"] if row["threshold"] is not None else "-",
+            row["val"], "" if row["resolved"] else "  (too few impostor pairs)"))
+    print("Saved threshold table to %s" % output)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Calibrate distance thresholds on the enrolled gallery.")
+    parser.add_argument("--far", type=float, nargs="+", default=list(DEFAULT_FAR_TARGETS),
+                        help="Target false accept rates.")
+    parser.add_argument("--max_impostor_pairs", type=int, default=2000000,
+                        help="Sample this many impostor pairs when the gallery has more.")
+    parser.add_argument("--output", type=str, default="",
+                        help="Threshold table to write, FACE_THRESHOLD_TABLE by default.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(parse_arguments(sys.argv[1:]))
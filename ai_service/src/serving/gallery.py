@@ -0,0 +1,338 @@
+"""Embedding gallery: every enrolled template in one contiguous matrix.
+
+Templates are stored in ``faces.embedding`` as fixed-width little-endian
+float32 or float16 blobs, tagged with the embedding model version that
+produced them, so a model upgrade never mixes incompatible vectors.
+
+At startup the gallery is read with one streaming query whose rows are
+decoded a chunk at a time straight into a preallocated ``(N, D)`` float32
+matrix. The result is also written as a snapshot (``<path>.npy`` plus
+``<path>.json`` with ids, names and a stamp of the table contents); on the
+next start a snapshot whose stamp still matches the table is memory-mapped
+instead, so cold start does not depend on the gallery size.
+
+Matching is exact (one matrix product) until the gallery reaches
+``ann_min_size`` templates; from then on an approximate nearest-neighbour
+index (``serving/ann.py``) is built and kept in sync with ``add``/``remove``.
+
+A search can be scoped to a partition: a tenant, the roster of an assessment
+or an explicit list of face ids. Scoped searches only gather and score the rows
+of that partition, so an exam with 40 candidates costs 40 dot products whatever
+the size of the platform.
+"""
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+from sqlalchemy import func, select
+
+from serving.ann import exact_search
+from serving.storage import FaceData, FacesRevision, RosterEntry
+
+logger = logging.getLogger("face_recognition_service.gallery")
+
+EMBEDDING_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+
+def encode_embedding(embedding, dtype="float32"):
+    """Embedding vector -> fixed-width blob"""
+    return np.ascontiguousarray(embedding, dtype=EMBEDDING_DTYPES[dtype]).reshape(-1).tobytes()
+
+
+def decode_embedding(blob, dtype="float32"):
+    """Blob -> float32 embedding vector"""
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPES[dtype]).astype(np.float32)
+
+
+def table_stamp(session, model_version):
+    """Cheap fingerprint of the templates of a model version, used to validate snapshots.
+
+    The revision of the ``faces`` table catches every write that keeps the count
+    unchanged (renames, re-embedding, a deletion plus a registration).
+    """
+    count = session.execute(
+        select(func.count(FaceData.id))
+        .where(FaceData.model_version == model_version, FaceData.embedding.isnot(None),
+               FaceData.deleted_at.is_(None))
+    ).scalar_one()
+    revision = session.execute(select(FacesRevision.revision).where(FacesRevision.id == 1)).scalar()
+    return {"count": int(count), "revision": revision}
+
+
+class Gallery(object):
+
+    def __init__(self, model_version, ids=(), names=(), embeddings=None, dim=512, tenants=None):
+        self.model_version = model_version
+        self.ids = list(ids)
+        self.names = list(names)
+        self.tenants = list(tenants) if tenants is not None else [None] * len(self.ids)
+        if embeddings is None:
+            embeddings = np.zeros((0, dim), dtype=np.float32)
+        # May be a read-only memmap until the first add/remove
+        self._matrix = embeddings
+        self._size = len(self.ids)
+        self._rows = {face_id: row for row, face_id in enumerate(self.ids)}
+        self.index = None
+        self._index_factory = None
+        self.ann_min_size = 0
+        # Partitions: tenant -> face ids, assessment -> roster of face ids, name -> face ids
+        self._tenant_members = {}
+        for face_id, tenant_id in zip(self.ids, self.tenants):
+            self._tenant_members.setdefault(tenant_id, set()).add(face_id)
+        self._name_members = {}
+        for face_id, name in zip(self.ids, self.names):
+            self._name_members.setdefault(name, set()).add(face_id)
+        self.rosters = {}
+        self._assessments = {}  # face_id -> assessments it is rostered for
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, face_id):
+        return face_id in self._rows
+
+    @property
+    def dim(self):
+        return self._matrix.shape[1]
+
+    @property
+    def embeddings(self):
+        """(N, D) float32 view of the templates; row i belongs to ids[i]"""
+        return self._matrix[:self._size]
+
+    def name_of(self, face_id):
+        return self.names[self._rows[face_id]]
+
+    def ids_of(self, name):
+        """Face ids of every template registered under ``name``"""
+        return self._name_members.get(name, set())
+
+    def set_roster(self, assessment_id, face_ids):
+        """Replace the roster of an assessment"""
+        for face_id in self.rosters.pop(assessment_id, ()):
+            self._assessments[face_id].discard(assessment_id)
+        roster = set(face_ids)
+        self.rosters[assessment_id] = roster
+        for face_id in roster:
+            self._assessments.setdefault(face_id, set()).add(assessment_id)
+
+    def add_to_roster(self, assessment_id, face_id):
+        self.rosters.setdefault(assessment_id, set()).add(face_id)
+        self._assessments.setdefault(face_id, set()).add(assessment_id)
+
+    def load_rosters(self, session):
+        """Read all assessment rosters (a few ids per candidate) from the database"""
+        rosters = {}
+        for assessment_id, face_id in session.execute(
+                select(RosterEntry.assessment_id, RosterEntry.face_id)
+                .join(FaceData, FaceData.id == RosterEntry.face_id).where(FaceData.deleted_at.is_(None))):
+            rosters.setdefault(assessment_id, []).append(face_id)
+        for assessment_id, face_ids in rosters.items():
+            self.set_roster(assessment_id, face_ids)
+
+    def scope(self, tenant_id=None, assessment_id=None, face_ids=None):
+        """
+        Face ids a search is restricted to, or None for the whole gallery.
+
+        An explicit ``face_ids`` list wins over the roster of ``assessment_id``; either is
+        intersected with ``tenant_id`` when it is given. Raises KeyError for an unknown assessment.
+        """
+        if face_ids is not None:
+            candidates = set(face_ids)
+        elif assessment_id is not None:
+            candidates = self.rosters[assessment_id]
+        elif tenant_id is not None:
+            return self._tenant_members.get(tenant_id, set())
+        else:
+            return None
+        if tenant_id is not None:
+            candidates = candidates & self._tenant_members.get(tenant_id, set())
+        return candidates
+
+    def enable_ann(self, index_factory, min_size=0):
+        """
+        Search through ``index_factory(ids, embeddings)`` (see ``serving.ann.build_index``)
+        once the gallery holds ``min_size`` templates; smaller galleries are searched exactly.
+        """
+        self._index_factory = index_factory
+        self.ann_min_size = min_size
+        self.index = None
+        self._maybe_build_index()
+
+    def _maybe_build_index(self):
+        if self.index is None and self._index_factory is not None and self._size and \
+                self._size >= self.ann_min_size:
+            self.index = self._index_factory(list(self.ids), self.embeddings)
+            logger.info("Built %s index over %d templates", self.index.name, self._size)
+
+    def search(self, queries, k=1, candidates=None):
+        """
+        Most similar templates of each query embedding.
+
+        Returns (ids, similarities): one list of up to ``k`` face ids and one array of
+        inner products per query, best match first. ``candidates`` (see ``scope``)
+        restricts the search to those face ids.
+        """
+        if candidates is not None:
+            rows = np.fromiter((self._rows[face_id] for face_id in candidates if face_id in self._rows),
+                               dtype=np.int64)
+            subset_rows, similarities = exact_search(self._matrix[rows], queries, k)
+            return [[self.ids[rows[row]] for row in query_rows] for query_rows in subset_rows], list(similarities)
+        if self.index is not None:
+            return self.index.search(queries, k)
+        rows, similarities = exact_search(self.embeddings, queries, k)
+        return [[self.ids[row] for row in query_rows] for query_rows in rows], list(similarities)
+
+    def _writable(self, capacity):
+        if isinstance(self._matrix, np.memmap) or self._matrix.shape[0] < capacity:
+            new_capacity = max(capacity, 2 * self._size, 64)
+            matrix = np.empty((new_capacity, self.dim), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+            self._matrix = matrix
+        return self._matrix
+
+    def add(self, face_id, name, embedding, tenant_id=None):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self._size == 0 and embedding.shape[0] != self.dim:
+            self._matrix = np.zeros((0, embedding.shape[0]), dtype=np.float32)
+        if face_id in self._rows:
+            row = self._rows[face_id]
+            self._writable(self._size)[row] = embedding
+            self._name_members[self.names[row]].discard(face_id)
+            self.names[row] = name
+            self._name_members.setdefault(name, set()).add(face_id)
+            self._tenant_members[self.tenants[row]].discard(face_id)
+            self.tenants[row] = tenant_id
+            self._tenant_members.setdefault(tenant_id, set()).add(face_id)
+            if self.index is not None:
+                self.index.add(face_id, embedding)
+            return
+        matrix = self._writable(self._size + 1)
+        matrix[self._size] = embedding
+        self.ids.append(face_id)
+        self.names.append(name)
+        self.tenants.append(tenant_id)
+        self._tenant_members.setdefault(tenant_id, set()).add(face_id)
+        self._name_members.setdefault(name, set()).add(face_id)
+        self._rows[face_id] = self._size
+        self._size += 1
+        if self.index is not None:
+            self.index.add(face_id, embedding)
+        else:
+            self._maybe_build_index()
+
+    def remove(self, face_id):
+        """Remove a template in O(1) by moving the last row into its place"""
+        for assessment_id in self._assessments.pop(face_id, ()):
+            self.rosters[assessment_id].discard(face_id)
+        row = self._rows.pop(face_id, None)
+        if row is None:
+            return False
+        self._tenant_members[self.tenants[row]].discard(face_id)
+        self._name_members[self.names[row]].discard(face_id)
+        last = self._size - 1
+        matrix = self._writable(self._size)
+        if row != last:
+            matrix[row] = matrix[last]
+            self.ids[row] = self.ids[last]
+            self.names[row] = self.names[last]
+            self.tenants[row] = self.tenants[last]
+            self._rows[self.ids[row]] = row
+        self.ids.pop()
+        self.names.pop()
+        self.tenants.pop()
+        self._size = last
+        if self.index is not None:
+            self.index.remove(face_id)
+        return True
+
+    @classmethod
+    def load_from_db(cls, session, model_version, chunk_size=10000):
+        """Stream all templates of ``model_version`` into one preallocated matrix"""
+        counts = dict(session.execute(
+            select(FaceData.embedding_dtype, func.count(FaceData.id))
+            .where(FaceData.model_version == model_version, FaceData.embedding.isnot(None),
+                   FaceData.deleted_at.is_(None))
+            .group_by(FaceData.embedding_dtype)
+        ).all())
+        total = sum(counts.values())
+        ids, names, tenants = [], [], []
+        matrix = None
+        for dtype, count in counts.items():
+            itemsize = EMBEDDING_DTYPES[dtype].itemsize
+            result = session.execute(
+                select(FaceData.id, FaceData.name, FaceData.tenant_id, FaceData.embedding)
+                .where(FaceData.model_version == model_version, FaceData.embedding_dtype == dtype,
+                       FaceData.embedding.isnot(None), FaceData.deleted_at.is_(None))
+                .execution_options(yield_per=chunk_size))
+            for chunk in result.partitions():
+                blobs = b"".join(bytes(row.embedding) for row in chunk)
+                if matrix is None:
+                    dim = len(chunk[0].embedding) // itemsize
+                    matrix = np.empty((total, dim), dtype=np.float32)
+                start = len(ids)
+                matrix[start:start + len(chunk)] = np.frombuffer(
+                    blobs, dtype=EMBEDDING_DTYPES[dtype]).reshape(len(chunk), -1)
+                ids.extend(row.id for row in chunk)
+                names.extend(row.name for row in chunk)
+                tenants.extend(row.tenant_id for row in chunk)
+        return cls(model_version, ids, names, matrix, tenants=tenants)
+
+    def save_snapshot(self, path, stamp):
+        """Write ``<path>.npy`` and ``<path>.json`` atomically"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        for suffix, write in ((".npy", lambda f: np.save(f, np.ascontiguousarray(self.embeddings))),
+                              (".json", lambda f: f.write(json.dumps({
+                                  "model_version": self.model_version, "stamp": stamp,
+                                  "ids": self.ids, "names": self.names,
+                                  "tenants": self.tenants}).encode("utf-8")))):
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=suffix + ".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.replace(tmp_path, path + suffix)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    @classmethod
+    def load_snapshot(cls, path, model_version, stamp):
+        """Memory-map a snapshot, or return None if it is missing or stale"""
+        try:
+            with open(path + ".json", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["model_version"] != model_version or meta["stamp"] != stamp:
+                return None
+            embeddings = np.load(path + ".npy", mmap_mode="r")
+        except (OSError, ValueError, KeyError) as e:
+            logger.info("No usable gallery snapshot at %s: %s", path, e)
+            return None
+        if embeddings.shape[0] != len(meta["ids"]):
+            return None
+        return cls(model_version, meta["ids"], meta["names"], embeddings, tenants=meta.get("tenants"))
+
+
+def load_gallery(session, model_version, snapshot_path=""):
+    """
+    Load the gallery from a matching snapshot, else from the database (and refresh the snapshot).
+    Assessment rosters are always read from the database.
+    """
+    stamp = table_stamp(session, model_version)
+    if snapshot_path:
+        gallery = Gallery.load_snapshot(snapshot_path, model_version, stamp)
+        if gallery is not None:
+            logger.info("Memory-mapped %d templates from %s", len(gallery), snapshot_path)
+            gallery.load_rosters(session)
+            return gallery
+    gallery = Gallery.load_from_db(session, model_version)
+    gallery.load_rosters(session)
+    logger.info("Loaded %d templates for model %s from the database", len(gallery), model_version)
+    if snapshot_path and len(gallery):
+        try:
+            gallery.save_snapshot(snapshot_path, stamp)
+        except OSError as e:
+            logger.warning("Could not write gallery snapshot %s: %s", snapshot_path, e)
+    return gallery
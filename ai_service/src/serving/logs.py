@@ -0,0 +1,132 @@
+"""Non-blocking logging for the service.
+
+Request threads only put records on an in-memory queue (``QueueHandler``); a
+``QueueListener`` thread formats them and writes the log file, so file I/O and
+the handler lock are off the inference path. Messages use lazy %-formatting
+and are only rendered for records that pass the level check.
+
+Levels can be set per logger (``FACE_LOG_LEVELS``), records can be written as
+JSON lines, and each record carries the id of the request trace it belongs to.
+Per-face detail goes to the ``face_recognition_service.faces`` logger at DEBUG
+and is sampled (``FACE_LOG_FACE_SAMPLE_RATE``) so enabling it under load does
+not multiply the log volume by the number of faces.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime, timezone
+
+from serving import tracing
+
+FACE_LOGGER = "face_recognition_service.faces"
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra= and is kept in JSON output
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener = None
+_queue_handler = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Tag records with the id of the current request trace (or None)"""
+
+    def filter(self, record):
+        trace = tracing.current_trace()
+        record.request_id = trace.request_id if trace is not None else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Pass a random fraction of the records below WARNING"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def parse_levels(spec):
+    """'sqlalchemy.engine=WARNING,face_recognition_service.faces=DEBUG' -> {logger: level}"""
+    levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(settings):
+    """
+    Route all records through a queue to the log file and apply the levels.
+
+    Replaces a previous configuration, so it is safe to call on every app
+    startup. Returns the started ``QueueListener``.
+    """
+    global _listener, _queue_handler
+    stop_logging()
+
+    if settings.log_format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    file_handler = logging.FileHandler(settings.log_file, encoding="utf-8")
+    file_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(settings.log_level.upper())
+    for name, level in parse_levels(settings.log_levels).items():
+        logging.getLogger(name).setLevel(level)
+
+    face_logger = logging.getLogger(FACE_LOGGER)
+    for existing in [f for f in face_logger.filters if isinstance(f, SamplingFilter)]:
+        face_logger.removeFilter(existing)
+    if settings.log_face_sample_rate < 1.0:
+        face_logger.addFilter(SamplingFilter(settings.log_face_sample_rate))
+
+    _queue_handler = queue_handler
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Flush the queue and stop the listener thread"""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
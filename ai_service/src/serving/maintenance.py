@@ -0,0 +1,124 @@
+"""Background maintenance of deleted identities.
+
+``DELETE /faces/{id}`` only writes a tombstone (``faces.deleted_at``) and
+drops the template from the in-memory gallery, which takes effect for the next
+recognition at once. The expensive part runs here, on a daemon thread, every
+``FACE_MAINTENANCE_INTERVAL`` seconds:
+
+- the raw and processed images of people without any live registration left
+  are removed, and dropped from the alignment manifest; for a name that is
+  still registered under another id, only the files of the deleted
+  registration (``<face_id>_<n>.*``) are,
+- tombstoned rows (and, by cascade, their roster entries) are purged,
+- the classifier is compacted, i.e. retrained once for all deletions of the
+  sweep, so the published classifier stops carrying removed classes.
+"""
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+
+from sqlalchemy import delete, func, select
+
+from face_recognition_process.alignment_manifest import AlignmentManifest
+from serving import metrics
+from serving.storage import FaceData
+
+logger = logging.getLogger("face_recognition_service.maintenance")
+
+
+class Maintenance(object):
+
+    def __init__(self, session_factory, raw_dataset_dir, processed_dataset_dir, compact=None, interval=60.0):
+        """
+        ``compact()`` is called after a sweep purged at least one tombstone, with the
+        processed dataset already cleaned up (e.g. retrain the classifier).
+        """
+        self.session_factory = session_factory
+        self.raw_dataset_dir = raw_dataset_dir
+        self.processed_dataset_dir = processed_dataset_dir
+        self.compact = compact
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="face-maintenance", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        """Run the next sweep now instead of at the end of the interval"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Maintenance sweep failed")
+
+    def pending(self, session):
+        return session.execute(select(func.count(FaceData.id)).where(FaceData.deleted_at.isnot(None))).scalar()
+
+    def remove_registration_files(self, name, face_id):
+        """Remove the raw uploads and aligned crops of one registration, named ``<face_id>_<n>.*``"""
+        for directory in (self.raw_dataset_dir, self.processed_dataset_dir):
+            person_dir = os.path.join(directory, name)
+            for path in glob.glob(os.path.join(glob.escape(person_dir), glob.escape(face_id) + "_*")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def run_once(self):
+        """Purge all tombstones; returns the names whose files were removed"""
+        start = time.perf_counter()
+        with self.session_factory() as session:
+            tombstones = session.execute(
+                select(FaceData.id, FaceData.name).where(FaceData.deleted_at.isnot(None))).all()
+            if not tombstones:
+                metrics.TOMBSTONES.set(0)
+                return []
+            names = {name for _, name in tombstones}
+            live = set(session.execute(
+                select(FaceData.name).where(FaceData.name.in_(names), FaceData.deleted_at.is_(None))
+                .distinct()).scalars())
+            removed = sorted(names - live)
+            with AlignmentManifest(self.processed_dataset_dir) as manifest:
+                for name in removed:
+                    for directory in (self.raw_dataset_dir, self.processed_dataset_dir):
+                        person_dir = os.path.join(directory, name)
+                        if os.path.isdir(person_dir):
+                            shutil.rmtree(person_dir, ignore_errors=True)
+                    manifest.forget(name + "/")
+                # A name shared with a live registration keeps its directories, but not the
+                # images of the deleted one, or they would be trained as the live person
+                for face_id, name in tombstones:
+                    if name in live:
+                        self.remove_registration_files(name, face_id)
+                        manifest.forget(f"{name}/{face_id}_")
+            session.execute(delete(FaceData).where(FaceData.id.in_([face_id for face_id, _ in tombstones])))
+            session.commit()
+            metrics.TOMBSTONES.set(self.pending(session))
+        if self.compact is not None:
+            self.compact()
+        logger.info("Maintenance purged %d deleted faces, removed the files of %d people in %.1f s",
+                    len(tombstones), len(removed), time.perf_counter() - start)
+        return removed
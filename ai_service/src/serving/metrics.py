@@ -0,0 +1,107 @@
+"""Prometheus metrics of the face recognition service, exposed on ``/metrics``.
+
+Pipeline stages share one histogram labelled by stage so a slow request can be
+attributed to decode, PNet/RNet/ONet, alignment, FaceNet, classification or the
+DB lookup::
+
+    with time_stage("embed"):
+        emb_array = self.embed(images)
+
+PNet is observed once per pyramid scale, RNet and ONet once per call; the
+``detect`` stage covers the whole MTCNN cascade. Every observation is also
+recorded as a span of the current request trace (``serving/tracing.py``).
+Inside ``suppressed()`` (the startup warmup on dummy inputs) nothing is recorded.
+"""
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from serving import tracing
+
+# Per-stage latencies are in the 0.5 ms (classify) to a few seconds (detect on a large frame) range
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+# Alignment and retraining of the whole gallery take seconds to minutes
+JOB_BUCKETS = (.1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+STAGE_LATENCY = Histogram(
+    "face_stage_duration_seconds", "Latency of a recognition pipeline stage", ["stage"], buckets=STAGE_BUCKETS)
+REQUEST_LATENCY = Histogram(
+    "face_http_request_duration_seconds", "HTTP request latency", ["method", "route"], buckets=STAGE_BUCKETS)
+REQUESTS = Counter(
+    "face_http_requests_total", "HTTP requests", ["method", "route", "status"])
+
+FACES_DETECTED = Counter("face_faces_detected_total", "Faces found by MTCNN")
+FACES_REJECTED = Counter("face_faces_rejected_total", "Detected faces not returned as a match", ["reason"])
+IMAGES_REJECTED = Counter("face_register_images_rejected_total", "Registration images failing validation", ["reason"])
+ALIGNMENT_CROPS = Counter(
+    "face_alignment_crops_total", "Registration crops by the alignment strategy that produced them", ["strategy"])
+
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "face_inference_queue_depth", "Requests waiting for or running model inference")
+MODEL_INFO = Gauge(
+    "face_model_info", "Loaded inference models (value is always 1)", ["backend", "embedding_model"])
+CLASSIFIER_VERSION = Gauge(
+    "face_classifier_version", "Modification time (unix seconds) of the classifier in use")
+GALLERY_SIZE = Gauge("face_gallery_size", "Identities known to the classifier")
+GALLERY_TEMPLATES = Gauge("face_gallery_templates", "Templates in the in-memory embedding gallery")
+TOMBSTONES = Gauge("face_tombstones", "Deleted faces waiting for background maintenance")
+ARTIFACTS_PENDING = Gauge(
+    "face_registration_artifacts_pending", "Registrations whose retained images are not written yet")
+
+REGISTRATION_LATENCY = Histogram(
+    "face_registration_duration_seconds", "End-to-end registration latency", ["result"], buckets=JOB_BUCKETS)
+ALIGN_LATENCY = Histogram(
+    "face_align_duration_seconds", "Alignment of one identity's raw images", buckets=JOB_BUCKETS)
+RETRAIN_LATENCY = Histogram(
+    "face_retrain_duration_seconds", "Classifier retraining latency", ["result"], buckets=JOB_BUCKETS)
+
+# Set while stage latencies must not be recorded
+_suppressed = contextvars.ContextVar("face_metrics_suppressed", default=False)
+
+
+@contextmanager
+def suppressed():
+    """Record no stage latencies or spans inside the ``with`` block"""
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+@contextmanager
+def time_stage(stage):
+    """Observe the duration of the ``with`` block in the stage histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if not _suppressed.get():
+            duration = time.perf_counter() - start
+            STAGE_LATENCY.labels(stage).observe(duration)
+            tracing.record(stage, start, duration)
+
+
+def timed(stage, fn):
+    """Wrap ``fn`` so every call is observed as ``stage``"""
+    observe = STAGE_LATENCY.labels(stage).observe
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if not _suppressed.get():
+                duration = time.perf_counter() - start
+                observe(duration)
+                tracing.record(stage, start, duration)
+    return wrapper
+
+
+def render():
+    """Return (body, content_type) of the text exposition format"""
+    return generate_latest(), CONTENT_TYPE_LATEST
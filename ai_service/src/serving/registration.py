@@ -0,0 +1,195 @@
+"""Single-pass registration pipeline.
+
+A ``/register`` call used to write the uploads to ``raw/``, read them back for
+the quality checks, read them a third time to align every image of the person
+(older ones included) into PNG crops, and let the classifier subprocess decode
+all those PNGs again to embed them. Now every upload is decoded once and stays
+in memory through
+
+    decode -> quality gate -> detection and crop -> one batched embedding
+
+The per-image embeddings are stored with the identity (``face_samples``), so
+retraining the classifier reads vectors instead of images.
+
+Nothing has to reach the disk for a registration to succeed. The raw uploads
+and the aligned crops are only written if ``FACE_RETAIN_IMAGES`` asks for them,
+by ``ArtifactWriter`` on a background thread after the response is sent:
+
+``none``
+    Keep nothing (the default).
+``crops``
+    Write the aligned crops to ``processed/<name>/<face_id>_<n>.png``.
+``all``
+    Also keep the uploads in ``raw/<name>/<face_id>_<n>.jpg`` and record them in
+    the alignment manifest, so ``align_dataset_mtcnn.py`` does not align them again.
+"""
+import logging
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from face_recognition_process import facenet
+from face_recognition_process.alignment_manifest import AlignmentManifest, file_digest
+from serving import metrics
+from serving.metrics import time_stage
+
+logger = logging.getLogger("face_recognition_service.registration")
+
+RETENTION = ("none", "crops", "all")
+
+
+def is_image_blurry(gray_img, threshold=100.0):
+    """Trả về True nếu variance của Laplacian < threshold (tức là ảnh mờ)."""
+    return cv2.Laplacian(gray_img, cv2.CV_64F).var() < threshold
+
+
+def is_image_bright_or_dark(gray_img, min_brightness=30, max_brightness=220):
+    """Trả về True nếu độ sáng trung bình < min hoặc > max."""
+    mean_b = float(np.mean(gray_img))
+    return mean_b < min_brightness or mean_b > max_brightness
+
+
+def decode_image(data):
+    """BGR image from encoded bytes, or None if they are not an image"""
+    with time_stage("decode"):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def quality_issues(img):
+    """Rejection reasons of a decoded upload: ``blurry`` and/or ``brightness``"""
+    with time_stage("quality"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        issues = []
+        if is_image_blurry(gray):
+            issues.append("blurry")
+        if is_image_bright_or_dark(gray):
+            issues.append("brightness")
+    return issues
+
+
+class RegistrationPipeline(object):
+
+    def __init__(self, aligner, embed):
+        """``aligner``: an ``AlignmentEngine``; ``embed(prewhitened (N, H, W, 3))`` returns (N, D) embeddings"""
+        self.aligner = aligner
+        self.embed = embed
+
+    def validate(self, uploads):
+        """
+        Decode and quality-check encoded uploads: (images, issues), with ``images[i]``
+        None for an unreadable upload and ``issues[i]`` its rejection reasons.
+        """
+        images, issues = [], []
+        for data in uploads:
+            img = decode_image(data)
+            images.append(img)
+            issues.append(["unreadable"] if img is None else quality_issues(img))
+        return images, issues
+
+    def embed_faces(self, images):
+        """(faces, embeddings): the ``AlignedFace`` of each image and its row of embeddings"""
+        with time_stage("align"):
+            faces = [self.aligner.align(img) for img in images]
+        batch = np.stack([facenet.prewhiten(face.image) for face in faces])
+        return faces, self.embed(batch)
+
+
+def template_of(embeddings):
+    """Normalized mean embedding"""
+    template = np.mean(embeddings, axis=0)
+    return template / np.linalg.norm(template)
+
+
+class ArtifactWriter(object):
+
+    def __init__(self, raw_dataset_dir, processed_dataset_dir, retention="none", manifest_params=None):
+        """``manifest_params``: the alignment parameters registration crops are made with"""
+        if retention not in RETENTION:
+            raise ValueError("Unknown image retention %r (expected one of %s)" % (retention, ", ".join(RETENTION)))
+        self.raw_dataset_dir = raw_dataset_dir
+        self.processed_dataset_dir = processed_dataset_dir
+        self.retention = retention
+        self.manifest_params = manifest_params
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.retention != "none"
+
+    def start(self):
+        if self._thread is None and self.enabled:
+            self._thread = threading.Thread(target=self._run, name="face-artifacts", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Write what is queued, then stop"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def flush(self):
+        """Block until every queued registration is written"""
+        self._queue.join()
+
+    def submit(self, name, face_id, uploads, faces):
+        """Queue the encoded ``uploads`` and their ``faces`` (AlignedFace) for writing; no-op without retention"""
+        if not self.enabled:
+            return
+        self._queue.put((name, face_id, uploads, faces))
+        metrics.ARTIFACTS_PENDING.inc()
+        if self._thread is None:
+            # Not started (tests, tooling): write synchronously
+            self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._process(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            self._process(item)
+
+    def _process(self, item):
+        try:
+            self.write(*item)
+        except Exception:
+            logger.exception("Could not write the registration images of %s", item[0])
+        finally:
+            metrics.ARTIFACTS_PENDING.dec()
+            self._queue.task_done()
+
+    def write(self, name, face_id, uploads, faces):
+        processed_dir = os.path.join(self.processed_dataset_dir, name)
+        os.makedirs(processed_dir, exist_ok=True)
+        outputs = []
+        for position, face in enumerate(faces, start=1):
+            output = os.path.join(processed_dir, f"{face_id}_{position}.png")
+            Image.fromarray(face.image).save(output, format="PNG")
+            outputs.append(output)
+        if self.retention != "all":
+            return
+        raw_dir = os.path.join(self.raw_dataset_dir, name)
+        os.makedirs(raw_dir, exist_ok=True)
+        with AlignmentManifest(self.processed_dataset_dir, self.manifest_params) as manifest:
+            for position, (data, face, output) in enumerate(zip(uploads, faces, outputs), start=1):
+                filename = f"{face_id}_{position}.jpg"
+                source_path = os.path.join(raw_dir, filename)
+                with open(source_path, "wb") as f:
+                    f.write(data)
+                manifest.record(f"{name}/{filename}", source_path, [output], [face.bbox], face.strategy,
+                                digest=file_digest(data=data))
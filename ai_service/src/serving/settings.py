@@ -0,0 +1,209 @@
+"""Runtime configuration for the face recognition service.
+
+Every value can be overridden with a ``FACE_*`` environment variable so a
+deployment (docker-compose, k8s manifest) can tune the service without code
+changes. Reading the settings is cheap and has no side effects.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+from serving.threads import ThreadBudget
+
+# Project base directory (the folder that contains src/, Models/ and Dataset/)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return int(value)
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+def env_int_tuple(name: str, default: Tuple[int, ...]) -> Tuple[int, ...]:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return tuple(int(v) for v in value.replace(" ", "").split(",") if v)
+
+
+@dataclass(frozen=True)
+class Settings:
+    base_dir: str
+    raw_dataset_dir: str
+    processed_dataset_dir: str
+    model_dir: str
+    classifier_path: str
+    facenet_model_path: str
+    mtcnn_model_dir: str
+    # Versioned classifiers and the CURRENT pointer (serving/artifacts.py)
+    classifier_store_dir: str = ""
+    classifier_versions_kept: int = 5
+    # Training backend (face_recognition_process/classifier_backends.py): svc, ncm, logreg or linear_svc
+    classifier_backend: str = "svc"
+    # Identity store (serving/storage.py): sqlite:///... or postgresql+psycopg://...
+    database_url: str = "sqlite:///./face_recognition.db"
+    db_schema: str = ""
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    # Embedding gallery (serving/gallery.py)
+    embedding_dtype: str = "float32"
+    model_version: str = ""
+    gallery_snapshot_path: str = ""
+    # "classifier" (facemodel.pkl probabilities) or "gallery" (nearest template by L2 distance)
+    matcher: str = "classifier"
+    match_threshold: float = 1.1
+    # Calibrated distance thresholds per target FAR (serving/calibration.py); replace the rules above when present
+    threshold_table_path: str = ""
+    target_far: float = 1e-3
+    # Approximate nearest-neighbour index over the gallery (serving/ann.py): none, auto, ivf or hnsw
+    ann_index: str = "none"
+    ann_min_size: int = 1000
+    ivf_nlist: int = 0
+    ivf_nprobe: int = 8
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 200
+    hnsw_ef_search: int = 64
+    # Alignment fallbacks (serving/alignment.py): Haar cascade XML ("" finds OpenCV's) and its downscaled input size
+    haar_cascade_path: str = ""
+    align_fallback_max_side: int = 640
+    # Registration images written after the response (serving/registration.py): none, crops or all
+    retain_images: str = "none"
+    # Seconds between background purges of deleted faces (serving/maintenance.py), 0 disables them
+    maintenance_interval: float = 60.0
+    # Inference-only graph written by face_recognition_process/export_inference_graph.py
+    facenet_optimized_model_path: str = ""
+    use_optimized_graph: bool = False
+    # "tensorflow" or "onnxruntime" (models from face_recognition_process/convert_to_onnx.py)
+    inference_backend: str = "tensorflow"
+    onnx_model_dir: str = ""
+    # INT8 embedder written by face_recognition_process/quantize_embedder.py (onnxruntime only)
+    quantized_embedder: bool = False
+    quantized_embedder_name: str = "facenet_int8.onnx"
+
+    # Thread counts for TF/ORT, OpenCV and BLAS (serving/threads.py)
+    thread_budget: ThreadBudget = field(default_factory=ThreadBudget)
+
+    # Logging (serving/logs.py)
+    log_file: str = "face_service.log"
+    log_level: str = "INFO"
+    log_levels: str = ""
+    log_format: str = "text"
+    log_face_sample_rate: float = 0.1
+
+    # Per-request stage traces (serving/tracing.py): Server-Timing header and sampled JSONL log
+    server_timing: bool = False
+    trace_log_path: str = ""
+    trace_sample_rate: float = 0.0
+    trace_slow_ms: float = 0.0
+
+    # Warmup runs dummy detections/embeddings before the service reports ready
+    warmup_enabled: bool = True
+    warmup_batch_sizes: Tuple[int, ...] = (1, 3)
+    warmup_frame_size: Tuple[int, ...] = (480, 640)
+    warmup_iterations: int = 2
+
+    @property
+    def embedding_model_path(self) -> str:
+        """FaceNet graph to load: the optimized export when enabled and present"""
+        if self.use_optimized_graph and os.path.isfile(self.facenet_optimized_model_path):
+            return self.facenet_optimized_model_path
+        return self.facenet_model_path
+
+    @property
+    def embedding_model_version(self) -> str:
+        """Version tag stored with every template: FACE_MODEL_VERSION or the FaceNet model file name"""
+        if self.model_version:
+            return self.model_version
+        version = os.path.splitext(os.path.basename(self.facenet_model_path))[0]
+        if self.inference_backend == "onnxruntime" and self.quantized_embedder:
+            version += "-int8"
+        return version
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        base_dir = os.environ.get("FACE_BASE_DIR", BASE_DIR)
+        model_dir = os.environ.get("FACE_MODEL_DIR", os.path.join(base_dir, "Models"))
+        return cls(
+            base_dir=base_dir,
+            raw_dataset_dir=os.environ.get(
+                "FACE_RAW_DATASET_DIR", os.path.join(base_dir, "Dataset", "FaceData", "raw")),
+            processed_dataset_dir=os.environ.get(
+                "FACE_PROCESSED_DATASET_DIR", os.path.join(base_dir, "Dataset", "FaceData", "processed")),
+            model_dir=model_dir,
+            classifier_path=os.environ.get("FACE_CLASSIFIER_PATH", os.path.join(model_dir, "facemodel.pkl")),
+            classifier_store_dir=os.environ.get("FACE_CLASSIFIER_STORE", os.path.join(model_dir, "classifiers")),
+            classifier_versions_kept=env_int("FACE_CLASSIFIER_VERSIONS_KEPT", 5),
+            classifier_backend=os.environ.get("FACE_CLASSIFIER_BACKEND", "svc").strip().lower(),
+            facenet_model_path=os.environ.get(
+                "FACE_FACENET_MODEL_PATH", os.path.join(model_dir, "20180402-114759.pb")),
+            mtcnn_model_dir=os.environ.get("FACE_MTCNN_MODEL_DIR", os.path.join(base_dir, "src", "align")),
+            database_url=os.environ.get("FACE_DATABASE_URL", "sqlite:///./face_recognition.db"),
+            db_schema=os.environ.get("FACE_DB_SCHEMA", ""),
+            db_pool_size=env_int("FACE_DB_POOL_SIZE", 5),
+            db_max_overflow=env_int("FACE_DB_MAX_OVERFLOW", 10),
+            db_pool_timeout=env_int("FACE_DB_POOL_TIMEOUT", 30),
+            db_pool_recycle=env_int("FACE_DB_POOL_RECYCLE", 1800),
+            embedding_dtype=os.environ.get("FACE_EMBEDDING_DTYPE", "float32").strip().lower(),
+            model_version=os.environ.get("FACE_MODEL_VERSION", ""),
+            gallery_snapshot_path=os.environ.get("FACE_GALLERY_SNAPSHOT", os.path.join(model_dir, "gallery")),
+            matcher=os.environ.get("FACE_MATCHER", "classifier").strip().lower(),
+            match_threshold=env_float("FACE_MATCH_THRESHOLD", 1.1),
+            threshold_table_path=os.environ.get("FACE_THRESHOLD_TABLE", os.path.join(model_dir, "thresholds.json")),
+            target_far=env_float("FACE_TARGET_FAR", 1e-3),
+            ann_index=os.environ.get("FACE_ANN_INDEX", "none").strip().lower(),
+            ann_min_size=env_int("FACE_ANN_MIN_SIZE", 1000),
+            ivf_nlist=env_int("FACE_IVF_NLIST", 0),
+            ivf_nprobe=env_int("FACE_IVF_NPROBE", 8),
+            hnsw_m=env_int("FACE_HNSW_M", 16),
+            hnsw_ef_construction=env_int("FACE_HNSW_EF_CONSTRUCTION", 200),
+            hnsw_ef_search=env_int("FACE_HNSW_EF_SEARCH", 64),
+            haar_cascade_path=os.environ.get("FACE_HAAR_CASCADE", ""),
+            align_fallback_max_side=env_int("FACE_ALIGN_FALLBACK_MAX_SIDE", 640),
+            retain_images=os.environ.get("FACE_RETAIN_IMAGES", "none").strip().lower(),
+            maintenance_interval=env_float("FACE_MAINTENANCE_INTERVAL", 60.0),
+            facenet_optimized_model_path=os.environ.get(
+                "FACE_FACENET_OPTIMIZED_MODEL_PATH", os.path.join(model_dir, "20180402-114759.inference.pb")),
+            use_optimized_graph=env_bool("FACE_USE_OPTIMIZED_GRAPH", False),
+            inference_backend=os.environ.get("FACE_INFERENCE_BACKEND", "tensorflow").strip().lower(),
+            onnx_model_dir=os.environ.get("FACE_ONNX_MODEL_DIR", os.path.join(model_dir, "onnx")),
+            quantized_embedder=env_bool("FACE_QUANTIZED_EMBEDDER", False),
+            quantized_embedder_name=os.environ.get("FACE_QUANTIZED_EMBEDDER_NAME", "facenet_int8.onnx"),
+            thread_budget=ThreadBudget.profile(
+                os.environ.get("FACE_THREAD_PROFILE", "default").strip().lower()).override(
+                intra_op_threads=env_int("FACE_INTRA_OP_THREADS", None),
+                inter_op_threads=env_int("FACE_INTER_OP_THREADS", None),
+                opencv_threads=env_int("FACE_OPENCV_THREADS", None),
+                blas_threads=env_int("FACE_BLAS_THREADS", None),
+            ),
+            log_file=os.environ.get("FACE_LOG_FILE", "face_service.log"),
+            log_level=os.environ.get("FACE_LOG_LEVEL", "INFO"),
+            log_levels=os.environ.get("FACE_LOG_LEVELS", ""),
+            log_format=os.environ.get("FACE_LOG_FORMAT", "text").strip().lower(),
+            log_face_sample_rate=env_float("FACE_LOG_FACE_SAMPLE_RATE", 0.1),
+            server_timing=env_bool("FACE_SERVER_TIMING", False),
+            trace_log_path=os.environ.get("FACE_TRACE_LOG", os.path.join(base_dir, "traces.jsonl")),
+            trace_sample_rate=env_float("FACE_TRACE_SAMPLE_RATE", 0.0),
+            trace_slow_ms=env_float("FACE_TRACE_SLOW_MS", 0.0),
+            warmup_enabled=env_bool("FACE_WARMUP_ENABLED", True),
+            warmup_batch_sizes=env_int_tuple("FACE_WARMUP_BATCH_SIZES", (1, 3)),
+            warmup_frame_size=env_int_tuple("FACE_WARMUP_FRAME_SIZE", (480, 640)),
+            warmup_iterations=env_int("FACE_WARMUP_ITERATIONS", 2),
+        )
@@ -0,0 +1,210 @@
+"""Identity store: SQLAlchemy models and pooled engines.
+
+The database URL is configurable so several service replicas can share one
+Postgres identity store; SQLite stays the zero-config default for a single
+node. SQLite connections run in WAL mode with ``synchronous=NORMAL`` so a
+``/register`` write does not block concurrent ``/recognition`` readers.
+On Postgres the tables can live in their own schema of the shared SAP
+database (``FACE_DB_SCHEMA``).
+
+Every write to ``faces`` made through a session also bumps the single row of
+``faces_revision`` in the same transaction, so replicas can tell that the
+table changed (see ``serving/gallery.py`` snapshots) without comparing clocks.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, LargeBinary, String, create_engine, event, inspect, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+
+logger = logging.getLogger("face_recognition_service.storage")
+
+Base = declarative_base()
+
+
+class FaceData(Base):
+    __tablename__ = "faces"
+
+    id = Column(String(36), primary_key=True)
+    name = Column(String(255), nullable=False)
+    registered_at = Column(DateTime, nullable=False, default=datetime.now)
+    # Template embedding as a fixed-width blob (serving/gallery.py), see embedding_dtype
+    embedding = Column(LargeBinary)
+    embedding_dtype = Column(String(8))
+    # Embedding model that produced the template; only templates of the serving model are matched
+    model_version = Column(String(64))
+    # SAP tenant the identity was registered for; recognition can be restricted to one tenant
+    tenant_id = Column(String(64))
+    # Tombstone: set by DELETE /faces/{id}; the row and its files are purged by background maintenance
+    deleted_at = Column(DateTime)
+
+    __table_args__ = (
+        # Recognition looks identities up by classifier label, deletion counts the remaining rows of a name
+        Index("ix_faces_name", "name"),
+        # /faces lists identities in registration order
+        Index("ix_faces_registered_at", "registered_at"),
+        # The gallery is loaded per model version at startup
+        Index("ix_faces_model_version", "model_version"),
+        Index("ix_faces_tenant_id", "tenant_id"),
+        # Maintenance looks for tombstones
+        Index("ix_faces_deleted_at", "deleted_at"),
+    )
+
+
+class RosterEntry(Base):
+    """Candidate ``face_id`` is registered for assessment ``assessment_id``"""
+    __tablename__ = "roster_entries"
+
+    assessment_id = Column(String(64), primary_key=True)
+    face_id = Column(String(36), ForeignKey("faces.id", ondelete="CASCADE"), primary_key=True)
+    tenant_id = Column(String(64))
+
+    __table_args__ = (
+        # Deleting a face removes its roster entries
+        Index("ix_roster_entries_face_id", "face_id"),
+    )
+
+class FaceSample(Base):
+    """Embedding of one registration image of ``face_id``, what the classifier is trained on"""
+    __tablename__ = "face_samples"
+
+    face_id = Column(String(36), ForeignKey("faces.id", ondelete="CASCADE"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    embedding = Column(LargeBinary, nullable=False)
+    embedding_dtype = Column(String(8), nullable=False)
+    model_version = Column(String(64), nullable=False)
+
+    __table_args__ = (
+        # Purging a face removes its samples
+        Index("ix_face_samples_face_id", "face_id"),
+    )
+
+
+class FacesRevision(Base):
+    """Change counter of the ``faces`` table, bumped in the transaction of every write to it"""
+    __tablename__ = "faces_revision"
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+
+# Columns added after the first release, with their DDL type, for tables created before them
+ADDED_COLUMNS = {
+    "embedding_dtype": "VARCHAR(8)",
+    "model_version": "VARCHAR(64)",
+    "tenant_id": "VARCHAR(64)",
+    "deleted_at": "TIMESTAMP",
+}
+# Indexes added after the first release (on the added columns and on registered_at), for existing tables
+ADDED_INDEXES = {
+    "ix_faces_registered_at": "registered_at",
+    "ix_faces_model_version": "model_version",
+    "ix_faces_tenant_id": "tenant_id",
+    "ix_faces_deleted_at": "deleted_at",
+}
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Wait for a concurrent writer instead of failing with "database is locked"
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def create_db_engine(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, schema=""):
+    """Create a pooled engine for ``url`` (sqlite:/// or postgresql://)"""
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+        )
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+        return engine
+
+    connect_args = {}
+    if schema:
+        # Unqualified table names resolve to the service's schema (created by init_db)
+        connect_args["options"] = f"-csearch_path={schema}"
+    return create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        # Drop connections the server or a proxy closed while idle instead of failing a request
+        pool_pre_ping=True,
+    )
+
+
+def create_session_factory(engine):
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def init_db(engine, schema=""):
+    """Create the schema (Postgres) and the tables if they do not exist"""
+    if schema and engine.dialect.name != "sqlite":
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+    Base.metadata.create_all(bind=engine)
+    _add_missing_columns(engine)
+    _add_missing_indexes(engine)
+    _ensure_revision_row(engine)
+    logger.info("Identity store ready on %s", engine.url.render_as_string(hide_password=True))
+
+
+def _add_missing_columns(engine):
+    existing = {column["name"] for column in inspect(engine).get_columns(FaceData.__tablename__)}
+    missing = [name for name in ADDED_COLUMNS if name not in existing]
+    if not missing:
+        return
+    with engine.begin() as connection:
+        for name in missing:
+            connection.execute(text(f"ALTER TABLE {FaceData.__tablename__} ADD COLUMN {name} {ADDED_COLUMNS[name]}"))
+    logger.info("Added columns %s to the %s table", ", ".join(missing), FaceData.__tablename__)
+
+
+def _add_missing_indexes(engine):
+    existing = {index["name"] for index in inspect(engine).get_indexes(FaceData.__tablename__)}
+    missing = [name for name in ADDED_INDEXES if name not in existing]
+    if not missing:
+        return
+    with engine.begin() as connection:
+        for index_name in missing:
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {FaceData.__tablename__} ({ADDED_INDEXES[index_name]})"))
+    logger.info("Added indexes %s to the %s table", ", ".join(missing), FaceData.__tablename__)
+
+
+def _ensure_revision_row(engine):
+    with engine.begin() as connection:
+        if connection.execute(text(f"SELECT 1 FROM {FacesRevision.__tablename__} WHERE id = 1")).first() is None:
+            connection.execute(text(f"INSERT INTO {FacesRevision.__tablename__} (id, revision) VALUES (1, 0)"))
+
+
+def _bump_faces_revision(session):
+    session.execute(update(FacesRevision).where(FacesRevision.id == 1)
+                    .values(revision=FacesRevision.revision + 1))
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_on_flush(session, flush_context, instances):
+    """Added, modified or deleted FaceData objects change the table"""
+    if any(isinstance(obj, FaceData) for obj in (*session.new, *session.dirty, *session.deleted)):
+        _bump_faces_revision(session)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bump_on_bulk_write(orm_execute_state):
+    """So do ORM-enabled ``update(FaceData)``/``delete(FaceData)`` statements"""
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            orm_execute_state.bind_mapper is FaceData.__mapper__:
+        _bump_faces_revision(orm_execute_state.session)
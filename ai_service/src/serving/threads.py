@@ -0,0 +1,107 @@
+"""Thread budget shared by TensorFlow / ONNX Runtime, OpenCV and the BLAS library.
+
+Every library sizes its own thread pool to the number of cores, so in one
+process they oversubscribe the CPU and tail latency spikes. A ``ThreadBudget``
+sets all of them from one place. Two named profiles are provided:
+
+``latency``
+    One request at a time gets the whole machine: intra-op parallelism uses
+    every core, independent ops run one after another and OpenCV/BLAS stay
+    single-threaded so they never compete with the inference pool.
+``throughput``
+    Many concurrent requests each get a small slice: two intra-op threads
+    per op and enough inter-op threads to keep the cores busy.
+
+``default`` leaves every library at its own default (the previous behaviour).
+A value of 0 always means "library default".
+"""
+import logging
+import os
+from dataclasses import dataclass, replace
+
+logger = logging.getLogger("face_recognition_service.threads")
+
+THREAD_PROFILES = ("default", "latency", "throughput")
+
+# Read by OpenBLAS / MKL / OpenMP at load time, and inherited by subprocesses
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def available_cpus() -> int:
+    """Cores this process may run on (respects cgroup cpusets / taskset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    name: str = "default"
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    opencv_threads: int = 0
+    blas_threads: int = 0
+
+    @classmethod
+    def profile(cls, name: str, cpus: int = None) -> "ThreadBudget":
+        cpus = cpus or available_cpus()
+        if name == "default":
+            return cls()
+        if name == "latency":
+            return cls(name, intra_op_threads=cpus, inter_op_threads=1, opencv_threads=1, blas_threads=1)
+        if name == "throughput":
+            return cls(name, intra_op_threads=min(2, cpus), inter_op_threads=max(1, cpus // 2),
+                       opencv_threads=1, blas_threads=1)
+        raise ValueError(f"Unknown thread profile '{name}', expected one of {THREAD_PROFILES}")
+
+    def override(self, **threads) -> "ThreadBudget":
+        """Replace the counts that are not None (explicit env overrides on top of a profile)"""
+        threads = {key: value for key, value in threads.items() if value is not None}
+        return replace(self, **threads) if threads else self
+
+    def tf_session_config(self):
+        import tensorflow as tf
+        return tf.compat.v1.ConfigProto(intra_op_parallelism_threads=self.intra_op_threads,
+                                        inter_op_parallelism_threads=self.inter_op_threads)
+
+    def ort_session_options(self):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        if self.inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        return options
+
+
+def apply_process_limits(budget: ThreadBudget):
+    """
+    Apply the OpenCV and BLAS part of the budget to the current process.
+
+    BLAS libraries read their environment variables when they are loaded, so
+    for an already imported numpy the limit is applied through threadpoolctl
+    when it is installed; the variables still reach training subprocesses.
+
+    Returns the threadpoolctl limiter (``restore_original_limits()`` undoes
+    the BLAS limit), or None when no BLAS limit was applied in-process.
+    """
+    limiter = None
+    if budget.opencv_threads > 0:
+        import cv2
+        cv2.setNumThreads(budget.opencv_threads)
+
+    if budget.blas_threads > 0:
+        for var in BLAS_ENV_VARS:
+            os.environ[var] = str(budget.blas_threads)
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            logger.warning("threadpoolctl is not installed, BLAS threads only limited for subprocesses")
+        else:
+            limiter = threadpool_limits(limits=budget.blas_threads, user_api="blas")
+
+    logger.info("Thread budget '%s': intra_op=%d inter_op=%d opencv=%d blas=%d (%d cpus)",
+                budget.name, budget.intra_op_threads, budget.inter_op_threads, budget.opencv_threads,
+                budget.blas_threads, available_cpus())
+    return limiter
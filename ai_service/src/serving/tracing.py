@@ -0,0 +1,122 @@
+"""Per-request stage traces.
+
+The HTTP middleware starts a ``Trace`` for a request and stores it in a
+context variable; every ``metrics.time_stage`` block and ``metrics.timed``
+call (decode, pnet/rnet/onet, align, embed, classify, db_lookup, ...) then
+appends a span to it. Without an active trace ``record`` is a single
+context variable lookup.
+
+A finished trace is returned as a ``Server-Timing`` header (spans of the same
+stage summed, so PNet shows the total over all pyramid scales) and can be
+appended as one JSON line to a trace log, sampled at a fixed rate and always
+for requests slower than a threshold.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger("face_recognition_service.tracing")
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("face_trace", default=None)
+
+
+class Trace(object):
+    __slots__ = ("request_id", "method", "path", "start", "wall_start", "spans", "duration")
+
+    def __init__(self, method, path, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans = []
+        self.duration = None
+
+    def add(self, name, start, duration):
+        self.spans.append((name, start - self.start, duration))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def stage_totals(self):
+        """{stage: (total seconds, number of spans)} in first-seen order"""
+        totals = {}
+        for name, _, duration in self.spans:
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + duration, count + 1)
+        return totals
+
+    def server_timing(self):
+        entries = []
+        for name, (total, count) in self.stage_totals().items():
+            entry = f"{name};dur={total * 1000.0:.2f}"
+            if count > 1:
+                entry += f';desc="{count} calls"'
+            entries.append(entry)
+        if self.duration is not None:
+            entries.append(f"total;dur={self.duration * 1000.0:.2f}")
+        return ", ".join(entries)
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "timestamp": self.wall_start,
+            "duration_ms": round(self.duration * 1000.0, 3) if self.duration is not None else None,
+            "spans": [{"stage": name, "offset_ms": round(offset * 1000.0, 3), "duration_ms": round(duration * 1000.0, 3)}
+                      for name, offset, duration in self.spans],
+        }
+
+
+def start_trace(method, path, request_id=None):
+    """Create a trace and make it current; returns (trace, token for ``end_trace``)"""
+    trace = Trace(method, path, request_id)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record(name, start, duration):
+    """Add a span to the current trace, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, duration)
+
+
+class TraceSampler(object):
+    """Appends sampled traces to a JSONL file"""
+
+    def __init__(self, path, sample_rate=0.0, slow_ms=0.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path) and (self.sample_rate > 0 or self.slow_ms > 0)
+
+    def should_write(self, trace):
+        if self.slow_ms > 0 and trace.duration * 1000.0 >= self.slow_ms:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def write(self, trace):
+        line = json.dumps(trace.to_dict(), separators=(",", ":")) + "\n"
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            logger.warning("Could not write trace to %s: %s", self.path, e)
@@ -0,0 +1,50 @@
+"""Warmup pass that runs the inference graphs on dummy inputs.
+
+The first ``session.run`` for a given input shape pays for TensorFlow kernel
+selection and memory allocation. Running MTCNN and FaceNet once per common
+batch size during startup moves that cost out of the first real request.
+The dummy calls are kept out of the stage latency metrics.
+"""
+import logging
+import time
+
+import numpy as np
+
+from serving import metrics
+
+logger = logging.getLogger("face_recognition_service.warmup")
+
+
+def warmup(service, batch_sizes=(1, 3), frame_size=(480, 640), iterations=2):
+    """Run dummy detections and embeddings through ``service``.
+
+    Returns a dict mapping each warmed stage to the latency (seconds) of the
+    last iteration, so callers can log how close to steady state it got.
+    """
+    rng = np.random.RandomState(0)
+    height, width = frame_size[0], frame_size[1]
+    frame = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+    image_size = service.INPUT_IMAGE_SIZE
+
+    timings = {}
+    with metrics.suppressed():
+        for _ in range(max(1, iterations)):
+            # Full pyramid: one PNet call per scale of a typical webcam frame
+            start = time.perf_counter()
+            service.detect(frame)
+            timings["detect_%dx%d" % (height, width)] = time.perf_counter() - start
+
+            # RNet/ONet/FaceNet only run when candidates survive, so drive them directly
+            for batch_size in batch_sizes:
+                start = time.perf_counter()
+                service.rnet(np.zeros((batch_size, 24, 24, 3), dtype=np.float32))
+                service.onet(np.zeros((batch_size, 48, 48, 3), dtype=np.float32))
+                timings["rnet_onet_%d" % batch_size] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                service.embed(np.zeros((batch_size, image_size, image_size, 3), dtype=np.float32))
+                timings["embed_%d" % batch_size] = time.perf_counter() - start
+
+    for stage, seconds in sorted(timings.items()):
+        logger.info("Warmup %s: %.1f ms", stage, seconds * 1000.0)
+    return timings
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import imageio
+
+import align_dataset_mtcnn
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class AlignDatasetMtcnnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'raw')
+        self.output_dir = os.path.join(self.tmp_dir, 'processed')
+        for name, images in (('p1', ['img.png', 'img_1.png']), ('p2', ['img_2.png'])):
+            os.makedirs(os.path.join(self.input_dir, name))
+            for image in images:
+                shutil.copy(os.path.join(TEST_DIR, image), os.path.join(self.input_dir, name, image))
+        with open(os.path.join(self.input_dir, 'p2', 'broken.jpg'), 'wb') as f:
+            f.write(b'not an image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def align(self, *extra):
+        args = align_dataset_mtcnn.parse_arguments([self.input_dir, self.output_dir, '--image_size', '160'] +
+                                                   list(extra))
+        align_dataset_mtcnn.main(args)
+        with open(os.path.join(self.output_dir, 'bounding_boxes.txt')) as f:
+            rows = sorted(line.split() for line in f)
+        with open(os.path.join(self.output_dir, 'manifest.jsonl')) as f:
+            log = [json.loads(line) for line in f]
+        return rows, log
+
+    def testWorkersAndIncrementalRuns(self):
+        rows, log = self.align('--workers', '2', '--progress_interval', '0')
+        expected = sorted(os.path.join(self.output_dir, name) for name in ('p1/img.png', 'p1/img_1.png', 'p2/img_2.png'))
+        self.assertEqual([row[0] for row in rows], expected)
+        for row in rows:
+            self.assertEqual(len(row), 5)
+            self.assertEqual(imageio.imread(row[0]).shape, (160, 160, 3))
+        # The unreadable image is retried next time, so it has no entry
+        self.assertEqual(sorted(entry['source'] for entry in log), ['p1/img.png', 'p1/img_1.png', 'p2/img_2.png'])
+
+        # Nothing changed: nothing is aligned or logged again
+        self.assertEqual(self.align()[1], log)
+
+        # A touched but identical image only refreshes its stat; an edited one is aligned again
+        source = os.path.join(self.input_dir, 'p1', 'img.png')
+        os.utime(source, (time.time() + 10, time.time() + 10))
+        shutil.copy(os.path.join(TEST_DIR, 'img_2.png'), os.path.join(self.input_dir, 'p1', 'img_1.png'))
+        _, new_log = self.align()
+        appended = {entry['source']: entry for entry in new_log[len(log):]}
+        self.assertEqual(sorted(appended), ['p1/img.png', 'p1/img_1.png'])
+        self.assertEqual(appended['p1/img.png']['boxes'], log[[e['source'] for e in log].index('p1/img.png')]['boxes'])
+        self.assertNotEqual(appended['p1/img_1.png']['sha1'],
+                            log[[e['source'] for e in log].index('p1/img_1.png')]['sha1'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from alignment_manifest import AlignmentManifest, file_digest
+
+
+class AlignmentManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raw = os.path.join(self.tmp_dir, 'raw')
+        self.processed = os.path.join(self.tmp_dir, 'processed')
+        os.makedirs(os.path.join(self.raw, 'ann'))
+        os.makedirs(os.path.join(self.processed, 'ann'))
+        self.source = os.path.join(self.raw, 'ann', 'a.jpg')
+        self.write(self.source, b'image one')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def testRecordAndReload(self):
+        output = os.path.join(self.processed, 'ann', 'a.png')
+        self.write(output, b'crop')
+        with AlignmentManifest(self.processed, {'image_size': 160}) as manifest:
+            self.assertEqual(manifest.check('ann/a.jpg', self.source), (False, None))
+            manifest.record('ann/a.jpg', self.source, [output], [[1, 2, 3, 4]], 'mtcnn')
+        manifest = AlignmentManifest(self.processed, {'image_size': 160})
+        current, entry = manifest.check('ann/a.jpg', self.source)
+        self.assertTrue(current)
+        self.assertEqual(entry['outputs'], ['ann/a.png'])
+        self.assertEqual(entry['sha1'], file_digest(self.source))
+        self.assertEqual(entry['detector'], 'mtcnn')
+        # Other parameters make every entry stale
+        self.assertFalse(AlignmentManifest(self.processed, {'image_size': 182}).check('ann/a.jpg', self.source)[0])
+
+    def testChangedSourceAndStaleOutputs(self):
+        old_output = os.path.join(self.processed, 'ann', 'a_0.png')
+        self.write(old_output, b'crop')
+        with AlignmentManifest(self.processed) as manifest:
+            manifest.record('ann/a.jpg', self.source, [old_output], [[0, 0, 1, 1]], 'mtcnn')
+            stat = os.stat(self.source)
+            os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            current, entry = manifest.check('ann/a.jpg', self.source)
+            self.assertFalse(current)
+            self.assertTrue(manifest.unchanged_content(entry, file_digest(self.source)))
+            manifest.refresh(entry, os.stat(self.source))
+            self.assertTrue(manifest.check('ann/a.jpg', self.source)[0])
+
+            self.write(self.source, b'image two')
+            current, entry = manifest.check('ann/a.jpg', self.source)
+            self.assertFalse(manifest.unchanged_content(entry, file_digest(self.source)))
+            manifest.record('ann/a.jpg', self.source, ['ann/a.png'], [[0, 0, 2, 2]], 'haar', previous=entry)
+        self.assertFalse(os.path.exists(old_output))
+
+    def testTornLineForgetAndCompact(self):
+        with AlignmentManifest(self.processed) as manifest:
+            manifest.record('ann/a.jpg', self.source, [], [], 'none')
+            manifest.record('bob/b.jpg', self.source, ['bob/b.png'], [[0, 0, 1, 1]], 'center')
+            manifest.forget('ann/')
+        with open(manifest.path, 'a') as f:
+            f.write('{"source": "torn')
+        manifest = AlignmentManifest(self.processed)
+        self.assertEqual(list(manifest.entries), ['bob/b.jpg'])
+        manifest.compact()
+        with open(manifest.path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        manifest.write_bounding_boxes(os.path.join(self.processed, 'bounding_boxes.txt'))
+        with open(os.path.join(self.processed, 'bounding_boxes.txt')) as f:
+            self.assertEqual(f.read(), '%s 0 0 1 1\n' % os.path.join(self.processed, 'bob/b.png'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+from serving import metrics
+from serving.alignment import AlignmentEngine, load_cascade
+
+
+class FakeCascade(object):
+    """Finds one 'face' at a fixed place of the original image, in the coordinates of its input"""
+
+    def __init__(self, box, original_width):
+        self.box = np.array(box, dtype=np.float64)
+        self.original_width = original_width
+        self.shapes = []
+
+    def detectMultiScale(self, gray, scale_factor, min_neighbors):
+        self.shapes.append(gray.shape)
+        scale = gray.shape[1] / float(self.original_width)
+        return np.array([np.round(self.box * scale).astype(np.int32), [0, 0, 4, 4]])
+
+
+def no_faces(img):
+    return np.zeros((0, 5)), np.zeros((10, 0))
+
+
+def crops(strategy):
+    return metrics.ALIGNMENT_CROPS.labels(strategy)._value.get()
+
+
+class AlignmentTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.img = rng.randint(0, 255, size=(1200, 1600, 3), dtype=np.uint8)
+
+    def testMtcnnLargestFaceWithMargin(self):
+        seen = []
+
+        def detect(img):
+            seen.append(img)
+            return np.array([[10, 10, 50, 50, 0.9], [100, 200, 300, 500, 0.99]]), None
+
+        before = crops('mtcnn')
+        face = AlignmentEngine(detect, image_size=160, margin=44).align(self.img)
+        self.assertEqual(face.strategy, 'mtcnn')
+        self.assertEqual(face.bbox, [78, 178, 322, 522])
+        self.assertEqual(face.image.shape, (160, 160, 3))
+        self.assertEqual(face.image.dtype, np.uint8)
+        # MTCNN gets RGB
+        np.testing.assert_array_equal(seen[0], self.img[:, :, ::-1])
+        self.assertEqual(crops('mtcnn'), before + 1)
+
+    def testHaarRunsDownscaled(self):
+        cascade = FakeCascade([400, 300, 200, 200], 1600)
+        before = crops('haar')
+        face = AlignmentEngine(no_faces, cascade=cascade, fallback_max_side=400).align(self.img)
+        self.assertEqual(cascade.shapes, [(300, 400)])
+        self.assertEqual(face.strategy, 'haar')
+        # 200 px face plus 40% margin around its center (500, 400)
+        self.assertEqual(face.bbox, [360, 260, 640, 540])
+        self.assertEqual(crops('haar'), before + 1)
+
+    def testCenterCropWithoutDetections(self):
+        cascade = FakeCascade([0, 0, 0, 0], 1600)
+        cascade.detectMultiScale = lambda gray, scale_factor, min_neighbors: ()
+        portrait = self.img.transpose(1, 0, 2)
+        face = AlignmentEngine(no_faces, cascade=cascade).align(portrait)
+        self.assertEqual(face.strategy, 'center')
+        self.assertEqual(face.bbox, [0, 40, 1200, 1240])
+        self.assertEqual(AlignmentEngine(no_faces).align(self.img).bbox, [200, 0, 1400, 1200])
+
+    def testMissingCascade(self):
+        self.assertIsNone(load_cascade(None))
+        self.assertIsNone(load_cascade('/nonexistent/haarcascade.xml'))
+
+
+if __name__ == "__main__":
+    unittest.main()
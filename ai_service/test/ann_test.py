@@ -0,0 +1,95 @@
+import unittest
+
+import numpy as np
+
+from serving.ann import IVFIndex, build_index, exact_search
+from serving.gallery import Gallery
+
+try:
+    import hnswlib  # noqa: F401
+    HAVE_HNSWLIB = True
+except ImportError:
+    HAVE_HNSWLIB = False
+
+
+def clustered(rng, n, dim=64, nclusters=20):
+    """Normalized vectors around a few centres, so coarse quantization is meaningful"""
+    centres = rng.normal(size=(nclusters, dim))
+    x = centres[rng.randint(nclusters, size=n)] + 0.3 * rng.normal(size=(n, dim))
+    x = x.astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def recall_at_1(index, ids, embeddings, queries):
+    exact_rows, _ = exact_search(embeddings, queries, 1)
+    found, _ = index.search(queries, 1)
+    return np.mean([result[0] == ids[row[0]] for result, row in zip(found, exact_rows)])
+
+
+class AnnTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.embeddings = clustered(rng, 2000)
+        self.ids = ['id%d' % i for i in range(len(self.embeddings))]
+        self.queries = self.embeddings[:100] + 0.05 * rng.normal(size=(100, 64)).astype(np.float32)
+
+    def testExactSearchOrdersBySimilarity(self):
+        rows, sims = exact_search(self.embeddings, self.embeddings[[5, 7]], 3)
+        self.assertEqual(rows.shape, (2, 3))
+        np.testing.assert_array_equal(rows[:, 0], [5, 7])
+        self.assertTrue(np.all(np.diff(sims, axis=1) <= 0))
+
+    def testIvfProbingAllCellsIsExact(self):
+        index = IVFIndex.build(self.ids, self.embeddings, nlist=16, nprobe=16)
+        self.assertEqual(len(index), 2000)
+        self.assertEqual(recall_at_1(index, self.ids, self.embeddings, self.queries), 1.0)
+
+    def testIvfRecall(self):
+        index = IVFIndex.build(self.ids, self.embeddings, nlist=32, nprobe=4)
+        self.assertGreaterEqual(recall_at_1(index, self.ids, self.embeddings, self.queries), 0.9)
+
+    def testIvfAddAndRemove(self):
+        index = IVFIndex.build(self.ids[:1000], self.embeddings[:1000], nlist=16, nprobe=16)
+        for face_id, embedding in zip(self.ids[1000:], self.embeddings[1000:]):
+            index.add(face_id, embedding)
+        self.assertEqual(len(index), 2000)
+        self.assertEqual(index.search(self.embeddings[1500], 1)[0][0][0], 'id1500')
+        self.assertTrue(index.remove('id1500'))
+        self.assertFalse(index.remove('id1500'))
+        self.assertNotIn('id1500', index.search(self.embeddings[1500], 10)[0][0])
+        self.assertEqual(index.search(self.embeddings[1999], 1)[0][0][0], 'id1999')
+
+    @unittest.skipUnless(HAVE_HNSWLIB, 'hnswlib is not installed')
+    def testHnswAddRemoveAndRecall(self):
+        index = build_index('hnsw', self.ids[:1500], self.embeddings[:1500], hnsw_ef_search=64)
+        for face_id, embedding in zip(self.ids[1500:], self.embeddings[1500:]):
+            index.add(face_id, embedding)
+        self.assertGreaterEqual(recall_at_1(index, self.ids, self.embeddings, self.queries), 0.95)
+        self.assertTrue(index.remove('id10'))
+        self.assertNotIn('id10', index.search(self.embeddings[10], 5)[0][0])
+        _, sims = index.search(self.embeddings[11], 1)
+        self.assertAlmostEqual(float(sims[0][0]), 1.0, places=4)
+
+    def testUnknownIndex(self):
+        with self.assertRaises(ValueError):
+            build_index('lsh', self.ids, self.embeddings)
+
+    def testGallerySwitchesToIndexAtMinSize(self):
+        gallery = Gallery('v1', self.ids[:99], ['name'] * 99, self.embeddings[:99].copy(), dim=64)
+        gallery.enable_ann(lambda ids, embeddings: IVFIndex.build(ids, embeddings, nlist=4, nprobe=4), 100)
+        self.assertIsNone(gallery.index)
+        self.assertEqual(gallery.search(self.embeddings[3], 1)[0][0], ['id3'])
+
+        gallery.add('id99', 'name', self.embeddings[99])
+        self.assertEqual(len(gallery.index), 100)
+        gallery.add('new', 'new name', self.embeddings[500])
+        gallery.remove('id3')
+        ids, _ = gallery.search(self.embeddings[[500, 3]], 1)
+        self.assertEqual(ids[0], ['new'])
+        self.assertNotEqual(ids[1], ['id3'])
+        self.assertEqual(gallery.name_of('new'), 'new name')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,448 @@
+import dataclasses
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+import cv2
+import numpy as np
+from datetime import datetime
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import application
+from face_recognition_process import facenet
+from serving.alignment import AlignmentEngine
+from serving.calibration import ThresholdTable
+from serving import metrics
+from serving.gallery import Gallery, encode_embedding
+from serving.storage import create_db_engine, create_session_factory, init_db
+from serving.tracing import current_trace
+from serving.warmup import warmup
+
+
+class FakeFaceService(object):
+    INPUT_IMAGE_SIZE = 160
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else application.settings
+        self.calls = []
+        self.closed = False
+
+    def detect(self, img):
+        self.calls.append(('detect', img.shape))
+        return np.empty((0, 5)), np.empty(0)
+
+    def rnet(self, img):
+        self.calls.append(('rnet', img.shape))
+
+    def onet(self, img):
+        self.calls.append(('onet', img.shape))
+
+    def embed(self, images):
+        self.calls.append(('embed', images.shape))
+        return np.zeros((images.shape[0], 512), dtype=np.float32)
+
+    def close(self):
+        self.closed = True
+
+
+class CropEmbeddingFaceService(FakeFaceService):
+    """Embeds crop files to a vector derived from their face id"""
+
+    def embed_crops(self, paths):
+        self.calls.append(('embed_crops', len(paths)))
+        embeddings = []
+        for path in paths:
+            rng = np.random.RandomState(sum(os.path.basename(path).split('_')[0].encode()))
+            embedding = rng.normal(size=512).astype(np.float32)
+            embeddings.append(embedding / np.linalg.norm(embedding))
+        return embeddings
+
+
+class FixedFacesService(FakeFaceService):
+    """Returns the same detected faces for every image"""
+
+    def __init__(self, settings=None, faces=()):
+        super().__init__(settings)
+        self.faces = list(faces)
+
+    def detect_faces(self, image_path, gallery=None, candidates=None):
+        return [dict(face) for face in self.faces]
+
+
+class NoModelFaceService(application.FaceRecognitionService):
+    """The real service without inference models"""
+
+    def init_face_recognition(self):
+        pass
+
+
+class ApplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.settings = dataclasses.replace(
+            application.settings,
+            raw_dataset_dir=os.path.join(self.tmp_dir, 'raw'),
+            processed_dataset_dir=os.path.join(self.tmp_dir, 'processed'),
+            model_dir=os.path.join(self.tmp_dir, 'Models'),
+            gallery_snapshot_path=os.path.join(self.tmp_dir, 'Models', 'gallery'),
+            threshold_table_path=os.path.join(self.tmp_dir, 'Models', 'thresholds.json'),
+            warmup_batch_sizes=(1, 3),
+            warmup_frame_size=(120, 160),
+            warmup_iterations=1)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def testNotReadyBeforeStartup(self):
+        app = application.create_app(self.settings, service_factory=FakeFaceService)
+        client = TestClient(app)
+        self.assertEqual(client.get('/health').status_code, 200)
+        self.assertEqual(client.get('/ready').status_code, 503)
+
+    def testReadyAfterLifespan(self):
+        services = []
+
+        def factory(settings):
+            services.append(FakeFaceService(settings))
+            return services[-1]
+
+        app = application.create_app(self.settings, service_factory=factory)
+        with TestClient(app) as client:
+            response = client.get('/ready')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('embed_3', response.json()['warmup_ms'])
+        self.assertEqual(len(services), 1)
+        self.assertTrue(services[0].closed)
+
+    def testMetricsEndpoint(self):
+        app = application.create_app(self.settings, service_factory=FakeFaceService)
+        with TestClient(app) as client:
+            self.assertEqual(client.get('/ready').status_code, 200)
+            with application.time_stage('decode'):
+                pass
+            response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        self.assertIn('face_http_requests_total{method="GET",route="/ready",status="200"}', response.text)
+        self.assertIn('face_stage_duration_seconds_count{stage="decode"}', response.text)
+        self.assertIn('face_inference_queue_depth 0.0', response.text)
+
+    def testServerTimingAndTraceLog(self):
+        trace_log = os.path.join(self.tmp_dir, 'traces.jsonl')
+        settings = dataclasses.replace(self.settings, server_timing=True, trace_log_path=trace_log,
+                                       trace_sample_rate=1.0)
+        app = application.create_app(settings, service_factory=FakeFaceService)
+
+        @app.get('/stages')
+        def stages():
+            for _ in range(2):
+                with application.time_stage('pnet'):
+                    pass
+            with application.time_stage('embed'):
+                pass
+            return {}
+
+        with TestClient(app) as client:
+            response = client.get('/stages', headers={'X-Request-ID': 'exam-42'})
+        self.assertEqual(response.headers['X-Request-ID'], 'exam-42')
+        entries = [entry.strip() for entry in response.headers['Server-Timing'].split(',')]
+        self.assertTrue(entries[0].startswith('pnet;dur='))
+        self.assertTrue(entries[0].endswith(';desc="2 calls"'))
+        self.assertTrue(entries[1].startswith('embed;dur='))
+        self.assertTrue(entries[2].startswith('total;dur='))
+
+        with open(trace_log) as f:
+            traces = [json.loads(line) for line in f]
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]['request_id'], 'exam-42')
+        self.assertEqual([span['stage'] for span in traces[0]['spans']], ['pnet', 'pnet', 'embed'])
+
+    def testTracingDisabledByDefault(self):
+        app = application.create_app(self.settings, service_factory=FakeFaceService)
+        with TestClient(app) as client:
+            response = client.get('/ready')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertIsNone(current_trace())
+
+    def testQueuedJsonLogging(self):
+        log_file = os.path.join(self.tmp_dir, 'service.log')
+        settings = dataclasses.replace(self.settings, log_file=log_file, log_format='json',
+                                       log_levels='face_recognition_service.faces=DEBUG',
+                                       log_face_sample_rate=0.0, server_timing=True)
+        self.addCleanup(logging.getLogger('face_recognition_service.faces').setLevel, logging.NOTSET)
+        app = application.create_app(settings, service_factory=FakeFaceService)
+
+        @app.get('/log')
+        def log():
+            application.logger.info('matched %d faces', 2, extra={'faces': 2})
+            application.face_logger.debug('dropped by sampling %s', 'x')
+            application.face_logger.warning('kept despite sampling')
+            return {}
+
+        with TestClient(app) as client:
+            client.get('/log', headers={'X-Request-ID': 'req-1'})
+        self.assertFalse(any(isinstance(handler, logging.handlers.QueueHandler)
+                             for handler in logging.getLogger().handlers))
+
+        with open(log_file) as f:
+            records = [json.loads(line) for line in f]
+        matched = [r for r in records if r['msg'] == 'matched 2 faces']
+        self.assertEqual(len(matched), 1)
+        self.assertEqual(matched[0]['request_id'], 'req-1')
+        self.assertEqual(matched[0]['faces'], 2)
+        self.assertEqual(matched[0]['logger'], 'face_recognition_service')
+        self.assertFalse(any(r['msg'].startswith('dropped') for r in records))
+        self.assertTrue(any(r['msg'] == 'kept despite sampling' for r in records))
+
+    def useDatabase(self, db_path):
+        """Point the module-level engine at a database of this test"""
+        engine = create_db_engine('sqlite:///' + db_path)
+        self.addCleanup(engine.dispose)
+        for name, value in (('engine', engine), ('SessionLocal', create_session_factory(engine))):
+            patcher = mock.patch.object(application, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return engine
+
+    def deleteFaces(self, *face_ids):
+        with application.SessionLocal() as db:
+            db.query(application.RosterEntry).filter(application.RosterEntry.face_id.in_(face_ids)).delete()
+            db.query(application.FaceData).filter(application.FaceData.id.in_(face_ids)).delete()
+            db.commit()
+        application.engine.dispose()
+
+    def testAssessmentRoster(self):
+        # The module-level engine points at the service database, so use ids no other row has
+        a, b = sorted(str(uuid.uuid4()) for _ in range(2))
+        self.addCleanup(self.deleteFaces, a, b)
+        app = application.create_app(self.settings, service_factory=FakeFaceService)
+        with TestClient(app) as client:
+            with application.SessionLocal() as db:
+                db.add_all([application.FaceData(id=face_id, name=face_id, registered_at=datetime.now())
+                            for face_id in (a, b)])
+                db.commit()
+            response = client.put('/assessments/exam1/roster', json={'face_ids': [a, b, a]})
+            self.assertEqual(response.json(), {'assessment_id': 'exam1', 'candidates': 2})
+            self.assertEqual(client.get('/assessments/exam1/roster').json()['face_ids'], [a, b])
+            response = client.put('/assessments/exam1/roster', json={'face_ids': [b, 'unknown']})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(client.get('/assessments/exam2/roster').status_code, 404)
+            response = client.post('/recognition', data={'assessment_id': 'exam2'},
+                                   files={'image': ('a.jpg', b'not an image', 'image/jpeg')})
+            self.assertEqual(response.status_code, 404)
+
+    def testDeleteOnlyTombstones(self):
+        face_id = str(uuid.uuid4())
+        self.addCleanup(self.deleteFaces, face_id)
+        settings = dataclasses.replace(self.settings, maintenance_interval=0)
+        app = application.create_app(settings, service_factory=FakeFaceService)
+        with TestClient(app) as client:
+            with application.SessionLocal() as db:
+                db.add(application.FaceData(id=face_id, name=face_id, registered_at=datetime.now()))
+                db.commit()
+            self.assertIn(face_id, [face['id'] for face in client.get('/faces').json()])
+            self.assertEqual(client.delete('/faces/' + face_id).status_code, 200)
+            self.assertNotIn(face_id, [face['id'] for face in client.get('/faces').json()])
+            self.assertEqual(client.delete('/faces/' + face_id).status_code, 404)
+            with application.SessionLocal() as db:
+                self.assertIsNotNone(db.get(application.FaceData, face_id).deleted_at)
+
+    def testDeleteLogsFaceIdField(self):
+        face_id = str(uuid.uuid4())
+        self.addCleanup(self.deleteFaces, face_id)
+        log_file = os.path.join(self.tmp_dir, 'service.log')
+        settings = dataclasses.replace(self.settings, log_file=log_file, log_format='json', maintenance_interval=0)
+        app = application.create_app(settings, service_factory=FakeFaceService)
+        with TestClient(app) as client:
+            with application.SessionLocal() as db:
+                db.add(application.FaceData(id=face_id, name='alice', registered_at=datetime.now()))
+                db.commit()
+            self.assertEqual(client.delete('/faces/' + face_id).status_code, 200)
+
+        with open(log_file) as f:
+            records = [json.loads(line) for line in f]
+        tombstoned = [r for r in records if r['msg'].startswith('Tombstoned face')]
+        self.assertEqual(len(tombstoned), 1)
+        self.assertEqual(tombstoned[0]['msg'], 'Tombstoned face alice with ID %s' % face_id)
+        self.assertEqual(tombstoned[0]['face_id'], face_id)
+
+    def testStartupBackfillsPreMigrationRegistrations(self):
+        with_crops, without_crops = str(uuid.uuid4()), str(uuid.uuid4())
+        # A faces table as the first release created it, rows without embedding or model version
+        db_path = os.path.join(self.tmp_dir, 'legacy.db')
+        connection = sqlite3.connect(db_path)
+        connection.execute('CREATE TABLE faces (id VARCHAR NOT NULL PRIMARY KEY, name VARCHAR, '
+                           'registered_at DATETIME, embedding VARCHAR)')
+        connection.executemany('INSERT INTO faces VALUES (?, ?, ?, NULL)',
+                               [(with_crops, 'alice', '2024-01-01 00:00:00.000000'),
+                                (without_crops, 'bob', '2024-01-02 00:00:00.000000')])
+        connection.commit()
+        connection.close()
+        self.useDatabase(db_path)
+        person_dir = os.path.join(self.settings.processed_dataset_dir, 'alice')
+        os.makedirs(person_dir)
+        for n in range(1, 4):
+            open(os.path.join(person_dir, '%s_%d.png' % (with_crops, n)), 'wb').close()
+
+        services = []
+
+        def factory(settings):
+            services.append(CropEmbeddingFaceService(settings))
+            return services[-1]
+
+        settings = dataclasses.replace(self.settings, matcher='gallery')
+        app = application.create_app(settings, service_factory=factory)
+        with TestClient(app) as client:
+            self.assertEqual(client.get('/ready').status_code, 200)
+            gallery = app.state.gallery
+            self.assertIn(with_crops, gallery)
+            self.assertNotIn(without_crops, gallery)
+            self.assertEqual(gallery.name_of(with_crops), 'alice')
+            with application.SessionLocal() as db:
+                face = db.get(application.FaceData, with_crops)
+                self.assertEqual(face.model_version, settings.embedding_model_version)
+                self.assertEqual(db.query(application.FaceSample).filter(
+                    application.FaceSample.face_id == with_crops).count(), 3)
+        self.assertEqual(services[0].calls.count(('embed_crops', 3)), 1)
+
+        # Backfilled once: the next start finds the templates
+        services.clear()
+        with TestClient(application.create_app(settings, service_factory=factory)) as client:
+            self.assertIn(with_crops, client.app.state.gallery)
+        self.assertNotIn(('embed_crops', 3), services[0].calls)
+
+    def testServiceTrainsWithInjectedSettings(self):
+        engine = self.useDatabase(os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(engine)
+        settings = dataclasses.replace(self.settings, classifier_backend='ncm', model_version='injected')
+        rng = np.random.RandomState(0)
+        with application.SessionLocal() as db:
+            for face_id, name in (('a', 'alice'), ('b', 'bob')):
+                db.add(application.FaceData(id=face_id, name=name, registered_at=datetime.now()))
+                db.flush()
+                for position, version in enumerate(('injected', 'injected', 'other'), start=1):
+                    db.add(application.FaceSample(face_id=face_id, position=position, model_version=version,
+                                                  embedding=encode_embedding(rng.normal(size=512)),
+                                                  embedding_dtype='float32'))
+            db.commit()
+
+        service = NoModelFaceService(settings)
+        emb_array, labels, class_names = service.training_set()
+        self.assertEqual(emb_array.shape, (4, 512))
+        self.assertEqual(class_names, ['alice', 'bob'])
+        with mock.patch.object(application.classifier_backends, 'train',
+                               wraps=application.classifier_backends.train) as train:
+            self.assertTrue(service._train_classifier(os.path.join(self.tmp_dir, 'model.fca')))
+        self.assertEqual(train.call_args[0][0], 'ncm')
+
+    def testTrainingSetLogsRegistrationsWithoutData(self):
+        engine = self.useDatabase(os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(engine)
+        settings = dataclasses.replace(self.settings, model_version='v2-int8')
+        rng = np.random.RandomState(1)
+        with application.SessionLocal() as db:
+            for face_id, name, version in (('a', 'alice', 'v2'), ('b', 'bob', 'v2-int8'), ('c', 'carol', 'v2-int8')):
+                db.add(application.FaceData(id=face_id, name=name, registered_at=datetime.now()))
+                db.flush()
+                db.add(application.FaceSample(face_id=face_id, position=1, model_version=version,
+                                              embedding=encode_embedding(rng.normal(size=512)),
+                                              embedding_dtype='float32'))
+            db.commit()
+
+        with self.assertLogs('face_recognition_service', 'WARNING') as logs:
+            emb_array, labels, class_names = NoModelFaceService(settings).training_set()
+        self.assertEqual(class_names, ['bob', 'carol'])
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('1 registrations have no v2-int8 samples', logs.records[0].getMessage())
+        self.assertEqual(logs.records[0].face_ids, ['a'])
+
+    def testCalibratedThresholdFallsBackWithoutTemplate(self):
+        engine = self.useDatabase(os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(engine)
+        with application.SessionLocal() as db:
+            db.add_all([application.FaceData(id='a', name='alice', registered_at=datetime.now()),
+                        application.FaceData(id='b', name='bob', registered_at=datetime.now())])
+            db.commit()
+        os.makedirs(self.settings.model_dir)
+        ThresholdTable([{'far_target': 1e-6, 'threshold': 0.8, 'far': 0.0, 'val': 1.0, 'resolved': True}]).save(
+            self.settings.threshold_table_path)
+        faces = [
+            # No template to measure a distance to: the probability rule decides
+            {'name': 'alice', 'confidence': 0.9, 'bbox': [0, 0, 10, 10]},
+            {'id': 'b', 'name': 'bob', 'confidence': 0.9, 'distance': 0.95, 'bbox': [10, 0, 20, 10]},
+        ]
+        settings = dataclasses.replace(self.settings, base_dir=self.tmp_dir)
+        app = application.create_app(settings, service_factory=lambda s: FixedFacesService(s, faces))
+        with TestClient(app) as client:
+            self.assertEqual(app.state.accept_distance, 0.8)
+            response = client.post('/recognition', files={'image': ('a.jpg', b'jpeg', 'image/jpeg')})
+        self.assertEqual([face['name'] for face in response.json()], ['alice'])
+
+    def testProbeIsEmbeddedInRgbLikeRegistration(self):
+        settings = dataclasses.replace(self.settings, matcher='gallery')
+        service = NoModelFaceService(settings)
+        detected, embedded = [], []
+
+        def detect(img):
+            detected.append(img)
+            return np.array([[20.0, 20.0, 80.0, 80.0, 0.99]]), np.empty(0)
+
+        def embed(images):
+            embedded.append(images)
+            return np.ones((len(images), 512), dtype=np.float32) / np.sqrt(512)
+
+        service.detect, service.embed = detect, embed
+        service.aligner = AlignmentEngine(detect, service.INPUT_IMAGE_SIZE, margin=44)
+        # Pure blue in BGR
+        frame = np.zeros((100, 100, 3), dtype=np.uint8)
+        frame[..., 0] = 200
+        frame[..., 1:] = 20
+        image_path = os.path.join(self.tmp_dir, 'probe.png')
+        cv2.imwrite(image_path, frame)
+
+        faces = service.detect_faces(image_path, Gallery('v1'))
+        self.assertEqual(len(faces), 1)
+        self.assertGreater(detected[0][..., 2].mean(), detected[0][..., 0].mean())
+        registration = np.stack(
+            [facenet.prewhiten(service.aligner.align(cv2.imread(image_path)).image)])
+        np.testing.assert_allclose(embedded[0], registration, atol=1e-6)
+        self.assertGreater(embedded[0][..., 2].mean(), embedded[0][..., 0].mean())
+
+    def testWarmupCoversBatchSizes(self):
+        service = FakeFaceService()
+        warmup(service, batch_sizes=(1, 4), frame_size=(60, 80), iterations=1)
+        self.assertIn(('detect', (60, 80, 3)), service.calls)
+        self.assertIn(('embed', (4, 160, 160, 3)), service.calls)
+        self.assertIn(('rnet', (4, 24, 24, 3)), service.calls)
+        self.assertIn(('onet', (1, 48, 48, 3)), service.calls)
+
+    def testWarmupRecordsNoStageLatencies(self):
+        service = FakeFaceService()
+        service.embed = metrics.timed('embed', service.embed)
+        service.detect = metrics.timed('detect', service.detect)
+
+        def count(stage):
+            return REGISTRY.get_sample_value('face_stage_duration_seconds_count', {'stage': stage}) or 0.0
+
+        before = {stage: count(stage) for stage in ('embed', 'detect')}
+        warmup(service, batch_sizes=(1, 2), frame_size=(60, 80), iterations=2)
+        self.assertEqual({stage: count(stage) for stage in before}, before)
+        with application.time_stage('embed'):
+            pass
+        self.assertEqual(count('embed'), before['embed'] + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from serving.artifacts import ArtifactStore, CachedArtifact, WriterLock
+
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class ArtifactStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.legacy = os.path.join(self.tmp_dir, 'facemodel.pkl')
+        self.store = ArtifactStore(os.path.join(self.tmp_dir, 'classifiers'), keep=2, legacy_path=self.legacy)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testLegacyPathUntilFirstPublish(self):
+        self.assertIsNone(self.store.current_path())
+        with open(self.legacy, 'wb') as f:
+            pickle.dump('old', f)
+        self.assertEqual(self.store.current_path(), self.legacy)
+        self.store.publish_bytes(pickle.dumps('new'))
+        self.assertNotEqual(self.store.current_path(), self.legacy)
+        self.assertEqual(load_pickle(self.store.current_path()), 'new')
+        self.assertEqual(load_pickle(self.legacy), 'old')
+
+    def testKeepOnlyTheCurrentVersion(self):
+        store = ArtifactStore(os.path.join(self.tmp_dir, 'single'), keep=1)
+        published = [store.publish_bytes(pickle.dumps(i)) for i in range(3)]
+        self.assertEqual(store.versions(), published[-1:])
+        self.assertEqual(load_pickle(store.current_path()), 2)
+        with self.assertRaises(ValueError):
+            ArtifactStore(os.path.join(self.tmp_dir, 'none'), keep=0)
+
+    def testVersionsArePrunedButCurrentIsKept(self):
+        published = [self.store.publish_bytes(pickle.dumps(i)) for i in range(4)]
+        self.assertEqual(self.store.versions(), published[-2:])
+        self.assertEqual(self.store.current_version(), published[-1])
+        self.assertEqual(load_pickle(self.store.current_path()), 3)
+        self.assertEqual([f for f in os.listdir(self.store.directory) if f.startswith('.staging')], [])
+
+    def testUnpublishedStagingFileIsRemoved(self):
+        with self.store.staging_path() as path:
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(self.store.current_version())
+
+    def testCacheReloadsOnlyOnNewVersion(self):
+        loads = []
+
+        def load(path):
+            loads.append(path)
+            return load_pickle(path)
+
+        cache = CachedArtifact(self.store, load)
+        self.assertEqual(cache.get(), (None, None))
+        self.store.publish_bytes(pickle.dumps('a'))
+        self.assertEqual(cache.get()[1], 'a')
+        self.assertEqual(cache.get()[1], 'a')
+        self.assertEqual(len(loads), 1)
+        self.store.publish_bytes(pickle.dumps('b'))
+        self.assertEqual(cache.get()[1], 'b')
+        self.assertEqual(len(loads), 2)
+        self.store.unpublish()
+        self.assertEqual(cache.get(), (None, None))
+
+    def testReadersNeverSeeTornFiles(self):
+        payload = [list(range(20000))]
+        errors = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                path = self.store.current_path()
+                if path is None:
+                    continue
+                try:
+                    self.assertEqual(len(load_pickle(path)[0]), 20000)
+                except FileNotFoundError:
+                    pass  # pruned between reading the pointer and opening the file
+                except Exception as e:
+                    errors.append(e)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        for _ in range(20):
+            self.store.publish_bytes(pickle.dumps(payload))
+        done.set()
+        reader.join()
+        self.assertEqual(errors, [])
+
+    def testWriterLockSerializesWriters(self):
+        lock = WriterLock(os.path.join(self.tmp_dir, '.lock'))
+        active, overlaps = [], []
+
+        def write():
+            with lock:
+                with lock:  # re-entrant
+                    active.append(1)
+                    if len(active) > 1:
+                        overlaps.append(1)
+                    time.sleep(0.01)
+                    active.pop()
+
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
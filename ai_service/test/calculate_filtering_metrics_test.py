@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import imageio
+import numpy as np
+
+import calculate_filtering_metrics
+import facenet
+
+
+class ClassStatisticsTest(unittest.TestCase):
+
+    def testMatchesBatchComputation(self):
+        rng = np.random.RandomState(0)
+        nrof_examples_per_class = [3, 0, 1, 7, 0, 4]
+        embeddings = rng.normal(loc=5.0, size=(sum(nrof_examples_per_class), 8))
+        # Batches that cross class boundaries, hold several classes or part of one
+        for batch_size in (1, 2, 5, 15):
+            stats = calculate_filtering_metrics.ClassStatistics(nrof_examples_per_class, 8)
+            for i in range(0, len(embeddings), batch_size):
+                stats.update(embeddings[i:i+batch_size])
+            offsets = np.append(0, np.cumsum(nrof_examples_per_class))
+            for cls in range(len(nrof_examples_per_class)):
+                emb = embeddings[offsets[cls]:offsets[cls+1]]
+                if not len(emb):
+                    continue
+                center = np.mean(emb, axis=0)
+                dists_sqr = np.sum(np.square(emb - center), axis=1)
+                np.testing.assert_allclose(stats.class_center[cls], center)
+                np.testing.assert_allclose(stats.class_variance[cls], np.mean(dists_sqr))
+                np.testing.assert_allclose(stats.distance_to_center[offsets[cls]:offsets[cls+1]], np.sqrt(dists_sqr))
+            self.assertFalse(np.isnan(stats.distance_to_center).any())
+
+    def testTooManyEmbeddings(self):
+        stats = calculate_filtering_metrics.ClassStatistics([1, 1], 4)
+        with self.assertRaises(ValueError):
+            stats.update(np.zeros((3, 4)))
+
+
+class FilteringMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        for name, count in (('Ann', 3), ('Bob', 2)):
+            os.makedirs(os.path.join(self.tmp_dir, name))
+            for i in range(count):
+                imageio.imwrite(os.path.join(self.tmp_dir, name, '%s_%d.png' % (name, i)),
+                                rng.randint(0, 255, size=(20, 20, 3), dtype=np.uint8))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testWriteFilteringData(self):
+        dataset = facenet.get_dataset(self.tmp_dir)
+        batches = []
+
+        def embed(images):
+            batches.append(len(images))
+            return images.reshape(len(images), -1)[:, :16]
+
+        stats = calculate_filtering_metrics.calculate_statistics(dataset, embed, 2, 16)
+        self.assertEqual(batches, [2, 2, 1])
+        data_file = os.path.join(self.tmp_dir, 'filtering.hdf')
+        calculate_filtering_metrics.write_filtering_data(data_file, dataset, stats.distance_to_center)
+        image_list, label_list = facenet.get_image_paths_and_labels(dataset)
+        with h5py.File(data_file, 'r') as f:
+            self.assertEqual(sorted(f.keys()), ['class_names', 'distance_to_center', 'image_list', 'label_list'])
+            self.assertEqual(list(f['class_names'].asstr()[()]), ['Ann', 'Bob'])
+            self.assertEqual(list(f['image_list'].asstr()[()]), image_list)
+            self.assertEqual(list(f['label_list'][()]), label_list)
+            np.testing.assert_allclose(f['distance_to_center'][()], stats.distance_to_center)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from serving.calibration import (ThresholdTable, calibrate, genuine_impostor_distances, load_accept_distance,
+                                 load_samples, val_far)
+from serving.gallery import Gallery, encode_embedding
+from serving.registration import template_of
+from serving.storage import FaceData, FaceSample, create_db_engine, create_session_factory, init_db
+
+
+def identities(rng, nrof_people, per_person, dim=64, noise=0.5):
+    centres = rng.normal(size=(nrof_people, dim))
+    labels = np.repeat(np.arange(nrof_people), per_person)
+    x = centres[labels] / np.linalg.norm(centres[labels], axis=1, keepdims=True)
+    x = x + noise * rng.normal(size=x.shape) / np.sqrt(dim)
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32), labels
+
+
+def templates(samples, labels):
+    return np.stack([template_of(samples[labels == label]) for label in np.unique(labels)]).astype(np.float32)
+
+
+class CalibrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testPairsMatchBruteForce(self):
+        x, labels = identities(np.random.RandomState(0), 7, 3)
+        sample_ids = ['f%d' % label for label in labels]
+        t = templates(x, labels)
+        template_ids = ['f%d' % label for label in range(7)]
+        genuine, impostor = genuine_impostor_distances(x, sample_ids, t, template_ids)
+        np.testing.assert_allclose(np.sort(genuine), np.sort(np.linalg.norm(x - t[labels], axis=1)), atol=1e-5)
+        dist = np.linalg.norm(x[:, None, :] - t[None, :, :], axis=2)
+        other = labels[:, None] != np.arange(7)[None, :]
+        np.testing.assert_allclose(np.sort(impostor), np.sort(dist[other]), atol=1e-5)
+
+        _, sampled = genuine_impostor_distances(x, sample_ids, t, template_ids, max_impostor_pairs=50)
+        self.assertLessEqual(len(sampled), 50)
+        self.assertGreaterEqual(sampled.min(), impostor.min() - 1e-6)
+
+        # Samples of a registration without a template are left out
+        genuine, impostor = genuine_impostor_distances(x, sample_ids, t[1:], template_ids[1:])
+        self.assertEqual(len(genuine), 18)
+        self.assertEqual(len(impostor), 18 * 5)
+
+    def testOneRegistrationPerPersonHasGenuinePairs(self):
+        x, labels = identities(np.random.RandomState(4), 20, 3)
+        ids = ['f%d' % label for label in labels]
+        # Two people sharing a name are still impostors of each other
+        gallery = Gallery('v1', ['f%d' % i for i in range(20)], ['same name'] * 20, templates(x, labels))
+        table = calibrate(gallery, ids, x, far_targets=[1e-1])
+        self.assertEqual(table.meta['genuine_pairs'], 60)
+        self.assertEqual(table.meta['impostor_pairs'], 60 * 19)
+        self.assertGreater(table.rows[0]['val'], 0.9)
+
+    def testValFarMatchesFacenetDefinition(self):
+        rng = np.random.RandomState(1)
+        genuine, impostor = rng.uniform(0.2, 1.0, 300), rng.uniform(0.8, 1.6, 2000)
+        thresholds = np.arange(0, 2, 0.05)
+        val, far = val_far(thresholds, genuine, impostor)
+        for threshold, v, f in zip(thresholds, val, far):
+            self.assertAlmostEqual(v, np.mean(genuine < threshold))
+            self.assertAlmostEqual(f, np.mean(impostor < threshold))
+
+    def testTableMeetsTargets(self):
+        x, labels = identities(np.random.RandomState(2), 200, 4)
+        ids = ['id%d' % l for l in labels]
+        gallery = Gallery('v1', ['id%d' % i for i in range(200)], ['p%d' % i for i in range(200)],
+                          templates(x, labels))
+        table = calibrate(gallery, ids, x, far_targets=[1e-2, 1e-3, 1e-7])
+        self.assertEqual([row['far_target'] for row in table.rows], [1e-2, 1e-3, 1e-7])
+        self.assertEqual(table.meta['templates'], 200)
+        self.assertEqual(table.meta['samples'], 800)
+        for row in table.rows:
+            self.assertLessEqual(row['far'], row['far_target'])
+        self.assertFalse(table.rows[-1]['resolved'])
+        self.assertGreater(table.rows[0]['threshold'], table.rows[1]['threshold'])
+        self.assertGreater(table.rows[0]['val'], 0.9)
+
+        path = os.path.join(self.tmp_dir, 'thresholds.json')
+        table.save(path)
+        # The largest tabulated FAR not above the target
+        self.assertEqual(load_accept_distance(path, 5e-3), table.rows[1]['threshold'])
+        self.assertEqual(load_accept_distance(path, 1e-2), table.rows[0]['threshold'])
+        self.assertIsNone(load_accept_distance(os.path.join(self.tmp_dir, 'missing.json'), 1e-3))
+        # A target below the table disables calibrated acceptance instead of failing startup
+        with self.assertLogs('face_recognition_service.calibration', 'WARNING'):
+            self.assertIsNone(load_accept_distance(path, 1e-9))
+        with self.assertRaises(KeyError):
+            ThresholdTable.load(path).threshold(1e-9)
+
+    def testNeedsImpostors(self):
+        x, labels = identities(np.random.RandomState(3), 1, 5)
+        genuine, impostor = genuine_impostor_distances(x, ['f0'] * 5, templates(x, labels), ['f0'])
+        self.assertEqual(len(genuine), 5)
+        with self.assertRaises(ValueError):
+            ThresholdTable.from_distances(genuine, impostor)
+
+    def testLoadSamplesOfLiveRegistrations(self):
+        engine = create_db_engine('sqlite:///' + os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(engine)
+        try:
+            with create_session_factory(engine)() as db:
+                for face_id, deleted in (('a', False), ('b', True)):
+                    db.add(FaceData(id=face_id, name='ann', registered_at=datetime.now(),
+                                    deleted_at=datetime.now() if deleted else None))
+                    for position, version in ((1, 'v1'), (2, 'v1'), (3, 'v0')):
+                        db.add(FaceSample(face_id=face_id, position=position, embedding_dtype='float32',
+                                          embedding=encode_embedding(np.full(4, position)), model_version=version))
+                db.commit()
+                face_ids, samples = load_samples(db, 'v1')
+        finally:
+            engine.dispose()
+        self.assertEqual(face_ids, ['a', 'a'])
+        np.testing.assert_array_equal(samples[:, 0], [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.svm import SVC
+
+import classifier_artifact
+import convert_classifier
+
+
+def embeddings_and_labels(rng, nrof_classes, per_class=8, dim=32):
+    centres = rng.normal(size=(nrof_classes, dim))
+    labels = np.repeat(np.arange(nrof_classes), per_class)
+    x = centres[labels] + 1.5 * rng.normal(size=(len(labels), dim))
+    return x / np.linalg.norm(x, axis=1, keepdims=True), labels
+
+
+class ClassifierArtifactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'facemodel.fca')
+        warnings.simplefilter('ignore', FutureWarning)  # SVC(probability=True) is deprecated in recent sklearn
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertSameProbabilities(self, model, nrof_classes):
+        rng = np.random.RandomState(nrof_classes)
+        x, labels = embeddings_and_labels(rng, nrof_classes)
+        model.fit(x, labels)
+        class_names = ['Nguyễn Văn %d' % i for i in range(nrof_classes)]
+        classifier_artifact.save_model(self.path, model, class_names)
+        loaded, loaded_names = classifier_artifact.load_classifier(self.path)
+        self.assertEqual(loaded_names, class_names)
+        queries, _ = embeddings_and_labels(rng, nrof_classes, per_class=3)
+        np.testing.assert_allclose(loaded.predict_proba(queries), model.predict_proba(queries), atol=1e-5)
+
+    def testSvcMulticlass(self):
+        self.assertSameProbabilities(SVC(kernel='linear', probability=True), 7)
+
+    def testSvcBinary(self):
+        self.assertSameProbabilities(SVC(kernel='linear', probability=True), 2)
+
+    def testLogisticRegression(self):
+        self.assertSameProbabilities(LogisticRegression(max_iter=1000), 5)
+        self.assertSameProbabilities(LogisticRegression(max_iter=1000), 2)
+
+    def testLayoutIsAlignedAndMapped(self):
+        weights = np.arange(12, dtype=np.float64).reshape(3, 4)
+        classifier_artifact.save(self.path, 'linear', ['a', 'b', 'c'], {'weights': weights, 'bias': np.zeros(3)})
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(8), classifier_artifact.MAGIC)
+        artifact = classifier_artifact.load(self.path)
+        self.assertEqual(artifact.kind, 'linear')
+        self.assertEqual(artifact.class_names, ['a', 'b', 'c'])
+        self.assertIsInstance(artifact.arrays['weights'].base, np.memmap)
+        self.assertEqual(artifact.arrays['weights'].dtype, np.float32)
+        self.assertFalse(artifact.arrays['weights'].flags.writeable)
+        self.assertEqual(artifact.arrays['weights'].ctypes.data % classifier_artifact.ALIGNMENT,
+                         artifact.arrays['bias'].ctypes.data % classifier_artifact.ALIGNMENT)
+        np.testing.assert_array_equal(artifact.arrays['weights'], weights)
+
+    def testRejectsOtherFiles(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump(('model', []), f)
+        with self.assertRaises(ValueError):
+            classifier_artifact.load(self.path)
+
+    def testConverter(self):
+        x, labels = embeddings_and_labels(np.random.RandomState(0), 4)
+        pickle_path = os.path.join(self.tmp_dir, 'facemodel.pkl')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump((SVC(kernel='linear', probability=True).fit(x, labels), ['a', 'b', 'c', 'd']), f)
+        args = convert_classifier.parse_arguments([pickle_path, self.path, '--check', '50'])
+        self.assertEqual(convert_classifier.main(args), 0)
+        self.assertEqual(classifier_artifact.load_classifier(self.path)[1], ['a', 'b', 'c', 'd'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+import classifier_artifact
+import classifier_backends
+
+
+def embeddings_and_labels(rng, nrof_classes, per_class=6, dim=64, noise=0.6):
+    centres = rng.normal(size=(nrof_classes, dim))
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    labels = np.repeat(np.arange(nrof_classes), per_class)
+    x = centres[labels] + noise * rng.normal(size=(len(labels), dim)) / np.sqrt(dim)
+    return x / np.linalg.norm(x, axis=1, keepdims=True), labels
+
+
+class ClassifierBackendsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.x, self.labels = embeddings_and_labels(rng, 30)
+        self.queries, self.query_labels = embeddings_and_labels(np.random.RandomState(0), 30, per_class=2)
+        self.queries = self.queries + 0.01 * rng.normal(size=self.queries.shape)
+        warnings.simplefilter('ignore', FutureWarning)  # SVC(probability=True) is deprecated in recent sklearn
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testBackendsClassifyAndRoundTrip(self):
+        for backend in classifier_backends.BACKENDS:
+            model = classifier_backends.train(backend, self.x, self.labels)
+            probabilities = model.predict_proba(self.queries)
+            self.assertEqual(probabilities.shape, (len(self.queries), 30), backend)
+            np.testing.assert_allclose(probabilities.sum(axis=1), 1.0, atol=1e-6)
+            self.assertGreaterEqual(np.mean(probabilities.argmax(axis=1) == self.query_labels), 0.9, backend)
+
+            path = os.path.join(self.tmp_dir, '%s.fca' % backend)
+            classifier_artifact.save_model(path, model, ['p%d' % i for i in range(30)])
+            loaded, _ = classifier_artifact.load_classifier(path)
+            np.testing.assert_allclose(loaded.predict_proba(self.queries), probabilities, atol=1e-4, err_msg=backend)
+
+    def testBinaryLinearSvc(self):
+        x, labels = embeddings_and_labels(np.random.RandomState(1), 2)
+        model = classifier_backends.train('linear_svc', x, labels)
+        self.assertEqual(model.weights.shape[0], 2)
+        self.assertTrue(np.all(model.predict_proba(x).argmax(axis=1) == labels))
+
+    def testClassMeans(self):
+        x = np.arange(12, dtype=np.float64).reshape(6, 2)
+        labels = np.array([2, 0, 2, 0, 2, 3])
+        means = classifier_backends.class_means(x, labels, 4)
+        np.testing.assert_allclose(means, [[4, 5], [0, 0], [4, 5], [10, 11]])
+
+    def testHeldOutKeepsEveryClass(self):
+        labels = np.array([0, 1, 1, 2, 2, 2, 2, 2] * 10)
+        held = classifier_backends.held_out_mask(labels, 0.9, np.random.RandomState(3))
+        self.assertTrue(held.any())
+        self.assertEqual(set(labels[~held]), {0, 1, 2})
+
+    def testTemperatureRecoversSoftmaxScale(self):
+        rng = np.random.RandomState(0)
+        scores = rng.normal(size=(20000, 5))
+        p = np.exp(3.0 * scores)
+        p /= p.sum(axis=1, keepdims=True)
+        labels = (p.cumsum(axis=1) < rng.uniform(size=(len(p), 1))).sum(axis=1)
+        self.assertAlmostEqual(classifier_backends.fit_temperature(scores, labels), 3.0, delta=0.15)
+
+    def testUnknownBackend(self):
+        with self.assertRaises(ValueError):
+            classifier_backends.train('knn', self.x, self.labels)
+
+
+if __name__ == "__main__":
+    unittest.main()
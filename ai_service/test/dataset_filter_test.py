@@ -0,0 +1,83 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import calculate_filtering_metrics
+import dataset_filter
+import facenet
+
+
+def reference_filter(dataset, distance_to_center, label_list, image_list, percentile, min_nrof_images_per_class):
+    # The list-based filtering dataset_filter replaces
+    threshold = dataset_filter.find_threshold(distance_to_center, percentile)
+    filtered_dataset = copy.deepcopy(dataset)
+    removelist = []
+    for i in np.where(distance_to_center>=threshold)[0]:
+        label = label_list[i]
+        image = image_list[i]
+        if image in filtered_dataset[label].image_paths:
+            filtered_dataset[label].image_paths.remove(image)
+        if len(filtered_dataset[label].image_paths)<min_nrof_images_per_class:
+            removelist.append(label)
+    for i in sorted(set(removelist), reverse=True):
+        del(filtered_dataset[i])
+    return filtered_dataset
+
+
+class DatasetFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_file = os.path.join(self.tmp_dir, 'filtering.hdf')
+        rng = np.random.RandomState(0)
+        self.dataset = [facenet.ImageClass('class_%03d' % i, ['class_%03d/img_%d.png' % (i, j)
+                                                              for j in range(rng.randint(1, 12))])
+                        for i in range(60)]
+        image_list, self.label_list = facenet.get_image_paths_and_labels(self.dataset)
+        self.image_list = list(image_list)
+        self.distance_to_center = rng.gamma(2.0, size=len(self.image_list))
+        calculate_filtering_metrics.write_filtering_data(self.data_file, self.dataset, self.distance_to_center)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testSameResultAsListFiltering(self):
+        for percentile, min_nrof_images_per_class in ((100.0, 0), (90.0, 0), (75.0, 5), (50.0, 3)):
+            filtered, report = dataset_filter.filter_dataset(
+                self.dataset, self.data_file, percentile, min_nrof_images_per_class)
+            expected = reference_filter(self.dataset, self.distance_to_center, self.label_list, self.image_list,
+                                        percentile, min_nrof_images_per_class)
+            self.assertEqual([(cls.name, cls.image_paths) for cls in filtered],
+                             [(cls.name, cls.image_paths) for cls in expected])
+            self.assertEqual(report['nrof_kept_classes'], len(expected))
+            self.assertEqual(report['nrof_kept_images'], sum(len(cls) for cls in expected))
+        # The input dataset is left as it was
+        self.assertEqual(sum(len(cls) for cls in self.dataset), len(self.image_list))
+
+    def testReport(self):
+        filtered, report = dataset_filter.filter_dataset(self.dataset, self.data_file, 75.0, 5)
+        kept = set(image for cls in filtered for image in cls.image_paths)
+        outliers = set(report['removed_images'])
+        self.assertFalse(kept & outliers)
+        threshold = report['threshold']
+        self.assertEqual(outliers, set(image for image, distance in zip(self.image_list, self.distance_to_center)
+                                       if distance >= threshold))
+        removed_classes = set(cls['name'] for cls in report['removed_classes'])
+        self.assertEqual(removed_classes, set(cls.name for cls in self.dataset) - set(cls.name for cls in filtered))
+        for cls in report['removed_classes']:
+            self.assertLess(cls['nrof_images'] - cls['nrof_outliers'], 5)
+        report_file = os.path.join(self.tmp_dir, 'report.json')
+        dataset_filter.write_report(report, report_file)
+        self.assertTrue(os.path.getsize(report_file) > 0)
+
+    def testMismatchedDataset(self):
+        with self.assertRaises(ValueError):
+            dataset_filter.filter_dataset(self.dataset[:10], self.data_file, 90.0, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import decode_msceleb_dataset
+import packed_dataset
+
+
+class DecodeMsCelebDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tsv_file = os.path.join(self.tmp_dir, 'faces.tsv')
+        rng = np.random.RandomState(0)
+        lines = []
+        for i in range(12):
+            img = rng.randint(0, 255, size=(30 + i, 24, 3), dtype=np.uint8)
+            data = base64.b64encode(cv2.imencode('.png', img)[1].tobytes())
+            fields = [b'm.%02d' % (i % 3), b'Name %d' % i, b'%d' % i, b'http://img', b'page/%d' % i, data]
+            lines.append(b'\t'.join(fields) + b'\n')
+        lines.insert(5, b'm.00\tbroken line\n')
+        lines.insert(8, b'm.01\tName\t1\thttp://img\tpage\tbm90IGFuIGltYWdl\n')
+        with open(self.tsv_file, 'wb') as f:
+            f.write(b''.join(lines))
+        self.nrof_lines = len(lines)
+
+    def tearDown(self):
+        packed_dataset._open_datasets.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def decode(self, output_dir, *options):
+        return decode_msceleb_dataset.main(decode_msceleb_dataset.parse_arguments(
+            [output_dir, self.tsv_file, '--progress_interval', '0'] + list(options)))
+
+    def testRangesCoverEveryLineOnce(self):
+        for chunk_size in (1, 7, 100, 1 << 20):
+            ranges = decode_msceleb_dataset.split_ranges(self.tsv_file, chunk_size)
+            lines = [line for task in ranges for line in decode_msceleb_dataset.read_lines(*task)]
+            with open(self.tsv_file, 'rb') as f:
+                self.assertEqual(lines, f.readlines())
+
+    def testDecodeToShardedDirectories(self):
+        output_dir = os.path.join(self.tmp_dir, 'out')
+        self.assertEqual(self.decode(output_dir, '--size', '16', '--shards', '2'), (12, 2))
+        dataset = []
+        for shard in sorted(os.listdir(output_dir)):
+            if os.path.isdir(os.path.join(output_dir, shard)):
+                dataset += [(shard, cls) for cls in sorted(os.listdir(os.path.join(output_dir, shard)))]
+        self.assertEqual(sorted(cls for _, cls in dataset), ['m.00', 'm.01', 'm.02'])
+        for shard, cls in dataset:
+            self.assertEqual(os.path.join(shard, cls), decode_msceleb_dataset.class_directory(cls, 2))
+        shard = decode_msceleb_dataset.class_directory('m.01', 2)
+        img = cv2.imread(os.path.join(output_dir, shard, 'Name 4-page_4.png'))
+        self.assertEqual(img.shape, (16, 16, 3))
+
+    def testDecodeToPackedDatasetAndResume(self):
+        output_dir = os.path.join(self.tmp_dir, 'out.packed')
+        # Ranges of about 1 kB, so several shards are appended
+        self.assertEqual(self.decode(output_dir, '--packed', '--size', '20', '--workers', '2',
+                                     '--chunk_size', '0.001'), (12, 2))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, decode_msceleb_dataset.RANGES_DIR)))
+        dataset = packed_dataset.PackedDataset(output_dir)
+        self.assertEqual(len(dataset), 12)
+        self.assertEqual(dataset.image_size, (20, 20))
+        self.assertEqual(sorted(dataset.classes), ['m.00', 'm.01', 'm.02'])
+        self.assertIn('m.02/Name 5-page_5.png', dataset.paths)
+        # Every range is recorded, so a rerun has nothing left to decode
+        self.assertEqual(self.decode(output_dir, '--packed', '--size', '20', '--chunk_size', '0.001'), (0, 0))
+        # A range decoded again (crash before its progress line) does not duplicate rows
+        os.remove(os.path.join(output_dir, decode_msceleb_dataset.PROGRESS_FILE))
+        self.assertEqual(self.decode(output_dir, '--packed', '--size', '20'), (12, 2))
+        packed_dataset._open_datasets.clear()
+        self.assertEqual(len(packed_dataset.PackedDataset(output_dir)), 12)
+        with open(os.path.join(output_dir, decode_msceleb_dataset.PROGRESS_FILE)) as f:
+            self.assertEqual(sum(json.loads(line)['images'] for line in f), 12)
+
+    def testBoundedPendingRanges(self):
+        args = decode_msceleb_dataset.parse_arguments([os.path.join(self.tmp_dir, 'out'), self.tsv_file,
+                                                       '--workers', '2'])
+        tasks = decode_msceleb_dataset.split_ranges(self.tsv_file, 1024)
+        submitted = []
+
+        def track():
+            for task in tasks:
+                submitted.append(task)
+                yield task
+
+        results = decode_msceleb_dataset.decode_parallel(track(), args, max_pending=2)
+        first = next(results)
+        # Only as many ranges as may be pending are handed out before a result is consumed
+        self.assertLessEqual(len(submitted), 2)
+        rest = list(results)
+        self.assertEqual(sorted([first[0]] + [result[0] for result in rest]), sorted(tasks))
+        self.assertEqual(sum(result[1] for result in [first] + rest), 12)
+
+    def testPackedRequiresSize(self):
+        with self.assertRaises(SystemExit):
+            decode_msceleb_dataset.parse_arguments([self.tmp_dir, self.tsv_file, '--packed'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.ops import control_flow_ops
+
+import export_inference_graph
+import facenet
+import packed_dataset
+
+
+def build_frozen_graph(image_size):
+    """Small conv + batch norm net with the same phase_train Switch/Merge layout as FaceNet"""
+    with tf.Graph().as_default() as graph:
+        image_batch = tf.compat.v1.placeholder(tf.float32, (None, image_size, image_size, 3), 'image_batch')
+        images = tf.identity(image_batch, 'input')
+        phase_train = tf.compat.v1.placeholder(tf.bool, name='phase_train')
+        weights = tf.compat.v1.get_variable('InceptionResnetV1/Conv/weights', [3, 3, 3, 8])
+        net = tf.nn.conv2d(images, weights, [1, 1, 1, 1], 'SAME')
+        beta = tf.compat.v1.get_variable('InceptionResnetV1/Conv/BatchNorm/beta', [8])
+        gamma = tf.compat.v1.get_variable('InceptionResnetV1/Conv/BatchNorm/gamma', [8])
+        moving_mean = tf.compat.v1.get_variable('InceptionResnetV1/Conv/BatchNorm/moving_mean', [8], trainable=False)
+        moving_variance = tf.compat.v1.get_variable('InceptionResnetV1/Conv/BatchNorm/moving_variance', [8], trainable=False)
+        net_inference, net_train = control_flow_ops.switch(net, phase_train)
+        train_out, _, _ = tf.compat.v1.nn.fused_batch_norm(net_train, gamma, beta, is_training=True)
+        inference_out, _, _ = tf.compat.v1.nn.fused_batch_norm(net_inference, gamma, beta, mean=moving_mean,
+            variance=moving_variance, is_training=False)
+        net, _ = control_flow_ops.merge([inference_out, train_out])
+        net = tf.reduce_mean(tf.nn.relu(net), [1, 2])
+        embeddings = tf.nn.l2_normalize(net, 1, 1e-10, name='embeddings')
+
+        with tf.compat.v1.Session() as sess:
+            np.random.seed(666)
+            for var in tf.compat.v1.global_variables():
+                value = np.random.uniform(0.5, 1.5, size=var.shape.as_list()).astype(np.float32)
+                sess.run(var.assign(value))
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), ['embeddings'])
+            data = np.random.uniform(size=(4, image_size, image_size, 3)).astype(np.float32)
+            expected = sess.run(embeddings, feed_dict={images: data, phase_train: False})
+    return graph_def, data, expected
+
+
+class ExportInferenceGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testOptimizedGraphMatchesFrozenGraph(self):
+        graph_def, data, expected = build_frozen_graph(16)
+        optimized = export_inference_graph.optimize_graph_def(graph_def, 16)
+
+        ops = set(node.op for node in optimized.node)
+        self.assertNotIn('Switch', ops)
+        self.assertNotIn('Merge', ops)
+        self.assertFalse(any(op.startswith('FusedBatchNorm') for op in ops))
+        self.assertNotIn('phase_train', [node.name for node in optimized.node])
+
+        filename = os.path.join(self.tmp_dir, 'inference.pb')
+        with tf.io.gfile.GFile(filename, 'wb') as f:
+            f.write(optimized.SerializeToString())
+        with tf.Graph().as_default() as graph:
+            with tf.compat.v1.Session() as sess:
+                facenet.load_model(filename)
+                images_placeholder, embeddings, phase_train_placeholder = facenet.get_embedding_tensors(graph)
+                self.assertIsNone(phase_train_placeholder)
+                self.assertEqual(images_placeholder.get_shape().as_list(), [None, 16, 16, 3])
+                feed_dict = facenet.embedding_feed_dict(images_placeholder, phase_train_placeholder, data)
+                actual = sess.run(embeddings, feed_dict=feed_dict)
+        np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+
+    def testEmbedsPackedReferences(self):
+        graph_def, _, _ = build_frozen_graph(16)
+        model_file = os.path.join(self.tmp_dir, 'frozen.pb')
+        with tf.io.gfile.GFile(model_file, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        processed = os.path.join(self.tmp_dir, 'processed')
+        rng = np.random.RandomState(0)
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(processed, name))
+            for i in range(2):
+                cv2.imwrite(os.path.join(processed, name, '%s_%d.png' % (name, i)),
+                            rng.randint(0, 256, size=(16, 16, 3)).astype(np.uint8))
+        packed = os.path.join(self.tmp_dir, 'packed')
+        packed_dataset.pack(processed, packed, (16, 16))
+
+        files = [path for cls in facenet.get_dataset(processed) for path in sorted(cls.image_paths)]
+        refs = [path for cls in packed_dataset.get_dataset(packed) for path in cls.image_paths]
+        self.assertTrue(all(packed_dataset.is_ref(path) for path in refs))
+        np.testing.assert_allclose(export_inference_graph.compute_embeddings(model_file, refs, 3, 16),
+                                   export_inference_graph.compute_embeddings(model_file, files, 3, 16), atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from serving.gallery import Gallery, decode_embedding, encode_embedding, load_gallery, table_stamp
+from serving.storage import FaceData, RosterEntry, create_db_engine, create_session_factory, init_db
+
+
+def normalized(rng, n, dim=512):
+    x = rng.normal(size=(n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+class GalleryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = create_db_engine('sqlite:///' + os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(self.engine)
+        self.SessionLocal = create_session_factory(self.engine)
+        self.snapshot = os.path.join(self.tmp_dir, 'snapshot', 'gallery')
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def insert(self, embeddings, model_version='v1', dtype='float32', offset=0, tenant_id=None):
+        start = datetime(2024, 1, 1)
+        with self.SessionLocal() as db:
+            for i, embedding in enumerate(embeddings):
+                db.add(FaceData(id='id%d' % (offset + i), name='person%d' % (offset + i),
+                                registered_at=start + timedelta(seconds=offset + i),
+                                embedding=encode_embedding(embedding, dtype), embedding_dtype=dtype,
+                                model_version=model_version, tenant_id=tenant_id))
+            db.commit()
+
+    def testBlobRoundTrip(self):
+        embedding = normalized(np.random.RandomState(0), 1)[0]
+        self.assertEqual(len(encode_embedding(embedding, 'float32')), 512 * 4)
+        self.assertEqual(len(encode_embedding(embedding, 'float16')), 512 * 2)
+        np.testing.assert_array_equal(decode_embedding(encode_embedding(embedding)), embedding)
+        np.testing.assert_allclose(decode_embedding(encode_embedding(embedding, 'float16'), 'float16'),
+                                   embedding, atol=1e-3)
+
+    def testLoadFromDbStreamsAllTemplatesOfTheModel(self):
+        rng = np.random.RandomState(1)
+        embeddings = normalized(rng, 25)
+        self.insert(embeddings[:20])
+        self.insert(embeddings[20:], dtype='float16', offset=20)
+        self.insert(normalized(rng, 3), model_version='v0', offset=100)
+        with self.SessionLocal() as db:
+            gallery = Gallery.load_from_db(db, 'v1', chunk_size=7)
+        self.assertEqual(len(gallery), 25)
+        self.assertTrue(gallery.embeddings.flags['C_CONTIGUOUS'])
+        order = [int(face_id[2:]) for face_id in gallery.ids]
+        np.testing.assert_allclose(gallery.embeddings, embeddings[order], atol=1e-3)
+        self.assertEqual(gallery.names[0], 'person%d' % order[0])
+
+    def testSnapshotIsMemoryMappedUntilStale(self):
+        embeddings = normalized(np.random.RandomState(2), 10)
+        self.insert(embeddings)
+        with self.SessionLocal() as db:
+            from_db = load_gallery(db, 'v1', self.snapshot)
+            self.assertTrue(os.path.isfile(self.snapshot + '.npy'))
+            from_snapshot = load_gallery(db, 'v1', self.snapshot)
+        self.assertIsInstance(from_snapshot.embeddings, np.memmap)
+        self.assertEqual(from_snapshot.ids, from_db.ids)
+        np.testing.assert_array_equal(from_snapshot.embeddings, from_db.embeddings)
+
+        self.insert(normalized(np.random.RandomState(3), 1), offset=10)
+        with self.SessionLocal() as db:
+            self.assertIsNone(Gallery.load_snapshot(self.snapshot, 'v1', table_stamp(db, 'v1')))
+            self.assertEqual(len(load_gallery(db, 'v1', self.snapshot)), 11)
+
+    def testSnapshotIsStaleAfterWritesThatKeepTheCount(self):
+        rng = np.random.RandomState(5)
+        self.insert(normalized(rng, 4))
+        with self.SessionLocal() as db:
+            load_gallery(db, 'v1', self.snapshot)
+            stamp = table_stamp(db, 'v1')
+            self.assertIsNotNone(Gallery.load_snapshot(self.snapshot, 'v1', stamp))
+
+            db.get(FaceData, 'id0').name = 'renamed'
+            db.commit()
+            renamed = table_stamp(db, 'v1')
+            self.assertEqual(renamed['count'], stamp['count'])
+            self.assertIsNone(Gallery.load_snapshot(self.snapshot, 'v1', renamed))
+            self.assertEqual(load_gallery(db, 'v1', self.snapshot).names[0], 'renamed')
+
+            db.get(FaceData, 'id1').embedding = encode_embedding(normalized(rng, 1)[0])
+            db.commit()
+            self.assertIsNone(Gallery.load_snapshot(self.snapshot, 'v1', table_stamp(db, 'v1')))
+            load_gallery(db, 'v1', self.snapshot)
+
+            db.get(FaceData, 'id2').deleted_at = datetime(2024, 2, 1)
+            db.commit()
+        self.insert(normalized(rng, 1), offset=4)
+        with self.SessionLocal() as db:
+            replaced = table_stamp(db, 'v1')
+            self.assertEqual(replaced['count'], stamp['count'])
+            self.assertIsNone(Gallery.load_snapshot(self.snapshot, 'v1', replaced))
+
+    def testAddAndRemove(self):
+        embeddings = normalized(np.random.RandomState(4), 3)
+        gallery = Gallery('v1')
+        for i, embedding in enumerate(embeddings):
+            gallery.add('id%d' % i, 'p%d' % i, embedding)
+        self.assertTrue(gallery.remove('id0'))
+        self.assertFalse(gallery.remove('id0'))
+        self.assertEqual(sorted(gallery.ids), ['id1', 'id2'])
+        for face_id, row in zip(gallery.ids, gallery.embeddings):
+            np.testing.assert_array_equal(row, embeddings[int(face_id[2:])])
+
+    def testIdsOfName(self):
+        embeddings = normalized(np.random.RandomState(5), 3)
+        gallery = Gallery('v1', ['a', 'b'], ['ann', 'bob'], embeddings[:2].copy())
+        gallery.add('c', 'ann', embeddings[2])
+        self.assertEqual(gallery.ids_of('ann'), {'a', 'c'})
+        gallery.add('b', 'ann', embeddings[1])
+        gallery.remove('a')
+        self.assertEqual(gallery.ids_of('ann'), {'b', 'c'})
+        self.assertEqual(gallery.ids_of('bob'), set())
+
+    def testScopedSearchOnlyTouchesThePartition(self):
+        embeddings = normalized(np.random.RandomState(5), 6)
+        gallery = Gallery('v1')
+        for i, embedding in enumerate(embeddings):
+            gallery.add('id%d' % i, 'p%d' % i, embedding, tenant_id='a' if i < 4 else 'b')
+        gallery.set_roster('exam1', ['id0', 'id1', 'id5'])
+
+        self.assertIsNone(gallery.scope())
+        self.assertEqual(gallery.scope(tenant_id='b'), {'id4', 'id5'})
+        self.assertEqual(gallery.scope(assessment_id='exam1'), {'id0', 'id1', 'id5'})
+        self.assertEqual(gallery.scope(tenant_id='a', assessment_id='exam1'), {'id0', 'id1'})
+        self.assertEqual(gallery.scope(tenant_id='a', face_ids=['id3', 'id4']), {'id3'})
+        with self.assertRaises(KeyError):
+            gallery.scope(assessment_id='exam2')
+
+        ids, sims = gallery.search(embeddings[[2, 5]], 1, candidates=gallery.scope(assessment_id='exam1'))
+        self.assertNotEqual(ids[0], ['id2'])
+        self.assertIn(ids[0][0], {'id0', 'id1', 'id5'})
+        self.assertEqual(ids[1], ['id5'])
+        self.assertAlmostEqual(float(sims[1][0]), 1.0, places=5)
+        self.assertEqual(gallery.search(embeddings[0], 1, candidates=set())[0], [[]])
+
+        gallery.remove('id5')
+        self.assertEqual(gallery.scope(assessment_id='exam1'), {'id0', 'id1'})
+        self.assertEqual(gallery.scope(tenant_id='b'), {'id4'})
+
+    def testRostersAndTenantsAreLoaded(self):
+        self.insert(normalized(np.random.RandomState(6), 3), tenant_id='t1')
+        with self.SessionLocal() as db:
+            db.add_all([RosterEntry(assessment_id='exam1', face_id='id0', tenant_id='t1'),
+                        RosterEntry(assessment_id='exam1', face_id='id2', tenant_id='t1')])
+            db.commit()
+            load_gallery(db, 'v1', self.snapshot)
+            gallery = load_gallery(db, 'v1', self.snapshot)
+        self.assertIsInstance(gallery.embeddings, np.memmap)
+        self.assertEqual(gallery.scope(tenant_id='t1'), {'id0', 'id1', 'id2'})
+        self.assertEqual(gallery.rosters, {'exam1': {'id0', 'id2'}})
+
+        with self.SessionLocal() as db:
+            db.delete(db.get(FaceData, 'id0'))
+            db.commit()
+            self.assertEqual([entry.face_id for entry in db.query(RosterEntry)], ['id2'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from face_recognition_process.alignment_manifest import AlignmentManifest
+from serving.maintenance import Maintenance
+from serving.storage import FaceData, FaceSample, RosterEntry, create_db_engine, create_session_factory, init_db
+
+
+class MaintenanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = create_db_engine('sqlite:///' + os.path.join(self.tmp_dir, 'faces.db'))
+        init_db(self.engine)
+        self.SessionLocal = create_session_factory(self.engine)
+        self.raw_dir = os.path.join(self.tmp_dir, 'raw')
+        self.processed_dir = os.path.join(self.tmp_dir, 'processed')
+        self.compactions = []
+        self.maintenance = Maintenance(self.SessionLocal, self.raw_dir, self.processed_dir,
+                                       compact=lambda: self.compactions.append(1), interval=0)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def register(self, face_id, name, deleted=False):
+        for directory in (self.raw_dir, self.processed_dir):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        with self.SessionLocal() as db:
+            db.add(FaceData(id=face_id, name=name, registered_at=datetime.now(),
+                            deleted_at=datetime.now() if deleted else None))
+            db.add(RosterEntry(assessment_id='exam1', face_id=face_id))
+            db.add(FaceSample(face_id=face_id, position=1, embedding=b'\0' * 8, embedding_dtype='float32',
+                              model_version='v1'))
+            db.commit()
+
+    def testNothingToDo(self):
+        self.register('a', 'alice')
+        self.assertEqual(self.maintenance.run_once(), [])
+        self.assertEqual(self.compactions, [])
+
+    def testPurgesTombstonesAndFilesOfRemovedPeople(self):
+        self.register('a', 'alice', deleted=True)
+        self.register('b1', 'bob', deleted=True)
+        self.register('b2', 'bob')
+        self.register('c', 'carol')
+        with self.SessionLocal() as db:
+            self.assertEqual(self.maintenance.pending(db), 2)
+        source = os.path.join(self.tmp_dir, 'faces.db')
+        with AlignmentManifest(self.processed_dir) as manifest:
+            for name in ('alice', 'bob'):
+                manifest.record(name + '/1.jpg', source, [name + '/1.png'], [[0, 0, 1, 1]], 'mtcnn')
+
+        self.assertEqual(self.maintenance.run_once(), ['alice'])
+        self.assertEqual(list(AlignmentManifest(self.processed_dir).entries), ['bob/1.jpg'])
+        self.assertEqual(self.compactions, [1])
+        self.assertFalse(os.path.exists(os.path.join(self.raw_dir, 'alice')))
+        self.assertFalse(os.path.exists(os.path.join(self.processed_dir, 'alice')))
+        # bob is still registered under another id
+        self.assertTrue(os.path.isdir(os.path.join(self.processed_dir, 'bob')))
+        with self.SessionLocal() as db:
+            self.assertEqual(sorted(face.id for face in db.query(FaceData)), ['b2', 'c'])
+            self.assertEqual(sorted(entry.face_id for entry in db.query(RosterEntry)), ['b2', 'c'])
+            self.assertEqual(sorted(sample.face_id for sample in db.query(FaceSample)), ['b2', 'c'])
+            self.assertEqual(self.maintenance.pending(db), 0)
+
+    def testSharedNameKeepsOnlyLiveRegistrationFiles(self):
+        self.register('b1', 'bob', deleted=True)
+        self.register('b2', 'bob')
+        source = os.path.join(self.tmp_dir, 'faces.db')
+        with AlignmentManifest(self.processed_dir) as manifest:
+            for face_id in ('b1', 'b2'):
+                for position in (1, 2):
+                    filename = '%s_%d' % (face_id, position)
+                    for directory, ext in ((self.raw_dir, '.jpg'), (self.processed_dir, '.png')):
+                        with open(os.path.join(directory, 'bob', filename + ext), 'wb') as f:
+                            f.write(b'x')
+                    manifest.record('bob/%s.jpg' % filename, source, ['bob/%s.png' % filename],
+                                    [[0, 0, 1, 1]], 'center')
+
+        self.assertEqual(self.maintenance.run_once(), [])
+        # The classifier is compacted even though no name disappeared
+        self.assertEqual(self.compactions, [1])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.raw_dir, 'bob'))), ['b2_1.jpg', 'b2_2.jpg'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.processed_dir, 'bob'))),
+                         ['b2_1.png', 'b2_2.png'])
+        self.assertEqual(sorted(AlignmentManifest(self.processed_dir).entries), ['bob/b2_1.jpg', 'bob/b2_2.jpg'])
+
+    def testBackgroundThreadSweepsOnWake(self):
+        self.register('a', 'alice', deleted=True)
+        maintenance = Maintenance(self.SessionLocal, self.raw_dir, self.processed_dir, interval=3600).start()
+        maintenance.wake()
+        for _ in range(100):
+            with self.SessionLocal() as db:
+                if maintenance.pending(db) == 0:
+                    break
+            maintenance._stop.wait(0.05)
+        maintenance.stop(5)
+        self.assertFalse(os.path.exists(os.path.join(self.raw_dir, 'alice')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+import align.detect_face
+import convert_to_onnx
+
+try:
+    import onnxruntime  # noqa: F401
+    import tf2onnx  # noqa: F401
+    HAVE_ONNX = True
+except ImportError:
+    HAVE_ONNX = False
+
+from serving.backends import OnnxRuntimeBackend
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+MTCNN_DIR = os.path.join(TEST_DIR, '..', 'src', 'align')
+FACE_IMAGE = os.path.join(TEST_DIR, '..', 'DataSet', 'FaceData', 'raw', 'tungnt', 'tungnt_1.jpg')
+
+
+def build_embedding_graph(image_size):
+    with tf.Graph().as_default() as graph:
+        images = tf.compat.v1.placeholder(tf.float32, (None, image_size, image_size, 3), 'input')
+        weights = tf.constant(np.random.RandomState(1).normal(size=(3, 3, 3, 16)).astype(np.float32))
+        net = tf.nn.relu(tf.nn.conv2d(images, weights, [1, 2, 2, 1], 'SAME'))
+        net = tf.reduce_mean(net, [1, 2])
+        tf.nn.l2_normalize(net, 1, 1e-10, name='embeddings')
+    return graph.as_graph_def()
+
+
+@unittest.skipUnless(HAVE_ONNX, 'onnxruntime and tf2onnx are required')
+class OnnxBackendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_dir = tempfile.mkdtemp()
+        convert_to_onnx.convert_mtcnn(MTCNN_DIR, cls.model_dir)
+        cls.embedding_graph_def = build_embedding_graph(32)
+        convert_to_onnx.graph_def_to_onnx(cls.embedding_graph_def, ['input:0'], ['embeddings:0'],
+            os.path.join(cls.model_dir, 'facenet.onnx'))
+        cls.backend = OnnxRuntimeBackend(cls.model_dir)
+
+        cls.graph = tf.Graph()
+        with cls.graph.as_default():
+            cls.sess = tf.compat.v1.Session()
+            cls.mtcnn = align.detect_face.create_mtcnn(cls.sess, MTCNN_DIR)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sess.close()
+        shutil.rmtree(cls.model_dir)
+
+    def assertOutputsClose(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            self.assertEqual(e.shape, a.shape)
+            np.testing.assert_allclose(a, e, atol=1e-4)
+
+    def testMtcnnStagesMatchTensorFlow(self):
+        pnet, rnet, onet = self.mtcnn
+        rng = np.random.RandomState(0)
+        img = rng.uniform(-1, 1, size=(1, 70, 50, 3)).astype(np.float32)
+        self.assertOutputsClose(pnet(img), self.backend.pnet(img))
+        img = rng.uniform(-1, 1, size=(5, 24, 24, 3)).astype(np.float32)
+        self.assertOutputsClose(rnet(img), self.backend.rnet(img))
+        img = rng.uniform(-1, 1, size=(3, 48, 48, 3)).astype(np.float32)
+        self.assertOutputsClose(onet(img), self.backend.onet(img))
+
+    def testDetectFaceMatchesTensorFlow(self):
+        pnet, rnet, onet = self.mtcnn
+        img = cv2.cvtColor(cv2.imread(FACE_IMAGE), cv2.COLOR_BGR2RGB)
+        args = (20, [0.6, 0.7, 0.7], 0.709)
+        expected, _ = align.detect_face.detect_face(img, args[0], pnet, rnet, onet, args[1], args[2])
+        actual, _ = align.detect_face.detect_face(img, args[0], self.backend.pnet, self.backend.rnet,
+            self.backend.onet, args[1], args[2])
+        self.assertGreater(expected.shape[0], 0)
+        np.testing.assert_allclose(actual, expected, atol=0.5)
+
+    def testEmbeddingMatchesTensorFlow(self):
+        images = np.random.RandomState(2).uniform(-1, 1, size=(4, 32, 32, 3)).astype(np.float32)
+        with tf.Graph().as_default():
+            tf.import_graph_def(self.embedding_graph_def, name='')
+            with tf.compat.v1.Session() as sess:
+                expected = sess.run('embeddings:0', feed_dict={'input:0': images})
+        np.testing.assert_allclose(self.backend.embed(images), expected, atol=1e-5)
+
+    def testServiceDoesNotLoadTensorFlow(self):
+        env = dict(os.environ, FACE_INFERENCE_BACKEND='onnxruntime')
+        code = ('import sys, application, serving.backends; '
+                'sys.exit(int(any(m.split(".")[0] == "tensorflow" for m in sys.modules)))')
+        subprocess.run([sys.executable, '-c', code], env=env, check=True, cwd=os.path.join(TEST_DIR, '..'))
+
+
+if __name__ == "__main__":
+    unittest.main()
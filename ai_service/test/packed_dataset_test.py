@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import imageio
+import numpy as np
+import tensorflow as tf
+
+import facenet
+import lfw
+import pack_dataset
+import packed_dataset
+
+
+class PackedDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.processed = os.path.join(self.tmp_dir, 'processed')
+        self.packed = os.path.join(self.tmp_dir, 'processed.packed')
+        self.rng = np.random.RandomState(0)
+        for name, count in (('Bob', 2), ('Ann', 3)):
+            for i in range(count):
+                self.write_image(name, '%s_%04d.png' % (name, i + 1))
+
+    def tearDown(self):
+        packed_dataset._open_datasets.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_image(self, name, filename):
+        os.makedirs(os.path.join(self.processed, name), exist_ok=True)
+        imageio.imwrite(os.path.join(self.processed, name, filename),
+                        self.rng.randint(0, 255, size=(20, 20, 3), dtype=np.uint8))
+
+    def pack(self):
+        packed_dataset._open_datasets.clear()
+        return packed_dataset.pack(self.processed, self.packed)
+
+    def testPackMatchesDirectory(self):
+        self.assertEqual(self.pack(), (5, 0))
+        self.assertTrue(packed_dataset.is_packed(self.packed))
+        dataset = packed_dataset.get_dataset(self.packed)
+        expected = facenet.get_dataset(self.processed)
+        self.assertEqual([cls.name for cls in dataset], ['Ann', 'Bob'])
+        self.assertEqual([len(cls) for cls in dataset], [len(cls) for cls in expected])
+
+        paths, labels = facenet.get_image_paths_and_labels(dataset)
+        self.assertTrue(all(packed_dataset.is_ref(path) for path in paths))
+        files = [os.path.join(self.processed, packed_dataset.open_packed(self.packed).paths[
+            packed_dataset.parse_ref(path)[1]]) for path in paths]
+        np.testing.assert_array_equal(packed_dataset.load_data(paths, False, False, 16),
+                                      facenet.load_data(files, False, False, 16))
+        # References and plain files can be mixed
+        np.testing.assert_array_equal(packed_dataset.load_data([paths[0], files[1]], False, False, 16),
+                                      facenet.load_data(files[:2], False, False, 16))
+
+    def testIncrementalAppend(self):
+        self.pack()
+        self.write_image('Ann', 'Ann_0004.png')
+        self.write_image('Cid', 'Cid_0001.png')
+        self.assertEqual(self.pack(), (2, 5))
+        dataset = packed_dataset.PackedDataset(self.packed)
+        self.assertEqual(len(dataset), 7)
+        self.assertEqual(dataset.classes, ['Ann', 'Bob', 'Cid'])
+        self.assertEqual(dataset.paths[5:], ['Ann/Ann_0004.png', 'Cid/Cid_0001.png'])
+        np.testing.assert_array_equal(
+            dataset.images[5], imageio.imread(os.path.join(self.processed, 'Ann', 'Ann_0004.png')))
+
+    def testUncommittedRowsAreDropped(self):
+        self.pack()
+        writer = packed_dataset.PackedWriter(self.packed)
+        writer.append('Dan', 'Dan/Dan_0001.png', np.zeros((20, 20, 3), dtype=np.uint8))
+        writer.close()  # interrupted before commit
+        self.assertEqual(len(packed_dataset.PackedDataset(self.packed)), 5)
+        with packed_dataset.PackedWriter(self.packed) as writer:
+            self.assertNotIn('Dan/Dan_0001.png', writer.known)
+        self.assertEqual(os.path.getsize(os.path.join(self.packed, packed_dataset.IMAGES)), 5 * 20 * 20 * 3)
+        with self.assertRaises(ValueError):
+            with packed_dataset.PackedWriter(self.packed) as writer:
+                writer.append('Dan', 'Dan/Dan_0001.png', np.zeros((16, 16, 3), dtype=np.uint8))
+
+    def testPackedLfwPairs(self):
+        self.pack()
+        pairs = [['Ann', '1', '3'], ['Ann', '2', 'Bob', '1'], ['Bob', '1', '7']]
+        paths, issame = lfw.get_paths(self.packed, pairs)
+        self.assertEqual(issame, [True, False])
+        dataset = packed_dataset.open_packed(self.packed)
+        self.assertEqual([dataset.paths[packed_dataset.parse_ref(path)[1]] for path in paths],
+                         ['Ann/Ann_0001.png', 'Ann/Ann_0003.png', 'Ann/Ann_0002.png', 'Bob/Bob_0001.png'])
+
+    def testReadImageOp(self):
+        self.pack()
+        ref = packed_dataset.get_dataset(self.packed)[1].image_paths[0]
+        path = os.path.join(self.processed, 'Bob', 'Bob_0001.png')
+        with tf.Graph().as_default():
+            filename = tf.compat.v1.placeholder(tf.string, shape=())
+            image = packed_dataset.read_image(filename)
+            with tf.compat.v1.Session() as sess:
+                packed = sess.run(image, {filename: ref})
+                decoded = sess.run(image, {filename: path})
+        np.testing.assert_array_equal(packed, imageio.imread(path))
+        np.testing.assert_array_equal(decoded, packed)
+
+    def testPackDatasetScript(self):
+        pack_dataset.main(pack_dataset.parse_arguments([self.processed, self.packed, '--image_size', '20']))
+        self.assertEqual(len(packed_dataset.PackedDataset(self.packed)), 5)
+        with self.assertRaises(ValueError):
+            pack_dataset.main(pack_dataset.parse_arguments([self.processed, self.packed, '--image_size', '160']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+import convert_to_onnx
+import facenet
+import packed_dataset
+import quantize_embedder
+
+try:
+    import onnxruntime  # noqa: F401
+    import tf2onnx  # noqa: F401
+    HAVE_ONNX = True
+except ImportError:
+    HAVE_ONNX = False
+
+IMAGE_SIZE = 32
+
+
+def build_embedding_graph():
+    with tf.Graph().as_default() as graph:
+        images = tf.compat.v1.placeholder(tf.float32, (None, IMAGE_SIZE, IMAGE_SIZE, 3), 'input')
+        rng = np.random.RandomState(1)
+        w1 = tf.constant(rng.normal(size=(3, 3, 3, 16)).astype(np.float32))
+        w2 = tf.constant(rng.normal(size=(3, 3, 16, 32)).astype(np.float32) * 0.25)
+        net = tf.nn.relu(tf.nn.conv2d(images, w1, [1, 2, 2, 1], 'SAME'))
+        net = tf.nn.relu(tf.nn.conv2d(net, w2, [1, 2, 2, 1], 'SAME'))
+        net = tf.reduce_mean(net, [1, 2])
+        tf.nn.l2_normalize(net, 1, 1e-10, name='embeddings')
+    return graph.as_graph_def()
+
+
+def write_dataset(root, nrof_classes=6, nrof_images=8):
+    # Every class is a fixed random pattern plus per-image noise, so genuine pairs are close
+    rng = np.random.RandomState(3)
+    for i in range(nrof_classes):
+        class_dir = os.path.join(root, 'person_%d' % i)
+        os.makedirs(class_dir)
+        pattern = rng.uniform(0, 255, size=(IMAGE_SIZE, IMAGE_SIZE, 3))
+        for j in range(nrof_images):
+            img = np.clip(pattern + rng.normal(0, 20, size=pattern.shape), 0, 255).astype(np.uint8)
+            cv2.imwrite(os.path.join(class_dir, 'img_%d.png' % j), img)
+
+
+@unittest.skipUnless(HAVE_ONNX, 'onnxruntime and tf2onnx are required')
+class QuantizeEmbedderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dataset_dir = os.path.join(self.tmp_dir, 'processed')
+        write_dataset(self.dataset_dir)
+        self.float_model = os.path.join(self.tmp_dir, 'facenet.onnx')
+        self.int8_model = os.path.join(self.tmp_dir, 'facenet_int8.onnx')
+        convert_to_onnx.graph_def_to_onnx(build_embedding_graph(), ['input:0'], ['embeddings:0'], self.float_model)
+
+        rng = random.Random(0)
+        dataset = facenet.get_dataset(self.dataset_dir)
+        self.calibration_paths, holdout = quantize_embedder.split_calibration_set(dataset, 16, rng)
+        self.paths, self.actual_issame = quantize_embedder.sample_pairs(holdout, 40, rng)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testCalibrationSetIsHeldOut(self):
+        dataset = facenet.get_dataset(self.dataset_dir)
+        calibration_paths, holdout = quantize_embedder.split_calibration_set(dataset, 16, random.Random(0))
+        holdout_paths = [path for cls in holdout for path in cls.image_paths]
+        self.assertEqual(len(calibration_paths), 16)
+        self.assertEqual(len(holdout_paths), 6 * 8 - 16)
+        self.assertFalse(set(calibration_paths) & set(holdout_paths))
+        self.assertEqual(len(self.paths), 2 * len(self.actual_issame))
+
+    def testAcceptedModelIsQuantized(self):
+        report = quantize_embedder.quantize(self.float_model, self.int8_model, self.calibration_paths,
+            self.paths, self.actual_issame, image_size=IMAGE_SIZE, batch_size=8, max_accuracy_drop=0.1)
+        self.assertTrue(report['accepted'])
+        self.assertTrue(os.path.isfile(self.int8_model))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'facenet_int8.json')))
+        self.assertLess(os.path.getsize(self.int8_model), os.path.getsize(self.float_model))
+
+        import onnx
+        op_types = {node.op_type for node in onnx.load(self.int8_model).graph.node}
+        self.assertIn('QuantizeLinear', op_types)
+
+        session = onnxruntime.InferenceSession(self.int8_model, providers=['CPUExecutionProvider'])
+        images = facenet.load_data(self.paths[:8], False, False, IMAGE_SIZE).astype(np.float32)
+        int8 = session.run(None, {session.get_inputs()[0].name: images})[0]
+        float_session = onnxruntime.InferenceSession(self.float_model, providers=['CPUExecutionProvider'])
+        expected = float_session.run(None, {float_session.get_inputs()[0].name: images})[0]
+        self.assertGreater(np.min(np.sum(int8 * expected, axis=1)), 0.95)
+
+    def testPackedDatasetIsQuantized(self):
+        packed_dir = os.path.join(self.tmp_dir, 'packed')
+        packed_dataset.pack(self.dataset_dir, packed_dir, (IMAGE_SIZE, IMAGE_SIZE))
+        rng = random.Random(0)
+        dataset = packed_dataset.get_dataset(packed_dir)
+        calibration_paths, holdout = quantize_embedder.split_calibration_set(dataset, 16, rng)
+        paths, actual_issame = quantize_embedder.sample_pairs(holdout, 40, rng)
+        self.assertTrue(all(packed_dataset.is_ref(path) for path in calibration_paths + paths))
+
+        report = quantize_embedder.quantize(self.float_model, self.int8_model, calibration_paths,
+            paths, actual_issame, image_size=IMAGE_SIZE, batch_size=8, max_accuracy_drop=0.1)
+        self.assertTrue(report['accepted'])
+        self.assertTrue(os.path.isfile(self.int8_model))
+
+    def testRejectedModelIsNotWritten(self):
+        report = quantize_embedder.quantize(self.float_model, self.int8_model, self.calibration_paths,
+            self.paths, self.actual_issame, image_size=IMAGE_SIZE, batch_size=8, max_accuracy_drop=-1.0)
+        self.assertFalse(report['accepted'])
+        self.assertFalse(os.path.exists(self.int8_model))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['facenet.onnx', 'processed'])
+
+
+if __name__ == "__main__":
+    unittest.main()
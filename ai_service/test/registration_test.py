@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import imageio
+import numpy as np
+
+from serving import metrics
+from serving.alignment import AlignmentEngine
+from serving.registration import ArtifactWriter, RegistrationPipeline, template_of
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read(name):
+    with open(os.path.join(TEST_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def no_faces(img):
+    return np.zeros((0, 5)), np.zeros((10, 0))
+
+
+class RegistrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raw_dir = os.path.join(self.tmp_dir, 'raw')
+        self.processed_dir = os.path.join(self.tmp_dir, 'processed')
+        self.batches = []
+
+        def embed(images):
+            self.batches.append(images.shape)
+            embeddings = np.eye(images.shape[0], 512, dtype=np.float32)
+            return embeddings
+
+        self.pipeline = RegistrationPipeline(AlignmentEngine(no_faces, 160), embed)
+        self.uploads = [read('img.png'), read('img_1.png'), read('a.jpg')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testValidateDecodesOnce(self):
+        images, issues = self.pipeline.validate(self.uploads + [b'not an image', read('s.jpg')])
+        self.assertEqual([img is None for img in images], [False, False, False, True, False])
+        self.assertEqual(images[0].shape, (225, 225, 3))
+        self.assertEqual(issues, [[], [], [], ['unreadable'], ['blurry']])
+
+    def testEmbedFacesInOneBatch(self):
+        images, _ = self.pipeline.validate(self.uploads)
+        faces, embeddings = self.pipeline.embed_faces(images)
+        self.assertEqual(self.batches, [(3, 160, 160, 3)])
+        self.assertEqual([face.strategy for face in faces], ['center'] * 3)
+        self.assertEqual(faces[0].image.shape, (160, 160, 3))
+        template = template_of(embeddings)
+        np.testing.assert_allclose(template[:3], np.full(3, 1 / np.sqrt(3)), rtol=1e-6)
+
+    def write(self, retention, start=False):
+        images, _ = self.pipeline.validate(self.uploads)
+        faces, _ = self.pipeline.embed_faces(images)
+        writer = ArtifactWriter(self.raw_dir, self.processed_dir, retention, {'image_size': 160, 'margin': 44})
+        if start:
+            writer.start()
+        writer.submit('ann', 'f1', self.uploads, faces)
+        writer.flush()
+        writer.stop()
+        self.assertEqual(metrics.ARTIFACTS_PENDING._value.get(), 0)
+        return faces
+
+    def testNothingRetainedByDefault(self):
+        self.write('none', start=True)
+        self.assertFalse(os.path.exists(self.raw_dir))
+        self.assertFalse(os.path.exists(self.processed_dir))
+
+    def testRetainCropsInBackground(self):
+        faces = self.write('crops', start=True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.processed_dir, 'ann'))),
+                         ['f1_1.png', 'f1_2.png', 'f1_3.png'])
+        crop = imageio.imread(os.path.join(self.processed_dir, 'ann', 'f1_2.png'))
+        np.testing.assert_array_equal(crop, faces[1].image)
+        self.assertFalse(os.path.exists(self.raw_dir))
+
+    def testRetainAllRecordsManifest(self):
+        self.write('all')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.raw_dir, 'ann'))), ['f1_1.jpg', 'f1_2.jpg', 'f1_3.jpg'])
+        with open(os.path.join(self.raw_dir, 'ann', 'f1_3.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), self.uploads[2])
+        with open(os.path.join(self.processed_dir, 'manifest.jsonl')) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([entry['source'] for entry in entries], ['ann/f1_1.jpg', 'ann/f1_2.jpg', 'ann/f1_3.jpg'])
+        self.assertEqual(entries[0]['outputs'], ['ann/f1_1.png'])
+        self.assertEqual(entries[0]['detector'], 'center')
+        self.assertEqual(entries[0]['params'], {'image_size': 160, 'margin': 44})
+
+    def testUnknownRetention(self):
+        with self.assertRaises(ValueError):
+            ArtifactWriter(self.raw_dir, self.processed_dir, 'some')
+
+
+if __name__ == "__main__":
+    unittest.main()
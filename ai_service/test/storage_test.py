@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+from sqlalchemy import delete, inspect, text
+
+from serving.storage import FaceData, FacesRevision, create_db_engine, create_session_factory, init_db
+
+try:
+    import pgserver
+    import psycopg  # noqa: F401
+    HAVE_POSTGRES = True
+except ImportError:
+    HAVE_POSTGRES = False
+
+
+class SqliteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tmp_dir, 'faces.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testWalAndSynchronousNormal(self):
+        engine = create_db_engine(self.url)
+        init_db(engine)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            # 1 == NORMAL
+            self.assertEqual(connection.execute(text('PRAGMA synchronous')).scalar(), 1)
+        engine.dispose()
+
+    def testAddsColumnsToExistingTable(self):
+        engine = create_db_engine(self.url)
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE faces (id VARCHAR PRIMARY KEY, name VARCHAR, '
+                                    'registered_at DATETIME, embedding VARCHAR)'))
+            connection.execute(text("INSERT INTO faces VALUES ('a', 'alice', '2024-01-01 00:00:00', NULL)"))
+        init_db(engine)
+        columns = {column['name'] for column in inspect(engine).get_columns('faces')}
+        self.assertTrue({'embedding_dtype', 'model_version'} <= columns)
+        indexes = {index['name'] for index in inspect(engine).get_indexes('faces')}
+        self.assertTrue({'ix_faces_registered_at', 'ix_faces_model_version', 'ix_faces_deleted_at'} <= indexes)
+        with create_session_factory(engine)() as db:
+            self.assertIsNone(db.get(FaceData, 'a').model_version)
+        engine.dispose()
+
+    def testAddsIndexesToMigratedTable(self):
+        # A table that already has every column, but not the registered_at index
+        engine = create_db_engine(self.url)
+        init_db(engine)
+        with engine.begin() as connection:
+            connection.execute(text('DROP INDEX ix_faces_registered_at'))
+        init_db(engine)
+        indexes = {index['name'] for index in inspect(engine).get_indexes('faces')}
+        self.assertIn('ix_faces_registered_at', indexes)
+        engine.dispose()
+
+    def testWritesBumpFacesRevision(self):
+        engine = create_db_engine(self.url)
+        init_db(engine)
+        init_db(engine)  # keeps the single revision row
+        SessionLocal = create_session_factory(engine)
+
+        def revision(db):
+            return db.query(FacesRevision.revision).one()[0]
+
+        with SessionLocal() as db:
+            self.assertEqual(revision(db), 0)
+            db.add(FaceData(id='a', name='alice', registered_at=datetime.now()))
+            db.commit()
+            self.assertEqual(revision(db), 1)
+            db.get(FaceData, 'a').name = 'alicia'
+            db.commit()
+            self.assertEqual(revision(db), 2)
+            db.execute(delete(FaceData).where(FaceData.id == 'a'))
+            db.commit()
+            self.assertEqual(revision(db), 3)
+            # A rolled back write leaves the revision alone
+            db.add(FaceData(id='b', name='bob', registered_at=datetime.now()))
+            db.flush()
+            db.rollback()
+            self.assertEqual(revision(db), 3)
+        engine.dispose()
+
+    def testReaderNotBlockedByOpenWrite(self):
+        engine = create_db_engine(self.url)
+        init_db(engine)
+        SessionLocal = create_session_factory(engine)
+        with SessionLocal() as db:
+            db.add(FaceData(id='a', name='alice', registered_at=datetime.now()))
+            db.commit()
+
+        writer = SessionLocal()
+        writer.add(FaceData(id='b', name='bob', registered_at=datetime.now()))
+        writer.flush()  # holds the write lock until commit
+        counts = []
+        reader = threading.Thread(target=lambda: counts.append(SessionLocal().query(FaceData).count()))
+        reader.start()
+        reader.join(5)
+        writer.commit()
+        writer.close()
+        self.assertEqual(counts, [1])
+        engine.dispose()
+
+
+@unittest.skipUnless(HAVE_POSTGRES, 'pgserver and psycopg are required')
+class PostgresStorageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        cls.server = pgserver.get_server(cls.data_dir, cleanup_mode='stop')
+        cls.url = cls.server.get_uri().replace('postgresql://', 'postgresql+psycopg://', 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.cleanup()
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def testSchemaAndIndexes(self):
+        engine = create_db_engine(self.url, pool_size=2, schema='face_recognition')
+        init_db(engine, 'face_recognition')
+        init_db(engine, 'face_recognition')  # idempotent
+        inspector = inspect(engine)
+        self.assertIn('faces', inspector.get_table_names(schema='face_recognition'))
+        self.assertNotIn('faces', inspector.get_table_names(schema='public'))
+        indexes = {index['name']: index['column_names'] for index in
+                   inspector.get_indexes('faces', schema='face_recognition')}
+        self.assertEqual(indexes['ix_faces_name'], ['name'])
+        self.assertEqual(indexes['ix_faces_registered_at'], ['registered_at'])
+        engine.dispose()
+
+    def testReplicasShareIdentityStore(self):
+        replicas = [create_db_engine(self.url, pool_size=2, schema='shared') for _ in range(2)]
+        init_db(replicas[0], 'shared')
+        with create_session_factory(replicas[0])() as db:
+            db.add(FaceData(id='c', name='carol', registered_at=datetime.now()))
+            db.commit()
+        with create_session_factory(replicas[1])() as db:
+            self.assertEqual(db.query(FaceData).filter(FaceData.name == 'carol').one().id, 'c')
+        self.assertEqual(replicas[1].pool.size(), 2)
+        for engine in replicas:
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+from unittest import mock
+
+import cv2
+
+from serving.settings import Settings
+from serving.threads import BLAS_ENV_VARS, ThreadBudget, apply_process_limits
+
+
+def blas_threads():
+    """Threads of each loaded BLAS library, None without threadpoolctl"""
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        return None
+    return [pool['num_threads'] for pool in threadpool_info() if pool['user_api'] == 'blas']
+
+
+class ThreadBudgetTest(unittest.TestCase):
+
+    def testProfiles(self):
+        self.assertEqual(ThreadBudget.profile('default'), ThreadBudget())
+        latency = ThreadBudget.profile('latency', cpus=16)
+        self.assertEqual((latency.intra_op_threads, latency.inter_op_threads), (16, 1))
+        throughput = ThreadBudget.profile('throughput', cpus=16)
+        self.assertEqual((throughput.intra_op_threads, throughput.inter_op_threads), (2, 8))
+        for budget in (latency, throughput):
+            self.assertEqual((budget.opencv_threads, budget.blas_threads), (1, 1))
+        with self.assertRaises(ValueError):
+            ThreadBudget.profile('fastest')
+
+    def testSettingsFromEnv(self):
+        env = {'FACE_THREAD_PROFILE': 'Latency', 'FACE_INTER_OP_THREADS': '2', 'FACE_BLAS_THREADS': ''}
+        with mock.patch.dict(os.environ, env):
+            budget = Settings.from_env().thread_budget
+        self.assertEqual(budget.name, 'latency')
+        self.assertEqual(budget.inter_op_threads, 2)
+        self.assertEqual(budget.blas_threads, 1)
+
+        config = budget.tf_session_config()
+        self.assertEqual(config.intra_op_parallelism_threads, budget.intra_op_threads)
+        self.assertEqual(config.inter_op_parallelism_threads, 2)
+
+    def testApplyProcessLimits(self):
+        previous = cv2.getNumThreads()
+        blas_before = blas_threads()
+        limiter = None
+        try:
+            with mock.patch.dict(os.environ, {}):
+                limiter = apply_process_limits(ThreadBudget('test', opencv_threads=1, blas_threads=1))
+                self.assertEqual(cv2.getNumThreads(), 1)
+                for var in BLAS_ENV_VARS:
+                    self.assertEqual(os.environ[var], '1')
+        finally:
+            cv2.setNumThreads(previous)
+            # Do not leave numpy's BLAS at one thread for the rest of the test run
+            if limiter is not None:
+                limiter.restore_original_limits()
+        self.assertEqual(blas_threads(), blas_before)
+
+
+if __name__ == "__main__":
+    unittest.main()